@@ -0,0 +1,158 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+import httpx
+
+
+logger = logging.getLogger(__name__)
+
+
+class AdmissionController:
+    """Ограничение числа одновременно обрабатываемых запросов воркера.
+
+    Сверх лимита запросы ждут в очереди не дольше max_wait секунд и не больше queue_size штук,
+    остальные сразу отклоняются. При заданном latency_target лимит подстраивается по задержке
+    апстримов (AIMD): пока сглаженная задержка в норме, лимит растет примерно на 1 за каждые
+    limit ответов; при превышении цели или ошибке соединения — умножается на backoff,
+    не чаще раза в decrease_interval секунд.
+    """
+
+    def __init__(self, max_limit=0, min_limit=1, queue_size=100, max_wait=0.5,
+                 latency_target=0.0, backoff=0.9, decrease_interval=1.0, smoothing=0.2):
+        self.max_limit = max_limit
+        self.min_limit = min(min_limit, max_limit) if max_limit > 0 else min_limit
+        self.limit = float(max_limit)
+        self.queue_size = queue_size
+        self.max_wait = max_wait
+        self.latency_target = latency_target
+        self.backoff = backoff
+        self.decrease_interval = decrease_interval
+        self.smoothing = smoothing
+        self.in_flight = 0
+        self.latency = None
+        self._waiters = deque()
+        self._last_decrease = 0.0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+
+    @property
+    def enabled(self):
+        return self.max_limit > 0
+
+    async def acquire(self, timeout=None):
+        """Занимает слот; False — запрос надо отклонить. timeout ограничивает ожидание сверх max_wait."""
+        if not self.enabled:
+            return True
+        if self.in_flight < int(self.limit) and not self._waiters:
+            self.in_flight += 1
+            self.admitted += 1
+            return True
+        if len(self._waiters) >= self.queue_size:
+            self.rejected += 1
+            return False
+
+        wait = self.max_wait if timeout is None else min(self.max_wait, timeout)
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, wait)
+        except asyncio.TimeoutError:
+            self.timed_out += 1
+            return False
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release()  # слот уже был передан этому запросу
+            raise
+        finally:
+            if not waiter.done() or waiter.cancelled():
+                self._remove_waiter(waiter)
+        # Слот передан из release: in_flight уже увеличен
+        self.admitted += 1
+        return True
+
+    def _remove_waiter(self, waiter):
+        try:
+            self._waiters.remove(waiter)
+        except ValueError:
+            pass
+
+    def release(self):
+        if not self.enabled:
+            return
+        self.in_flight -= 1
+        self._wake_waiters()
+
+    def releaser(self):
+        """Освобождение слота, которое можно вызвать несколько раз: слот освобождается один раз."""
+        released = False
+
+        def release_once():
+            nonlocal released
+            if not released:
+                released = True
+                self.release()
+
+        return release_once
+
+    def _wake_waiters(self):
+        while self._waiters and self.in_flight < int(self.limit):
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(None)
+
+    def observe(self, latency, failed=False):
+        """Учитывает время ответа апстрима (секунды); failed — ошибка соединения или таймаут."""
+        if not self.enabled or self.latency_target <= 0:
+            return
+        self.latency = latency if self.latency is None else \
+            self.latency + (latency - self.latency) * self.smoothing
+
+        if failed or self.latency > self.latency_target:
+            now = time.monotonic()
+            if now - self._last_decrease >= self.decrease_interval:
+                self._last_decrease = now
+                previous = int(self.limit)
+                self.limit = max(float(self.min_limit), self.limit * self.backoff)
+                if int(self.limit) != previous:
+                    logger.warning(f"Upstream latency {self.latency * 1000:.0f} ms, "
+                                   f"concurrency limit lowered to {int(self.limit)}")
+        elif self.limit < self.max_limit:
+            self.limit = min(float(self.max_limit), self.limit + 1 / self.limit)
+            self._wake_waiters()
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "limit": int(self.limit),
+            "in_flight": self.in_flight,
+            "queued": len(self._waiters),
+            "latency_ms": round(self.latency * 1000, 1) if self.latency is not None else None,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+        }
+
+
+class LatencyObservingTransport(httpx.AsyncBaseTransport):
+    """Транспорт httpx, сообщающий время каждого запроса к апстриму в observe(latency, failed)."""
+
+    def __init__(self, transport, observe):
+        self.transport = transport
+        self.observe = observe
+
+    async def handle_async_request(self, request):
+        started = time.perf_counter()
+        try:
+            response = await self.transport.handle_async_request(request)
+        except (httpx.TimeoutException, httpx.NetworkError):
+            self.observe(time.perf_counter() - started, failed=True)
+            raise
+        self.observe(time.perf_counter() - started, failed=response.status_code >= 500)
+        return response
+
+    async def aclose(self):
+        await self.transport.aclose()
@@ -0,0 +1,77 @@
+import argparse
+import random
+import time
+
+from split_order import SplitOrderSolver, brute_force_solve
+
+
+def generate_city(pharmacies_count, basket_size, availability, rng):
+    """Синтетический ответ поиска: у каждой аптеки часть корзины, иногда с аналогами."""
+    basket = [{"sku": f"sku_{position}", "count_desired": rng.randint(1, 2)} for position in range(basket_size)]
+    base_prices = [rng.randint(300, 5000) for _ in basket]
+
+    pharmacies = []
+    for index in range(pharmacies_count):
+        products = []
+        for position, item in enumerate(basket):
+            if rng.random() > availability:
+                continue
+            product = {
+                "sku": item["sku"],
+                "base_price": round(base_prices[position] * rng.uniform(0.8, 1.3)),
+                "quantity": rng.choice((0, 1, 2, 5, 10)),
+                "quantity_desired": item["count_desired"],
+            }
+            if rng.random() < 0.2:
+                product["analogs"] = [{
+                    "sku": f"{item['sku']}_analog",
+                    "base_price": round(base_prices[position] * rng.uniform(0.5, 1.2)),
+                    "quantity": rng.choice((0, 1, 3)),
+                    "quantity_desired": item["count_desired"],
+                }]
+            products.append(product)
+        pharmacies.append({"source": {"code": f"pharmacy_{index}"}, "products": products})
+    return pharmacies, basket
+
+
+def run(args):
+    rng = random.Random(args.seed)
+    print(f"{'pharmacies':>10} {'skus':>5} {'solver ms':>10} {'brute ms':>10} {'speedup':>8} {'top-k match':>12}")
+    for pharmacies_count in args.pharmacies:
+        for basket_size in args.skus:
+            solver_time = brute_time = 0.0
+            matches = 0
+            for _ in range(args.rounds):
+                pharmacies, basket = generate_city(pharmacies_count, basket_size, args.availability, rng)
+                solver = SplitOrderSolver(top_k=args.top_k)
+
+                started = time.perf_counter()
+                solutions = solver.solve(pharmacies, basket, delivery_fee=args.delivery_fee)
+                solver_time += time.perf_counter() - started
+
+                started = time.perf_counter()
+                expected = brute_force_solve(pharmacies, basket, top_k=args.top_k, delivery_fee=args.delivery_fee)
+                brute_time += time.perf_counter() - started
+
+                matches += [solution["cost"] for solution in solutions] == expected
+
+            solver_ms = solver_time / args.rounds * 1000
+            brute_ms = brute_time / args.rounds * 1000
+            print(f"{pharmacies_count:>10} {basket_size:>5} {solver_ms:>10.2f} {brute_ms:>10.2f} "
+                  f"{brute_ms / solver_ms if solver_ms else 0:>7.1f}x {matches:>5}/{args.rounds:<6}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк поиска заказа из одной-двух аптек")
+    parser.add_argument("--pharmacies", type=int, nargs="+", default=[100, 300, 1000])
+    parser.add_argument("--skus", type=int, nargs="+", default=[3, 5, 8])
+    parser.add_argument("--availability", type=float, default=0.6, help="вероятность наличия позиции в аптеке")
+    parser.add_argument("--delivery-fee", type=float, default=600)
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=1)
+    run(parser.parse_args())
+
+
+if __name__ == "__main__":
+    main()
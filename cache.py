@@ -0,0 +1,492 @@
+import asyncio
+import fcntl
+import hashlib
+import json
+import logging
+import mmap
+import os
+import sqlite3
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+
+logger = logging.getLogger(__name__)
+
+
+def make_cache_key(prefix, *parts):
+    """Строит компактный ключ кэша: префикс и хэш от остальных частей."""
+    digest = hashlib.sha1(json.dumps(parts, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+    return f"{prefix}:{digest}"
+
+
+def encode_value(value):
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def decode_value(raw):
+    return json.loads(raw)
+
+
+# Снимок MemoryCache: заголовок (сигнатура, версия, время записи, число записей),
+# затем записи (срок жизни по часам, длина ключа, длина значения, ключ, значение)
+SNAPSHOT_MAGIC = b"FDCS"
+SNAPSHOT_VERSION = 1
+_SNAPSHOT_HEADER = struct.Struct("<4sHdI")
+_SNAPSHOT_RECORD = struct.Struct("<dHI")
+
+
+def write_snapshot(path, records):
+    """Атомарно записывает снимок из (ключ, expires_at, байты); возвращает число записей."""
+    records = list(records)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as file:
+        file.write(_SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, time.time(), len(records)))
+        for key, expires_at, raw in records:
+            encoded_key = key.encode("utf-8")
+            file.write(_SNAPSHOT_RECORD.pack(expires_at, len(encoded_key), len(raw)))
+            file.write(encoded_key)
+            file.write(raw)
+    os.replace(tmp_path, path)
+    return len(records)
+
+
+def claim_snapshot_slot(directory, limit=256):
+    """Номер воркера для файлов снимков: первый слот, чей файл блокировки никем не занят.
+
+    Возвращает (номер, открытый файл); блокировка держится, пока файл открыт (до конца процесса).
+    Перезапущенный воркер занимает освободившийся слот и восстанавливает снимок предшественника.
+    """
+    for slot in range(limit):
+        file = open(os.path.join(directory, f"worker-{slot}.lock"), "a")
+        try:
+            fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            file.close()
+            continue
+        return slot, file
+    raise OSError(f"all {limit} snapshot slots in {directory} are taken")
+
+
+class CacheSnapshot:
+    """Снимок, отображенный в память (mmap): при открытии читаются только заголовки записей,
+    значения копируются из файла при первом обращении к ключу.
+
+    Записи с истекшим сроком пропускаются; оставшийся TTL — срок из снимка минус прошедшее время.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._index = {}  # key -> (expires_at, смещение значения, длина)
+        self._map = None
+        self._pins = 0  # сколько сохранений снимка еще читают значения из файла
+        self._close_pending = False
+        with open(path, "rb") as file:
+            if os.fstat(file.fileno()).st_size < _SNAPSHOT_HEADER.size:
+                raise ValueError("snapshot is truncated")
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self._read_index()
+        except struct.error:
+            self.close()
+            raise ValueError("snapshot is truncated")
+        except Exception:
+            self.close()
+            raise
+
+    def _read_index(self):
+        magic, version, self.written_at, count = _SNAPSHOT_HEADER.unpack_from(self._map, 0)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            raise ValueError("unknown snapshot format")
+        now = time.time()
+        offset = _SNAPSHOT_HEADER.size
+        for _ in range(count):
+            expires_at, key_length, value_length = _SNAPSHOT_RECORD.unpack_from(self._map, offset)
+            offset += _SNAPSHOT_RECORD.size
+            key = self._map[offset:offset + key_length].decode("utf-8")
+            offset += key_length
+            if offset + value_length > len(self._map):
+                raise ValueError("snapshot is truncated")
+            if expires_at > now:
+                self._index.setdefault(key, (expires_at, offset, value_length))
+            offset += value_length
+
+    def __len__(self):
+        return len(self._index)
+
+    def pop(self, key):
+        """(expires_at, байты) записи или None; запись из снимка отдается один раз."""
+        location = self._index.pop(key, None)
+        if location is None:
+            return None
+        expires_at, offset, length = location
+        if expires_at <= time.time():
+            return None
+        return expires_at, self._map[offset:offset + length]
+
+    def discard(self, key):
+        self._index.pop(key, None)
+
+    def locations(self):
+        """Еще не загруженные живые записи без значений: [(ключ, expires_at, смещение, длина)]."""
+        now = time.time()
+        return [(key, expires_at, offset, length)
+                for key, (expires_at, offset, length) in self._index.items() if expires_at > now]
+
+    def read(self, offset, length):
+        return self._map[offset:offset + length]
+
+    def pin(self):
+        """Файл не закрывается, пока значения читаются вне блокировки кэша (до unpin)."""
+        self._pins += 1
+
+    def unpin(self):
+        self._pins -= 1
+        if not self._pins and self._close_pending:
+            self.close()
+
+    def close(self):
+        self._index = {}
+        if self._pins:
+            self._close_pending = True
+            return
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+
+class AsyncCacheMixin:
+    """Асинхронные варианты операций кэша для кода в event loop.
+
+    Кэши в памяти выполняют операции на месте; кэши с блокирующим вводом-выводом
+    переопределяют _run и выполняют их в потоке.
+    """
+
+    async def _run(self, func, *args):
+        return func(*args)
+
+    async def aget(self, key):
+        return await self._run(self.get, key)
+
+    async def aget_raw(self, key):
+        return await self._run(self.get_raw, key)
+
+    async def aset(self, key, value, ttl):
+        await self._run(self.set, key, value, ttl)
+
+    async def aset_raw(self, key, raw, ttl):
+        await self._run(self.set_raw, key, raw, ttl)
+
+    async def adelete(self, key):
+        await self._run(self.delete, key)
+
+    async def astats(self):
+        return await self._run(self.stats)
+
+
+class NullCache(AsyncCacheMixin):
+    """Кэш выключен: всегда промах."""
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        self.misses += 1
+        return None
+
+    def get_raw(self, key):
+        return self.get(key)
+
+    def set(self, key, value, ttl):
+        pass
+
+    def set_raw(self, key, raw, ttl):
+        pass
+
+    def delete(self, key):
+        pass
+
+    def stats(self):
+        return {"backend": "none", "hits": self.hits, "misses": self.misses, "entries": 0}
+
+
+class MemoryCache(AsyncCacheMixin):
+    """Кэш в памяти процесса с TTL и ограничением числа записей (LRU).
+
+    Значения хранятся в сериализованном виде: каждый get возвращает новую копию,
+    поэтому фильтры, изменяющие словари аптек на месте, не портят кэш.
+    """
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (expires_at, raw)
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self.hits = 0
+        self.misses = 0
+        self.restored = 0
+
+    def get(self, key):
+        raw = self.get_raw(key)
+        return None if raw is None else decode_value(raw)
+
+    def get_raw(self, key):
+        """Байты значения как есть (для значений, записанных через set_raw)."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None and self._snapshot is not None:
+                entry = self._restore(key)
+            if entry is None or entry[0] <= time.time():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def _restore(self, key):
+        """Переносит запись из снимка в кэш (под self._lock)."""
+        entry = self._snapshot.pop(key)
+        if not self._snapshot:
+            self._snapshot.close()
+            self._snapshot = None
+        if entry is None:
+            return None
+        self.restored += 1
+        self._entries[key] = entry
+        self._evict()
+        return entry
+
+    def set(self, key, value, ttl):
+        self.set_raw(key, encode_value(value), ttl)
+
+    def set_raw(self, key, raw, ttl):
+        with self._lock:
+            self._entries[key] = (time.time() + ttl, raw)
+            self._entries.move_to_end(key)
+            if self._snapshot is not None:
+                self._snapshot.discard(key)
+            self._evict()
+
+    def _evict(self):
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+            if self._snapshot is not None:
+                self._snapshot.discard(key)
+
+    def attach_snapshot(self, path):
+        """Подключает снимок с диска; записи загружаются при первом обращении к ключу."""
+        snapshot = CacheSnapshot(path)
+        with self._lock:
+            for key in self._entries:
+                snapshot.discard(key)
+            if self._snapshot is not None:
+                self._snapshot.close()
+            self._snapshot = snapshot if snapshot else None
+        if not snapshot:
+            snapshot.close()
+        return len(snapshot)
+
+    def save_snapshot(self, path, max_entries=None):
+        """Записывает до max_entries живых записей, начиная с недавно использованных.
+
+        Не загруженные еще записи прошлого снимка идут после записей кэша.
+        """
+        now = time.time()
+        with self._lock:
+            # Под блокировкой копируются только ссылки и смещения; значения из прошлого снимка
+            # читаются из файла и новый файл пишется уже без блокировки
+            records = [(key, entry[0], entry[1]) for key, entry in reversed(self._entries.items()) if entry[0] > now]
+            snapshot = self._snapshot
+            pending = snapshot.locations() if snapshot is not None else []
+            if pending:
+                snapshot.pin()
+        if max_entries is not None:
+            records = records[:max_entries]
+            pending = pending[:max(max_entries - len(records), 0)]
+        try:
+            records.extend((key, expires_at, snapshot.read(offset, length))
+                           for key, expires_at, offset, length in pending)
+        finally:
+            if pending:
+                with self._lock:
+                    snapshot.unpin()
+        return write_snapshot(path, records)
+
+    def stats(self):
+        return {
+            "backend": "memory",
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self._entries),
+            "restored": self.restored,
+            "snapshot_pending": len(self._snapshot) if self._snapshot is not None else 0,
+        }
+
+
+class SQLiteCache(AsyncCacheMixin):
+    """Кэш в SQLite (режим WAL), общий для всех воркеров на одном хосте.
+
+    Каждый процесс открывает свое соединение к одному файлу; данные хранятся один раз,
+    поэтому попадания не зависят от того, какой воркер получил запрос, а RSS не растет
+    с числом воркеров. У каждого кэша своя таблица table и свое ограничение размера.
+
+    Чтение не пишет в базу: время обращения к прочитанным ключам копится в памяти и
+    записывается пачкой (вместе с очередной записью, либо при TOUCH_BATCH ключах или раз
+    в TOUCH_INTERVAL секунд), так что воркеры не спорят за блокировку записи на каждом
+    попадании. Асинхронные операции (aget и т. д.) выполняются в потоке, не блокируя loop.
+    """
+
+    # Как часто (в записях) проверять ограничение размера
+    EVICT_EVERY = 100
+    # Сколько прочитанных ключей или секунд копить до записи времени обращения
+    TOUCH_BATCH = 100
+    TOUCH_INTERVAL = 5.0
+
+    def __init__(self, path, max_entries=10000, table="cache"):
+        if not table.isidentifier():
+            raise ValueError(f"Invalid cache table name '{table}'")
+        self.path = path
+        self.max_entries = max_entries
+        self.table = table
+        self._conn = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._touched = {}  # key -> время последнего чтения, еще не записанное в базу
+        self._touched_at = time.monotonic()
+        self.hits = 0
+        self.misses = 0
+
+    async def _run(self, func, *args):
+        return await asyncio.to_thread(func, *args)
+
+    def _connection(self):
+        # После fork соединение родителя использовать нельзя — открываем свое
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=1.0, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {self.table} ("
+                "key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            conn.execute(f"CREATE INDEX IF NOT EXISTS {self.table}_accessed_at ON {self.table} (accessed_at)")
+            self._conn = conn
+            self._pid = os.getpid()
+        return self._conn
+
+    def get(self, key):
+        raw = self.get_raw(key)
+        return None if raw is None else decode_value(raw)
+
+    def get_raw(self, key):
+        """Байты значения как есть (для значений, записанных через set_raw)."""
+        now = time.time()
+        try:
+            with self._lock:
+                conn = self._connection()
+                row = conn.execute(f"SELECT value, expires_at FROM {self.table} WHERE key = ?", (key,)).fetchone()
+                if row is None or row[1] <= now:
+                    self.misses += 1
+                    return None
+                self.hits += 1
+                self._touched[key] = now
+                if len(self._touched) >= self.TOUCH_BATCH or \
+                        time.monotonic() - self._touched_at >= self.TOUCH_INTERVAL:
+                    self._flush_touched(conn)
+        except sqlite3.Error as e:
+            logger.error(f"Cache read error: {e}")
+            self.misses += 1
+            return None
+        return bytes(row[0])
+
+    def set(self, key, value, ttl):
+        self.set_raw(key, encode_value(value), ttl)
+
+    def set_raw(self, key, raw, ttl):
+        now = time.time()
+        try:
+            with self._lock:
+                conn = self._connection()
+                self._touched.pop(key, None)
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    conn.execute(
+                        f"INSERT OR REPLACE INTO {self.table} (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+                        (key, raw, now + ttl, now),
+                    )
+                    self._write_touched(conn)
+                    self._writes += 1
+                    if self._writes % self.EVICT_EVERY == 0:
+                        self._evict(conn, now)
+                    conn.execute("COMMIT")
+                except BaseException:
+                    conn.execute("ROLLBACK")
+                    raise
+        except sqlite3.Error as e:
+            logger.error(f"Cache write error: {e}")
+
+    def _write_touched(self, conn):
+        if self._touched:
+            conn.executemany(f"UPDATE {self.table} SET accessed_at = ? WHERE key = ?",
+                             [(accessed_at, key) for key, accessed_at in self._touched.items()])
+            self._touched = {}
+        self._touched_at = time.monotonic()
+
+    def _flush_touched(self, conn):
+        """Записывает накопленное время обращений одной транзакцией (под self._lock)."""
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._write_touched(conn)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        except sqlite3.Error as e:
+            # Время обращения нужно только для вытеснения — при занятой базе попробуем позже
+            logger.warning(f"Cache access time update skipped: {e}")
+            self._touched_at = time.monotonic()
+
+    def _evict(self, conn, now):
+        conn.execute(f"DELETE FROM {self.table} WHERE expires_at <= ?", (now,))
+        conn.execute(
+            f"DELETE FROM {self.table} WHERE key IN ("
+            f"SELECT key FROM {self.table} ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        )
+
+    def delete(self, key):
+        try:
+            with self._lock:
+                self._touched.pop(key, None)
+                self._connection().execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+        except sqlite3.Error as e:
+            logger.error(f"Cache delete error: {e}")
+
+    def stats(self):
+        try:
+            with self._lock:
+                entries = self._connection().execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+        except sqlite3.Error:
+            entries = None
+        return {"backend": "sqlite", "hits": self.hits, "misses": self.misses, "entries": entries}
+
+
+def create_cache(backend, path=None, max_entries=10000, table="cache"):
+    """Создает кэш по имени бэкенда: none, memory или sqlite (в таблице table файла path)."""
+    if backend == "memory":
+        return MemoryCache(max_entries=max_entries)
+    if backend == "sqlite":
+        return SQLiteCache(path, max_entries=max_entries, table=table)
+    if backend not in ("none", "", None):
+        logger.warning(f"Unknown cache backend '{backend}', caching disabled")
+    return NullCache()
@@ -0,0 +1,201 @@
+import asyncio
+import logging
+import time
+from array import array
+
+
+logger = logging.getLogger(__name__)
+
+
+class CountMinSketch:
+    """Приближенный счетчик частот в фиксированной памяти: width x depth счетчиков.
+
+    Оценка никогда не меньше настоящего числа и завышена тем меньше, чем шире таблица.
+    """
+
+    def __init__(self, width=2048, depth=4):
+        self.width = width
+        self.depth = depth
+        self._rows = [array("L", bytes(array("L").itemsize * width)) for _ in range(depth)]
+
+    def _cells(self, key):
+        # Ячейки всех рядов — из двух половин одного 64-битного хеша ключа (двойное хеширование)
+        value = hash(key) & 0xFFFFFFFFFFFFFFFF
+        first, second = value & 0xFFFFFFFF, (value >> 32) | 1
+        return [(first + row * second) % self.width for row in range(self.depth)]
+
+    def add(self, key, count=1):
+        """Увеличивает счетчики ключа (консервативно: только минимальные) и возвращает новую оценку."""
+        cells = self._cells(key)
+        estimate = min(row[cell] for row, cell in zip(self._rows, cells)) + count
+        for row, cell in zip(self._rows, cells):
+            if row[cell] < estimate:
+                row[cell] = estimate
+        return estimate
+
+    def estimate(self, key):
+        return min(row[cell] for row, cell in zip(self._rows, self._cells(key)))
+
+    def decay(self):
+        """Делит все счетчики пополам: частота отражает недавний трафик."""
+        for row in self._rows:
+            for cell in range(self.width):
+                row[cell] >>= 1
+
+
+class HotKeyTracker:
+    """capacity самых частых ключей по оценке CountMinSketch; для каждого хранится последний spec."""
+
+    def __init__(self, capacity=200, width=2048, depth=4):
+        self.capacity = capacity
+        self.sketch = CountMinSketch(width, depth)
+        self._top = {}  # key -> [оценка, spec]
+        self._min = 0  # нижняя граница оценок в _top; считается, когда _top заполнен
+
+    def __contains__(self, key):
+        return key in self._top
+
+    def __len__(self):
+        return len(self._top)
+
+    def add(self, key, spec):
+        estimate = self.sketch.add(key)
+        entry = self._top.get(key)
+        if entry is not None:
+            entry[0] = estimate
+            entry[1] = spec
+        elif len(self._top) < self.capacity:
+            self._top[key] = [estimate, spec]
+            if len(self._top) == self.capacity:
+                self._min = min(entry[0] for entry in self._top.values())
+        elif estimate > self._min:
+            # Оценки в _top с тех пор могли вырасти: вытесняем, только если новый ключ чаще самого редкого
+            coldest = min(self._top, key=lambda top_key: self._top[top_key][0])
+            if estimate > self._top[coldest][0]:
+                del self._top[coldest]
+                self._top[key] = [estimate, spec]
+            self._min = min(entry[0] for entry in self._top.values())
+        return estimate
+
+    def hot(self, min_count=1):
+        """[(ключ, оценка, spec)] с оценкой не меньше min_count, от самых частых."""
+        entries = [(key, count, spec) for key, (count, spec) in self._top.items() if count >= min_count]
+        entries.sort(key=lambda entry: entry[1], reverse=True)
+        return entries
+
+    def decay(self):
+        self.sketch.decay()
+        for key in list(self._top):
+            self._top[key][0] >>= 1
+            if not self._top[key][0]:
+                del self._top[key]
+        self._min = min((entry[0] for entry in self._top.values()), default=0)
+
+
+class CacheWarmer:
+    """Фоновое обновление популярных записей кэша апстрима до истечения их срока.
+
+    Запросы отмечаются через record(ключ частоты, ключ кэша, spec). Раз в interval секунд
+    для ключей, встреченных не меньше min_hits раз, чьи записи истекают в ближайшие lead
+    секунд (или уже истекли), вызывается refresh(ключ кэша, spec) — он должен сам записать
+    кэш. Срок записи сообщает stored(ключ кэша, ttl) при любой записи в кэш; ключи, чья
+    запись еще не сохранялась, не обновляются.
+    Апстрим защищен лимитом rate обновлений в секунду (с запасом на один цикл) и
+    не более concurrency одновременными вызовами. Раз в decay_interval секунд частоты
+    делятся пополам.
+    """
+
+    def __init__(self, name, refresh, capacity=200, min_hits=3, lead=10.0, rate=5.0, concurrency=4,
+                 interval=5.0, decay_interval=60.0):
+        self.name = name
+        self.refresh = refresh
+        self.tracker = HotKeyTracker(capacity)
+        self.min_hits = min_hits
+        self.lead = lead
+        self.rate = rate
+        self.concurrency = concurrency
+        self.interval = interval
+        self.decay_interval = decay_interval
+        self.expires_at = {}  # ключ кэша -> срок записи (monotonic), только для отслеживаемых ключей
+        self._watched = set()
+        self._tokens = rate * interval
+        self._refilled_at = time.monotonic()
+        self._decayed_at = time.monotonic()
+        self.recorded = 0
+        self.refreshed = 0
+        self.failed = 0
+        self.throttled = 0
+
+    def record(self, key, cache_key, spec):
+        self.recorded += 1
+        self.tracker.add(key, (cache_key, spec))
+        if key in self.tracker:
+            self._watched.add(cache_key)
+
+    def stored(self, cache_key, ttl):
+        if cache_key in self._watched:
+            self.expires_at[cache_key] = time.monotonic() + ttl
+
+    def _take_tokens(self, now):
+        burst = max(self.rate * self.interval, 1.0)
+        self._tokens = min(burst, self._tokens + (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+        return int(self._tokens)
+
+    async def run_once(self):
+        """Один цикл: обновляет записи, которые скоро истекут; возвращает число обновленных."""
+        now = time.monotonic()
+        if now - self._decayed_at >= self.decay_interval:
+            self.tracker.decay()
+            self._decayed_at = now
+
+        hot = self.tracker.hot(self.min_hits)
+        self._watched = {cache_key for _, _, (cache_key, _) in self.tracker.hot(0)}
+        self.expires_at = {key: at for key, at in self.expires_at.items() if key in self._watched}
+
+        # Ключ без известного срока записи пропускаем: иначе он обновлялся бы каждый цикл
+        due = [(cache_key, spec) for _, _, (cache_key, spec) in hot
+               if cache_key in self.expires_at and self.expires_at[cache_key] - now <= self.lead]
+        allowed = self._take_tokens(now)
+        if len(due) > allowed:
+            self.throttled += len(due) - allowed
+            due = due[:allowed]
+        if not due:
+            return 0
+        self._tokens -= len(due)
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def refresh(cache_key, spec):
+            async with semaphore:
+                try:
+                    ok = await self.refresh(cache_key, spec)
+                except Exception as e:
+                    logger.warning(f"Cache warmer '{self.name}' refresh failed: {e}")
+                    ok = False
+            if ok:
+                self.refreshed += 1
+            else:
+                self.failed += 1
+            return ok
+
+        results = await asyncio.gather(*(refresh(cache_key, spec) for cache_key, spec in due))
+        return sum(results)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.run_once()
+            except Exception as e:
+                logger.error(f"Cache warmer '{self.name}' cycle failed: {e}")
+
+    def stats(self):
+        return {
+            "tracked": len(self.tracker),
+            "hot": len(self.tracker.hot(self.min_hits)),
+            "recorded": self.recorded,
+            "refreshed": self.refreshed,
+            "failed": self.failed,
+            "throttled": self.throttled,
+        }
@@ -0,0 +1,80 @@
+import gzip
+import logging
+
+from fastapi.responses import Response
+
+try:
+    import brotli
+except ImportError:  # brotli необязателен: без него хранится только gzip
+    brotli = None
+
+
+logger = logging.getLogger(__name__)
+
+# При равном q в Accept-Encoding предпочитаем кодировку, которая раньше в списке
+SUPPORTED_ENCODINGS = ("br", "gzip")
+
+
+def available_encodings(requested):
+    """Кодировки из конфигурации, которые можно использовать (br — только с установленным brotli)."""
+    encodings = []
+    for encoding in requested:
+        if encoding not in SUPPORTED_ENCODINGS:
+            logger.warning(f"Unsupported response encoding '{encoding}' ignored")
+        elif encoding == "br" and brotli is None:
+            logger.info("brotli is not installed, br response encoding disabled")
+        else:
+            encodings.append(encoding)
+    return [encoding for encoding in SUPPORTED_ENCODINGS if encoding in encodings]
+
+
+def compress_variants(body, encodings, min_size=1024, gzip_level=6, brotli_quality=5):
+    """Тело ответа и его сжатые варианты: {"identity": body, "gzip": ..., "br": ...}.
+
+    Ответы меньше min_size байт не сжимаются. Вариант, который не меньше исходного, не хранится.
+    """
+    variants = {"identity": body}
+    if len(body) < min_size:
+        return variants
+    for encoding in encodings:
+        if encoding == "gzip":
+            compressed = gzip.compress(body, compresslevel=gzip_level, mtime=0)
+        else:
+            compressed = brotli.compress(body, quality=brotli_quality)
+        if len(compressed) < len(body):
+            variants[encoding] = compressed
+    return variants
+
+
+def choose_encoding(accept_encoding, available):
+    """Кодировка из available по заголовку Accept-Encoding (с учетом q); identity, если подходящей нет."""
+    if not accept_encoding:
+        return "identity"
+    weights = {}
+    for item in accept_encoding.split(","):
+        name, _, params = item.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        weights[name.strip().lower()] = quality
+
+    best, best_quality = "identity", 0.0
+    for encoding in SUPPORTED_ENCODINGS:
+        if encoding not in available:
+            continue
+        quality = weights.get(encoding, weights.get("*", 0.0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def encoded_response(body, encoding):
+    """Готовые байты без повторной сериализации и сжатия."""
+    headers = {"Vary": "Accept-Encoding"}
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    return Response(content=body, media_type="application/json", headers=headers)
@@ -0,0 +1,118 @@
+import threading
+import time
+
+
+# Границы полос расстояния (км) от аптеки до адреса доставки
+DISTANCE_BANDS_KM = (1, 2, 3, 5, 8, 13, 21)
+# Ширина интервала времени суток (часы)
+HOUR_BUCKET_SIZE = 3
+
+
+def distance_band(distance_km):
+    for band, upper_bound in enumerate(DISTANCE_BANDS_KM):
+        if distance_km < upper_bound:
+            return band
+    return len(DISTANCE_BANDS_KM)
+
+
+def hour_bucket(hour):
+    return hour // HOUR_BUCKET_SIZE
+
+
+class _RunningStats:
+    """Скользящее среднее минимальной цены и минимального времени доставки."""
+
+    __slots__ = ("count", "price", "eta", "observed_at")
+
+    def __init__(self):
+        self.count = 0
+        self.price = 0.0
+        self.eta = 0.0
+        self.observed_at = None
+
+    def add(self, price, eta, max_weight, now):
+        # После max_weight наблюдений среднее становится экспоненциальным и следует за изменениями тарифов
+        self.count += 1
+        self.observed_at = now
+        weight = 1 / min(self.count, max_weight)
+        self.price += (price - self.price) * weight
+        self.eta += (eta - self.eta) * weight
+
+
+class DeliveryEstimator:
+    """Локальная оценка стоимости и времени доставки по уже полученным ответам URL_PRICE.
+
+    Статистика ведется на нескольких уровнях детализации: (полоса расстояния, аптека, время суток),
+    (полоса, аптека), (полоса, время суток), (полоса) и общий. Прогноз берется с самого детального
+    уровня, где накоплено не меньше min_samples наблюдений. Все вычисления детерминированы:
+    время суток передается явно, момент наблюдения (time.monotonic) можно передать в now.
+    """
+
+    def __init__(self, min_samples=5, max_weight=50):
+        self.min_samples = min_samples
+        self.max_weight = max_weight
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _keys(source_code, distance_km, hour):
+        band = distance_band(distance_km)
+        bucket = hour_bucket(hour)
+        return (
+            ("band_code_hour", band, source_code, bucket),
+            ("band_code", band, source_code),
+            ("band_hour", band, bucket),
+            ("band", band),
+            ("all",),
+        )
+
+    def observe(self, source_code, distance_km, hour, delivery_options, now=None):
+        """Учитывает ответ URL_PRICE: берутся самая дешевая и самая быстрая опции доставки."""
+        if not delivery_options:
+            return
+        price = min(option["price"] for option in delivery_options)
+        eta = min(option["eta"] for option in delivery_options)
+        now = time.monotonic() if now is None else now
+
+        with self._lock:
+            for key in self._keys(source_code, distance_km, hour):
+                stats = self._stats.get(key)
+                if stats is None:
+                    stats = self._stats[key] = _RunningStats()
+                stats.add(price, eta, self.max_weight, now)
+
+    def predict(self, source_code, distance_km, hour):
+        """Возвращает (цена, eta) или None, если данных недостаточно."""
+        with self._lock:
+            for key in self._keys(source_code, distance_km, hour):
+                stats = self._stats.get(key)
+                if stats is not None and stats.count >= self.min_samples:
+                    return stats.price, stats.eta
+        return None
+
+    def touch(self, source_code, distance_km, now=None):
+        """Отмечает, что тариф аптеки на этой полосе расстояния подтвержден (ответ из кэша).
+
+        Наблюдение не добавляется: один ответ, отданный из кэша много раз, учитывается
+        в статистике один раз.
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            stats = self._stats.get(("band_code", distance_band(distance_km), source_code))
+            if stats is not None:
+                stats.observed_at = now
+
+    def is_fresh(self, source_code, distance_km, max_age, now=None):
+        """Было ли у аптеки наблюдение на этой полосе расстояния не старше max_age секунд.
+
+        Прогноз для аптеки без свежих наблюдений держится на старых тарифах или на общих
+        уровнях — такую аптеку стоит запросить, а не отсеивать.
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            stats = self._stats.get(("band_code", distance_band(distance_km), source_code))
+            return stats is not None and now - stats.observed_at <= max_age
+
+    def stats(self):
+        with self._lock:
+            return {"keys": len(self._stats), "observations": self._stats.get(("all",), _RunningStats()).count}
@@ -0,0 +1,343 @@
+import argparse
+import asyncio
+import copy
+import json
+import logging
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+from fastapi.responses import JSONResponse
+
+import main
+import reference_engines
+from stages import same_result
+
+
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+ROUND_THE_CLOCK = "Круглосуточно"
+
+
+def format_time(moment):
+    return moment.strftime(TIME_FORMAT)
+
+
+def generate_hours(rng):
+    """Расписание аптеки относительно текущего момента.
+
+    Смещения — целые минуты плюс 30 секунд, чтобы граница «закроется через час» не сдвигалась
+    между вызовами эталона и движка.
+    """
+    now = datetime.utcnow()
+    situation = rng.choices(
+        ("round_the_clock", "open", "closes_soon", "hour_boundary", "closed", "not_open_yet", "invalid", "missing"),
+        weights=(10, 30, 20, 5, 15, 10, 3, 2),
+    )[0]
+
+    def at(minutes):
+        return format_time(now + timedelta(minutes=minutes, seconds=30 if minutes >= 0 else -30))
+
+    if situation == "round_the_clock":
+        return {"opening_hours": ROUND_THE_CLOCK, "closes_at": at(rng.randint(-60, 60)), "opens_at": at(-600)}
+    hours = {"opening_hours": "Пн-Вс: 08:00-23:00"}
+    if situation == "open":
+        hours.update(opens_at=at(-rng.randint(61, 600)), closes_at=at(rng.randint(61, 600)))
+    elif situation == "closes_soon":
+        hours.update(opens_at=at(-rng.randint(61, 600)), closes_at=at(rng.randint(0, 59)))
+    elif situation == "hour_boundary":
+        hours.update(opens_at=at(-rng.randint(61, 600)), closes_at=at(rng.choice((59, 60, 61))))
+    elif situation == "closed":
+        hours.update(opens_at=at(-rng.randint(600, 1200)), closes_at=at(-rng.randint(1, 300)))
+    elif situation == "not_open_yet":
+        hours.update(opens_at=at(rng.randint(1, 180)), closes_at=at(rng.randint(181, 900)))
+    elif situation == "invalid":
+        hours.update(opens_at="08:00", closes_at="23:00")
+    else:
+        hours.update(opens_at=at(-60), closes_at=None)
+    return hours
+
+
+def generate_source(rng, index):
+    source = {
+        "code": f"pharmacy_{index}",
+        "name": f"Аптека {index}",
+        # Координаты на грубой сетке, чтобы чаще встречались равные расстояния
+        "lat": round(43.2 + rng.randint(0, 20) * 0.005, 3),
+        "lon": round(76.9 + rng.randint(0, 20) * 0.005, 3),
+    }
+    source.update(generate_hours(rng))
+    if rng.random() < 0.05:
+        source["lat"] = None
+    if rng.random() < 0.02:
+        del source["code"]
+    return source
+
+
+def generate_analog(rng, sku, base_price):
+    analog_sku = f"{sku}_analog_{rng.randint(0, 3)}"
+    price = round(base_price * rng.choice((0.5, 0.7, 0.8, 0.8, 1.0, 1.2)))
+    return {
+        "source_code": "analogs",
+        "sku": analog_sku,
+        "name": f"Аналог {analog_sku}",
+        "base_price": price,
+        "price_with_warehouse_discount": price,
+        "warehouse_discount": 0,
+        "quantity": rng.choice((0, 1, 2, 3, 5)),
+        "pp_packing": "",
+        "recipe_needed": rng.random() < 0.2,
+        "strong_recipe": False,
+    }
+
+
+def generate_search_result(rng, basket, pharmacies_count, availability=0.7):
+    """Ответ поиска: часть корзины в каждой аптеке, аналоги, повторяющиеся цены и остатки."""
+    base_prices = {item["sku"]: rng.choice((300, 500, 800, 1200, 2500)) for item in basket}
+    pharmacies = []
+    for index in range(pharmacies_count):
+        products = []
+        for item in basket:
+            if rng.random() > availability:
+                continue
+            base_price = base_prices[item["sku"]]
+            price = round(base_price * rng.choice((0.9, 1.0, 1.0, 1.1)))
+            products.append({
+                "sku": item["sku"],
+                "name": f"Товар {item['sku']}",
+                "base_price": price,
+                "quantity": rng.choice((0, 1, 2, 3, 5, 10)),
+                "diff": 0,
+                "avg_price": base_price,
+                "min_price": round(base_price * 0.9),
+                "analogs": [generate_analog(rng, item["sku"], base_price) for _ in range(rng.choice((0, 0, 1, 2, 3)))],
+            })
+        rng.shuffle(products)
+        pharmacies.append({"source": generate_source(rng, index), "products": products})
+    return pharmacies
+
+
+def generate_basket(rng, max_skus):
+    skus = rng.sample(range(max_skus * 2), rng.randint(1, max_skus))
+    return [{"sku": f"sku_{sku}", "count_desired": rng.choice((1, 1, 2, 3))} for sku in skus]
+
+
+def generate_filtered(rng, args):
+    """Аптеки после priority_filter: с total_sum, часть с равными суммами."""
+    basket = generate_basket(rng, args.max_skus)
+    pharmacies = generate_search_result(rng, basket, rng.randint(0, args.max_pharmacies))
+    for pharmacy in pharmacies:
+        pharmacy.update(replacements_needed=0, replaced_skus=[], total_sum=rng.choice((1000, 1500, 1500, 2000, 3100)))
+    return pharmacies
+
+
+def priority_filter_case(rng, args):
+    basket = generate_basket(rng, args.max_skus)
+    pharmacies = generate_search_result(rng, basket, rng.randint(0, args.max_pharmacies))
+    return [{"result": pharmacies}, basket]
+
+
+def closest_case(rng, args):
+    user_lat = round(43.2 + rng.randint(0, 20) * 0.005, 3)
+    user_lon = round(76.9 + rng.randint(0, 20) * 0.005, 3)
+    return [{"filtered_pharmacies": generate_filtered(rng, args)}, user_lat, user_lon]
+
+
+def cheapest_case(rng, args):
+    pharmacies = generate_filtered(rng, args)
+    # get_top_cheapest_pharmacies сортирует по ключу "pharmacy" — встречается и такая форма
+    if rng.random() < 0.2:
+        pharmacies = [{"pharmacy": pharmacy} for pharmacy in pharmacies]
+    return [{"filtered_pharmacies": pharmacies}]
+
+
+def best_option_case(rng, args):
+    """Варианты доставки: открытые, закрытые, закрывающиеся; цены около порога «на 30% дешевле»."""
+    if rng.random() < 0.03:
+        return [[]]
+    base_price = rng.choice((1000, 2000, 5000))
+    options = []
+    for index in range(rng.randint(1, args.max_options)):
+        total_price = round(base_price * rng.choice((0.5, 0.69, 0.7, 0.71, 0.9, 1.0, 1.0, 1.3)))
+        eta = rng.choice((30, 42, 60, 60, 90, 120))
+        pharmacy = {"source": generate_source(rng, index), "products": [], "total_sum": total_price - 500}
+        option = {"pharmacy": pharmacy, "total_price": total_price,
+                  "delivery_option": {"price": 500, "eta": eta}}
+        if rng.random() < 0.01:
+            del option["delivery_option"]
+        options.append(option)
+    return [options]
+
+
+STAGES = {
+    "priority_filter": (reference_engines.filter_pharmacies_by_priority_items, priority_filter_case),
+    "closest": (reference_engines.get_top_closest_pharmacies, closest_case),
+    "cheapest": (reference_engines.get_top_cheapest_pharmacies, cheapest_case),
+    "best_option": (reference_engines.best_option, best_option_case),
+}
+
+
+async def call(func, case):
+    """Результат и время вызова на собственной копии входа; исключение — тоже результат."""
+    case = copy.deepcopy(case)
+    started = time.perf_counter()
+    try:
+        result = await func(*case)
+    except Exception as e:
+        result = ("exception", type(e).__name__, str(e))
+    return result, time.perf_counter() - started
+
+
+def same(first, second):
+    if isinstance(first, tuple) or isinstance(second, tuple):
+        return first == second
+    return same_result(first, second)
+
+
+def describe(result):
+    if isinstance(result, JSONResponse):
+        return {"status": result.status_code, "body": json.loads(result.body)}
+    if isinstance(result, tuple):
+        return {"exception": result[1], "message": result[2]}
+    return result
+
+
+def _list_paths(value, path=()):
+    if isinstance(value, list):
+        yield path
+        for index, item in enumerate(value):
+            yield from _list_paths(item, path + (index,))
+    elif isinstance(value, dict):
+        for key, item in value.items():
+            yield from _list_paths(item, path + (key,))
+
+
+def _at(value, path):
+    for key in path:
+        value = value[key]
+    return value
+
+
+async def minimize(case, diverges, max_checks=3000):
+    """Жадно удаляет элементы списков (аптеки, товары, аналоги, варианты), пока расхождение сохраняется."""
+    checks = 0
+    changed = True
+    while changed and checks < max_checks:
+        changed = False
+        for path in _list_paths(case):
+            if not path:
+                continue  # сами аргументы этапа не удаляем
+            for index in reversed(range(len(_at(case, path)))):
+                candidate = copy.deepcopy(case)
+                del _at(candidate, path)[index]
+                checks += 1
+                if await diverges(candidate):
+                    case = candidate
+                    changed = True
+                    break
+            if changed:
+                break  # пути устарели — перечисляем заново
+    return case
+
+
+class EngineReport:
+    def __init__(self, stage, engine):
+        self.stage = stage
+        self.engine = engine
+        self.cases = 0
+        self.mismatches = 0
+        self.reference_time = 0.0
+        self.engine_time = 0.0
+        self.reproducer = None
+
+    def as_dict(self):
+        return {
+            "stage": self.stage,
+            "engine": self.engine,
+            "cases": self.cases,
+            "mismatches": self.mismatches,
+            "reference_ms": round(self.reference_time * 1000, 3),
+            "engine_ms": round(self.engine_time * 1000, 3),
+            "speedup": round(self.reference_time / self.engine_time, 2) if self.engine_time else None,
+            "reproducer": self.reproducer,
+        }
+
+
+async def fuzz(args):
+    rng = random.Random(args.seed)
+    reports = []
+    for stage in args.stages:
+        reference, generate = STAGES[stage]
+        engines = {name: func for name, func in main.pipeline_stages.engines[stage].items()
+                   if not args.engines or name in args.engines}
+        stage_reports = {name: EngineReport(stage, name) for name in engines}
+        reports.extend(stage_reports.values())
+
+        for _ in range(args.cases):
+            case = generate(rng, args)
+            expected, reference_time = await call(reference, case)
+            for name, func in engines.items():
+                report = stage_reports[name]
+                result, engine_time = await call(func, case)
+                report.cases += 1
+                report.reference_time += reference_time
+                report.engine_time += engine_time
+                if same(expected, result):
+                    continue
+                report.mismatches += 1
+                if report.reproducer is None:
+                    report.reproducer = await reproduce(reference, func, case)
+    return reports
+
+
+async def reproduce(reference, func, case):
+    async def diverges(candidate):
+        return not same((await call(reference, candidate))[0], (await call(func, candidate))[0])
+
+    case = await minimize(case, diverges)
+    return {
+        "args": case,
+        "reference": describe((await call(reference, case))[0]),
+        "engine": describe((await call(func, case))[0]),
+    }
+
+
+def print_reports(reports):
+    print(f"{'stage':>16} {'engine':>14} {'cases':>6} {'diff':>5} {'ref ms':>9} {'engine ms':>10} {'speedup':>8}")
+    for report in reports:
+        row = report.as_dict()
+        speedup = f"{row['speedup']:.2f}x" if row["speedup"] else "-"
+        print(f"{row['stage']:>16} {row['engine']:>14} {row['cases']:>6} {row['mismatches']:>5} "
+              f"{row['reference_ms']:>9.1f} {row['engine_ms']:>10.1f} {speedup:>8}")
+    for report in reports:
+        if report.reproducer is not None:
+            print(f"\nMinimized reproducer for {report.stage}={report.engine}:")
+            print(json.dumps(report.reproducer, ensure_ascii=False, indent=2, default=str))
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Дифференциальный фаззер движков пайплайна против замороженного эталона")
+    parser.add_argument("--stages", nargs="+", choices=sorted(STAGES), default=sorted(STAGES))
+    parser.add_argument("--engines", nargs="+", help="только эти движки (по умолчанию все зарегистрированные)")
+    parser.add_argument("--cases", type=int, default=300)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--max-pharmacies", type=int, default=30)
+    parser.add_argument("--max-skus", type=int, default=4)
+    parser.add_argument("--max-options", type=int, default=10)
+    parser.add_argument("--report", help="файл для отчета в JSON")
+    args = parser.parse_args()
+
+    # Промежуточные файлы и логи этапов не нужны и искажают время
+    main.save_response_to_file = lambda *args, **kwargs: None
+    logging.disable(logging.CRITICAL)
+
+    reports = asyncio.run(fuzz(args))
+    print_reports(reports)
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as file:
+            json.dump([report.as_dict() for report in reports], file, ensure_ascii=False, indent=2, default=str)
+    sys.exit(1 if any(report.mismatches for report in reports) else 0)
+
+
+if __name__ == "__main__":
+    main_cli()
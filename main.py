@@ -1,17 +1,46 @@
+import time
+
+# Начало импорта приложения: время импорта попадает в отчет о старте воркера (GET /health/ready)
+_import_started = time.perf_counter()
+
+import asyncio
+import contextvars
+import hashlib
 import os
+import random
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
 from collections import defaultdict
 
 import httpx
 import math
 from fastapi import FastAPI, Request
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
 import logging
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.background import BackgroundTask
 import json
 from dotenv import load_dotenv
 from datetime import datetime, timedelta
 import pytz
 
+from admission import AdmissionController, LatencyObservingTransport
+from cache import MemoryCache, claim_snapshot_slot, create_cache, encode_value, make_cache_key
+from cache_warmer import CacheWarmer
+from compression import available_encodings, choose_encoding, compress_variants, encoded_response
+from estimator import DeliveryEstimator
+from memory_tracking import MemoryTracker, RssBudget
+from pool_filters import (analog_replacement, apply_filter_plan, basket_total_sum, compact_basket,
+                          compact_search_result, plan_filter_stages)
+from profiling import ProfileStore, ProfilingMiddleware, pstats_text
+from router import CityRouter
+from schemas import best_options_json, encode_best_options, parse_delivery_request
+from split_order import SplitOrderSolver
+from stages import BestOptions, FilteredPharmacies, PharmacyList, SearchResult, StageRegistry
+from stock_index import FileTailFeed, StockIndex, consume_feed
+from warmup import WorkerWarmup
+
 
 load_dotenv()
 
@@ -22,6 +51,209 @@ app = FastAPI()
 URL_SEARCH = os.getenv("URL_SEARCH")
 URL_PRICE = os.getenv("URL_PRICE")
 
+# Бюджет времени на запрос (мс). 0 — без ограничения, работают таймауты httpx по умолчанию
+REQUEST_DEADLINE_MS = int(os.getenv("REQUEST_DEADLINE_MS", "0"))
+# Запас времени (мс), который оставляем на выбор лучшего варианта после запросов к апстримам
+DEADLINE_RESERVE_MS = int(os.getenv("DEADLINE_RESERVE_MS", "50"))
+DEADLINE_HEADER = "X-Request-Deadline-Ms"
+
+# Кэш ответов URL_SEARCH и URL_PRICE: none (выключен), memory (в процессе) или sqlite (общий для воркеров хоста)
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "none")
+CACHE_PATH = os.getenv("CACHE_PATH", "/tmp/fast_delivery_cache.sqlite3")
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "10000"))
+SEARCH_CACHE_TTL = int(os.getenv("SEARCH_CACHE_TTL", "60"))
+PRICE_CACHE_TTL = int(os.getenv("PRICE_CACHE_TTL", "60"))
+
+# Радиус доставки (км) для предварительного отсева аптек после поиска. 0 — отсев выключен
+DELIVERY_RADIUS_KM = float(os.getenv("DELIVERY_RADIUS_KM", "0"))
+# Если в радиусе меньше MIN_PHARMACIES_IN_RADIUS аптек, радиус удваивается до DELIVERY_RADIUS_MAX_KM
+DELIVERY_RADIUS_MAX_KM = float(os.getenv("DELIVERY_RADIUS_MAX_KM", "30"))
+MIN_PHARMACIES_IN_RADIUS = int(os.getenv("MIN_PHARMACIES_IN_RADIUS", "5"))
+EARTH_RADIUS_KM = 6371.0
+
+# Пул соединений общего HTTP-клиента к апстримам
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "20"))
+
+# Окно (мс), в течение которого запросы цен от параллельных запросов объединяются. 0 — выключено
+PRICE_BATCH_WINDOW_MS = int(os.getenv("PRICE_BATCH_WINDOW_MS", "0"))
+PRICE_BATCH_MAX_SIZE = int(os.getenv("PRICE_BATCH_MAX_SIZE", "20"))
+# Пакетный расчет цен: POST со списком payload, в ответ список ответов в том же порядке.
+# Если не задан, одинаковые запросы все равно объединяются, а разные отправляются параллельно
+URL_PRICE_BATCH = os.getenv("URL_PRICE_BATCH")
+
+# Локальная оценка цены и времени доставки: цены запрашиваются только у кандидатов, которые могут победить
+ESTIMATOR_ENABLED = os.getenv("ESTIMATOR_ENABLED", "false").lower() == "true"
+ESTIMATOR_MIN_SAMPLES = int(os.getenv("ESTIMATOR_MIN_SAMPLES", "5"))
+# Допуск к лучшему прогнозу: кандидаты в пределах допуска все равно запрашиваются
+ESTIMATOR_MARGIN = float(os.getenv("ESTIMATOR_MARGIN", "0.15"))
+# Аптека, у которой нет ответа URL_PRICE моложе стольких секунд (на этой полосе расстояния),
+# запрашивается всегда — иначе отсеянная аптека так и осталась бы со старым прогнозом
+ESTIMATOR_MAX_AGE = float(os.getenv("ESTIMATOR_MAX_AGE", "600"))
+
+# Индекс остатков в памяти: поиск отвечает из индекса, пока он актуален, иначе идет в URL_SEARCH.
+# Снимки — файлы *.json в STOCK_INDEX_SNAPSHOT_DIR, изменения — JSONL-файл STOCK_INDEX_FEED_PATH
+STOCK_INDEX_ENABLED = os.getenv("STOCK_INDEX_ENABLED", "false").lower() == "true"
+STOCK_INDEX_SNAPSHOT_DIR = os.getenv("STOCK_INDEX_SNAPSHOT_DIR", "stock_snapshots")
+STOCK_INDEX_FEED_PATH = os.getenv("STOCK_INDEX_FEED_PATH")
+# Сколько секунд индекс города считается актуальным после последнего события
+STOCK_INDEX_MAX_AGE = float(os.getenv("STOCK_INDEX_MAX_AGE", "60"))
+
+# Кэш итоговых ответов /partial_availability: none, memory или sqlite. Ключ — город, корзина,
+# ячейка сетки адреса и интервал времени (от него зависит режим работы аптек)
+RESPONSE_CACHE_BACKEND = os.getenv("RESPONSE_CACHE_BACKEND", "none")
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", "15"))
+# Сколько секунд после TTL ответ еще отдается, пока в фоне считается новый
+RESPONSE_CACHE_STALE_TTL = int(os.getenv("RESPONSE_CACHE_STALE_TTL", "45"))
+RESPONSE_CACHE_CELL_DEG = float(os.getenv("RESPONSE_CACHE_CELL_DEG", "0.001"))
+RESPONSE_CACHE_TIME_BUCKET = int(os.getenv("RESPONSE_CACHE_TIME_BUCKET", "300"))
+# Ответы в кэше хранятся готовыми байтами JSON и, начиная с RESPONSE_COMPRESSION_MIN_BYTES,
+# сжатыми вариантами (br — при установленном brotli); вариант выбирается по Accept-Encoding
+RESPONSE_COMPRESSION_ENCODINGS = [encoding.strip() for encoding in
+                                  os.getenv("RESPONSE_COMPRESSION_ENCODINGS", "br,gzip").split(",") if encoding.strip()]
+RESPONSE_COMPRESSION_MIN_BYTES = int(os.getenv("RESPONSE_COMPRESSION_MIN_BYTES", "1024"))
+RESPONSE_GZIP_LEVEL = int(os.getenv("RESPONSE_GZIP_LEVEL", "6"))
+RESPONSE_BROTLI_QUALITY = int(os.getenv("RESPONSE_BROTLI_QUALITY", "5"))
+
+# Снимки кэшей в памяти (memory) на диске: пишутся периодически и при остановке, читаются
+# при старте по мере обращений. Пустое значение — снимки выключены
+CACHE_SNAPSHOT_DIR = os.getenv("CACHE_SNAPSHOT_DIR", "")
+CACHE_SNAPSHOT_INTERVAL = int(os.getenv("CACHE_SNAPSHOT_INTERVAL", "60"))
+# Сколько недавно использованных записей каждого кэша сохранять
+CACHE_SNAPSHOT_MAX_ENTRIES = int(os.getenv("CACHE_SNAPSHOT_MAX_ENTRIES", "5000"))
+
+# Запись запросов и ответов апстримов в JSONL для офлайн-прогона (replay.py)
+RECORD_TRAFFIC_PATH = os.getenv("RECORD_TRAFFIC_PATH")
+RECORD_TRAFFIC_SAMPLE_RATE = float(os.getenv("RECORD_TRAFFIC_SAMPLE_RATE", "1.0"))
+
+# Фильтрация ответов поиска, в которых аптек не меньше порога, выполняется в пуле процессов,
+# чтобы не блокировать event loop. 0 — всегда в текущем процессе
+PROCESS_POOL_THRESHOLD = int(os.getenv("PROCESS_POOL_THRESHOLD", "0"))
+PROCESS_POOL_WORKERS = int(os.getenv("PROCESS_POOL_WORKERS", "2"))
+
+# Профилирование отдельных запросов: по заголовку X-Profile со значением PROFILE_TOKEN
+# или случайная доля PROFILE_SAMPLE_RATE запросов. Без токена ручки /debug/profiles выключены
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN")
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+# Режим по умолчанию: sample (свернутые стеки) или cprofile (дамп pstats)
+PROFILE_DEFAULT_MODE = os.getenv("PROFILE_DEFAULT_MODE", "sample")
+PROFILE_MAX_STORED = int(os.getenv("PROFILE_MAX_STORED", "100"))
+
+# Учет памяти по этапам пайплайна: off, rss или tracemalloc
+MEMORY_TRACKING = os.getenv("MEMORY_TRACKING", "off")
+MEMORY_TRACEMALLOC_FRAMES = int(os.getenv("MEMORY_TRACEMALLOC_FRAMES", "10"))
+# Ограничение RSS воркера (МБ): при превышении новые запросы получают 503. 0 — без ограничения
+RSS_BUDGET_MB = float(os.getenv("RSS_BUDGET_MB", "0"))
+RSS_BUDGET_RETRY_AFTER = int(os.getenv("RSS_BUDGET_RETRY_AFTER", "1"))
+
+# Ограничение одновременно обрабатываемых запросов воркера. 0 — без ограничения
+ADMISSION_MAX_CONCURRENCY = int(os.getenv("ADMISSION_MAX_CONCURRENCY", "0"))
+ADMISSION_MIN_CONCURRENCY = int(os.getenv("ADMISSION_MIN_CONCURRENCY", "4"))
+# Очередь сверх лимита: размер и максимальное ожидание (мс)
+ADMISSION_QUEUE_SIZE = int(os.getenv("ADMISSION_QUEUE_SIZE", "100"))
+ADMISSION_MAX_WAIT_MS = int(os.getenv("ADMISSION_MAX_WAIT_MS", "500"))
+# Целевая задержка апстримов (мс) для адаптивного лимита (AIMD). 0 — лимит постоянный
+ADMISSION_LATENCY_TARGET_MS = int(os.getenv("ADMISSION_LATENCY_TARGET_MS", "0"))
+ADMISSION_RETRY_AFTER = int(os.getenv("ADMISSION_RETRY_AFTER", "1"))
+
+# Заказы из двух аптек, когда ни одна аптека не собирает корзину целиком (или это дешевле)
+SPLIT_ORDER_ENABLED = os.getenv("SPLIT_ORDER_ENABLED", "false").lower() == "true"
+# Сколько лучших решений рассматривать (включая заказы из одной аптеки)
+SPLIT_ORDER_TOP_K = int(os.getenv("SPLIT_ORDER_TOP_K", "3"))
+# Ожидаемая цена доставки из одной аптеки для оценки решений, если оценщик не дает прогноза
+SPLIT_ORDER_DELIVERY_FEE = float(os.getenv("SPLIT_ORDER_DELIVERY_FEE", "600"))
+
+# Реализации этапов пайплайна: "этап=движок,..." — активные и теневые (сравниваются с активными
+# на доле PIPELINE_SHADOW_SAMPLE_RATE запросов). Этапы и движки — в GET /metrics (stages)
+PIPELINE_ENGINES = os.getenv("PIPELINE_ENGINES", "")
+PIPELINE_SHADOW = os.getenv("PIPELINE_SHADOW", "")
+PIPELINE_SHADOW_SAMPLE_RATE = float(os.getenv("PIPELINE_SHADOW_SAMPLE_RATE", "0.01"))
+
+# Кэш отрицательных результатов (город + корзина, для которых аптек нет): none, memory или sqlite
+NEGATIVE_CACHE_BACKEND = os.getenv("NEGATIVE_CACHE_BACKEND", "none")
+NEGATIVE_CACHE_TTL = int(os.getenv("NEGATIVE_CACHE_TTL", "30"))
+NEGATIVE_CACHE_MAX_ENTRIES = int(os.getenv("NEGATIVE_CACHE_MAX_ENTRIES", "10000"))
+
+# Прогрев воркера до приема трафика: часовой пояс, соединения с апстримами, ответы поиска по городам
+WARMUP_ENABLED = os.getenv("WARMUP_ENABLED", "false").lower() == "true"
+# Соединений, открываемых заранее к каждому апстриму
+WARMUP_CONNECTIONS = int(os.getenv("WARMUP_CONNECTIONS", "4"))
+# Города и SKU (через запятую), для которых заранее запрашивается поиск
+WARMUP_CITIES = [city.strip() for city in os.getenv("WARMUP_CITIES", "").split(",") if city.strip()]
+WARMUP_SKUS = [sku.strip() for sku in os.getenv("WARMUP_SKUS", "").split(",") if sku.strip()]
+# Ограничение времени каждого сетевого шага прогрева (мс)
+WARMUP_STEP_TIMEOUT_MS = int(os.getenv("WARMUP_STEP_TIMEOUT_MS", "5000"))
+# Убрать переживший прогрев heap из-под сборщика мусора (gc.freeze)
+WARMUP_GC_FREEZE = os.getenv("WARMUP_GC_FREEZE", "true").lower() == "true"
+
+# Маршрутизация запросов по городу между воркерами/узлами (router.py); без участников отключена
+# Базовые URL участников через запятую, включая этот воркер
+ROUTER_MEMBERS = [member.strip() for member in os.getenv("ROUTER_MEMBERS", "").split(",") if member.strip()]
+# Базовый URL этого воркера среди участников: его города обрабатываются на месте
+ROUTER_SELF = os.getenv("ROUTER_SELF")
+# Файл со списком участников (по строке), перечитывается при изменении
+ROUTER_MEMBERS_FILE = os.getenv("ROUTER_MEMBERS_FILE")
+ROUTER_REPLICAS = int(os.getenv("ROUTER_REPLICAS", "100"))
+ROUTER_HEALTH_INTERVAL = float(os.getenv("ROUTER_HEALTH_INTERVAL", "5"))
+
+# Фоновое обновление популярных записей кэша апстримов до истечения (нужен CACHE_BACKEND)
+CACHE_WARMER_ENABLED = os.getenv("CACHE_WARMER_ENABLED", "false").lower() == "true"
+# Период цикла обновления (с) и за сколько секунд до истечения запись обновляется
+CACHE_WARMER_INTERVAL = float(os.getenv("CACHE_WARMER_INTERVAL", "5"))
+CACHE_WARMER_LEAD = float(os.getenv("CACHE_WARMER_LEAD", "10"))
+# Сколько самых частых ключей отслеживается и сколько обращений делает ключ популярным
+CACHE_WARMER_TOP_K = int(os.getenv("CACHE_WARMER_TOP_K", "200"))
+CACHE_WARMER_MIN_HITS = int(os.getenv("CACHE_WARMER_MIN_HITS", "3"))
+# Частоты делятся пополам раз в CACHE_WARMER_DECAY_INTERVAL секунд
+CACHE_WARMER_DECAY_INTERVAL = float(os.getenv("CACHE_WARMER_DECAY_INTERVAL", "60"))
+# Лимиты обновлений в секунду для URL_SEARCH и URL_PRICE на весь хост: делятся поровну между
+# воркерами uvicorn (WEB_CONCURRENCY). Лимит одновременных вызовов каждого — на воркер
+CACHE_WARMER_SEARCH_RATE = float(os.getenv("CACHE_WARMER_SEARCH_RATE", "2"))
+CACHE_WARMER_PRICE_RATE = float(os.getenv("CACHE_WARMER_PRICE_RATE", "10"))
+CACHE_WARMER_CONCURRENCY = int(os.getenv("CACHE_WARMER_CONCURRENCY", "4"))
+CACHE_WARMER_WORKERS = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+# Размер ячейки координат (в градусах), по которой считается популярность цен доставки
+CACHE_WARMER_CELL_DEG = float(os.getenv("CACHE_WARMER_CELL_DEG", "0.001"))
+
+upstream_cache = create_cache(CACHE_BACKEND, path=CACHE_PATH, max_entries=CACHE_MAX_ENTRIES)
+delivery_estimator = DeliveryEstimator(min_samples=ESTIMATOR_MIN_SAMPLES)
+split_order_solver = SplitOrderSolver(top_k=SPLIT_ORDER_TOP_K)
+
+pipeline_stages = StageRegistry()
+pipeline_stages.define("radius_filter", (SearchResult, "user_lat", "user_lon"), SearchResult)
+pipeline_stages.define("missing_items_filter", (SearchResult, "sku_data"), SearchResult)
+pipeline_stages.define("priority_filter", (SearchResult, "sku_data"), FilteredPharmacies, errors=True)
+pipeline_stages.define("fulfillment_sort", (FilteredPharmacies,), FilteredPharmacies)
+pipeline_stages.define("closest", (FilteredPharmacies, "user_lat", "user_lon"), PharmacyList)
+pipeline_stages.define("cheapest", (FilteredPharmacies,), PharmacyList)
+pipeline_stages.define("best_option", ("delivery_options",), BestOptions, errors=True)
+pipeline_stages.configure(PIPELINE_ENGINES, PIPELINE_SHADOW, PIPELINE_SHADOW_SAMPLE_RATE)
+stock_index = StockIndex(max_age=STOCK_INDEX_MAX_AGE)
+# Кэши в одном файле sqlite держат записи в своих таблицах с отдельным ограничением размера
+response_cache = create_cache(RESPONSE_CACHE_BACKEND, path=CACHE_PATH, max_entries=CACHE_MAX_ENTRIES,
+                              table="response_cache")
+response_encodings = available_encodings(RESPONSE_COMPRESSION_ENCODINGS) if RESPONSE_CACHE_BACKEND != "none" else []
+negative_cache = create_cache(NEGATIVE_CACHE_BACKEND, path=CACHE_PATH, max_entries=NEGATIVE_CACHE_MAX_ENTRIES,
+                              table="negative_cache")
+profile_store = ProfileStore(max_profiles=PROFILE_MAX_STORED)
+memory_tracker = MemoryTracker(mode=MEMORY_TRACKING, frames=MEMORY_TRACEMALLOC_FRAMES)
+rss_budget = RssBudget(budget_mb=RSS_BUDGET_MB)
+worker_warmup = WorkerWarmup(_import_started)
+admission = AdmissionController(
+    max_limit=ADMISSION_MAX_CONCURRENCY,
+    min_limit=ADMISSION_MIN_CONCURRENCY,
+    queue_size=ADMISSION_QUEUE_SIZE,
+    max_wait=ADMISSION_MAX_WAIT_MS / 1000,
+    latency_target=ADMISSION_LATENCY_TARGET_MS / 1000,
+)
+
+# Записи кэша апстримов, из которых собран текущий ответ: [(ключ, версия)]
+_cache_dependencies = contextvars.ContextVar("cache_dependencies", default=None)
+# Время по этапам пайплайна для текущего запроса: {этап: [wall, cpu]}
+_stage_timings = contextvars.ContextVar("stage_timings", default=None)
+# Записываемый обмен с апстримами для текущего запроса
+_traffic_record = contextvars.ContextVar("traffic_record", default=None)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -30,105 +262,1181 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Без токена и семплирования middleware не подключается вовсе
+if PROFILE_TOKEN or PROFILE_SAMPLE_RATE > 0:
+    app.add_middleware(
+        ProfilingMiddleware,
+        store=profile_store,
+        token=PROFILE_TOKEN,
+        sample_rate=PROFILE_SAMPLE_RATE,
+        default_mode=PROFILE_DEFAULT_MODE,
+        paths={"/partial_availability", "/partial_availability/stream"},
+    )
 
-@app.post("/partial_availability")
-async def main_process(request: Request):
+# Маршрутизатор подключается последним, чтобы чужие города уходили дальше до остальных middleware
+if ROUTER_MEMBERS or ROUTER_MEMBERS_FILE:
+    app.add_middleware(
+        CityRouter,
+        members=ROUTER_MEMBERS,
+        self_member=ROUTER_SELF,
+        members_file=ROUTER_MEMBERS_FILE,
+        replicas=ROUTER_REPLICAS,
+        health_interval=ROUTER_HEALTH_INTERVAL,
+    )
+
+
+class Deadline:
+    """Бюджет времени на обработку одного запроса, общий для всех вызовов апстримов."""
+
+    def __init__(self, budget_ms=0):
+        self.budget_ms = budget_ms
+        self.expires_at = time.monotonic() + budget_ms / 1000 if budget_ms > 0 else None
+        self.partial = False  # True, если ответ собран не из всех вариантов доставки
+
+    @classmethod
+    def from_request(cls, request):
+        """Берет бюджет из заголовка запроса, иначе из конфигурации."""
+        header_value = request.headers.get(DEADLINE_HEADER)
+        if header_value:
+            try:
+                return cls(int(header_value))
+            except ValueError:
+                logger.warning(f"Invalid {DEADLINE_HEADER} header value: {header_value}")
+        return cls(REQUEST_DEADLINE_MS)
 
+    def remaining(self):
+        """Оставшееся время в секундах (None, если бюджета нет)."""
+        if self.expires_at is None:
+            return None
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self):
+        remaining = self.remaining()
+        return remaining is not None and remaining <= DEADLINE_RESERVE_MS / 1000
+
+    def cut_call(self):
+        """Сработал ли таймаут вызова апстрима из-за бюджета запроса, а не из-за самого апстрима."""
+        remaining = self.remaining()
+        # Таймер вызова срабатывает с небольшой погрешностью
+        return remaining is not None and remaining <= DEADLINE_RESERVE_MS / 1000 + 0.01
+
+    def timeout(self):
+        """Таймаут для вызова апстрима: оставшийся бюджет за вычетом запаса на best_option."""
+        remaining = self.remaining()
+        if remaining is None:
+            return httpx.USE_CLIENT_DEFAULT
+        return max(0.001, remaining - DEADLINE_RESERVE_MS / 1000)
+
+    def wait_timeout(self):
+        """Сколько можно ждать фоновые запросы (None — без ограничения)."""
+        if self.expires_at is None:
+            return None
+        return self.timeout()
+
+
+def deadline_exceeded_response():
+    return JSONResponse(content={"error": "Request deadline exceeded"}, status_code=504)
+
+
+def no_pharmacies_found_response():
+    logger.error("No pharmacies found with the provided SKU data")
+    return JSONResponse(content={"error": "No pharmacies found with the provided SKU data"}, status_code=500)
+
+
+def overloaded_response(retry_after):
+    return JSONResponse(content={"error": "Service is overloaded"}, status_code=503,
+                        headers={"Retry-After": str(retry_after)})
+
+
+@contextmanager
+def pipeline_stage(name):
+    """Замер времени (если замер включен для запроса) и памяти (если включен MEMORY_TRACKING) этапа пайплайна.
+
+    CPU — время процесса: при параллельных запросах в него попадает и работа соседних запросов.
+    """
+    timings = _stage_timings.get()
+    if timings is None and not memory_tracker.enabled:
+        yield
+        return
+    wall_started, cpu_started = time.perf_counter(), time.process_time()
+    try:
+        with memory_tracker.stage(name):
+            yield
+    finally:
+        if timings is not None:
+            stage = timings.setdefault(name, [0.0, 0.0])
+            stage[0] += time.perf_counter() - wall_started
+            stage[1] += time.process_time() - cpu_started
+
+
+async def record_upstream_request(request):
+    request.extensions["record_started"] = time.perf_counter()
+
+
+async def record_upstream_response(response):
+    record = _traffic_record.get()
+    if record is None:
+        return
+    await response.aread()
+    request = response.request
+    url = str(request.url.copy_with(query=None))
+    if URL_SEARCH and url == str(httpx.URL(URL_SEARCH)):
+        kind = "search"
+    elif URL_PRICE_BATCH and url == str(httpx.URL(URL_PRICE_BATCH)):
+        kind = "price_batch"
+    else:
+        kind = "price"
     try:
-        request_data = await request.json()
-        encoded_city = request_data.get("city")
-        sku_data = request_data.get("skus", [])
-        address = request_data.get("address", {})
+        body = response.json()
+    except ValueError:
+        body = response.text
+    record["upstream"].append({
+        "kind": kind,
+        "params": dict(request.url.params),
+        "payload": json.loads(request.content) if request.content else None,
+        "status": response.status_code,
+        "response": body,
+        "latency_ms": round((time.perf_counter() - request.extensions.get("record_started", time.perf_counter()))
+                            * 1000, 2),
+    })
 
-        user_lat = request_data.get("address", {}).get("lat")
-        user_lon = request_data.get("address", {}).get("lng")
 
-        if not encoded_city or not sku_data or user_lat is None or user_lon is None:
-            return JSONResponse(content={"error": "City, SKU data, and user coordinates are required"}, status_code=400)
+def write_traffic_record(record):
+    try:
+        with open(RECORD_TRAFFIC_PATH, "a", encoding="utf-8") as file:
+            file.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n")
+    except OSError as e:
+        logger.error(f"Failed to write traffic record: {e}")
+
+
+_http_client = None
+_http_client_loop = None
+
+
+def get_http_client():
+    """Общий для всех запросов HTTP-клиент к URL_SEARCH и URL_PRICE (переиспользует соединения)."""
+    global _http_client, _http_client_loop
+    loop = asyncio.get_running_loop()
+    if _http_client is None or _http_client.is_closed or _http_client_loop is not loop:
+        event_hooks = {"request": [record_upstream_request], "response": [record_upstream_response]} \
+            if RECORD_TRAFFIC_PATH else None
+        limits = httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+        )
+        if admission.enabled and ADMISSION_LATENCY_TARGET_MS > 0:
+            # Задержка каждого вызова апстрима подстраивает лимит одновременных запросов
+            transport = LatencyObservingTransport(httpx.AsyncHTTPTransport(limits=limits), admission.observe)
+            _http_client = httpx.AsyncClient(transport=transport, event_hooks=event_hooks)
+        else:
+            _http_client = httpx.AsyncClient(limits=limits, event_hooks=event_hooks)
+        _http_client_loop = loop
+    return _http_client
+
+
+@app.on_event("shutdown")
+async def close_http_client():
+    if _http_client is not None and not _http_client.is_closed:
+        await _http_client.aclose()
+
+
+class PriceQuoteCoalescer:
+    """Объединяет запросы цен к URL_PRICE от параллельных запросов пользователей.
+
+    Запросы собираются в течение короткого окна; одинаковые payload отправляются один раз,
+    а при заданном URL_PRICE_BATCH разные отправляются одним пакетным вызовом.
+    Ответ раздается всем ожидающим. Вызов апстрима ограничен самым поздним сроком среди
+    ожидающих его запросов (или не ограничен, если кто-то ждет без срока): запрос, у которого
+    бюджет почти исчерпан, не должен обрывать вызов для остальных. Свой срок каждый
+    ожидающий соблюдает сам.
+    """
 
-        if not isinstance(user_lat, (int, float)) or not isinstance(user_lon, (int, float)):
-            return JSONResponse(content={"error": "Invalid data type for user coordinates"}, status_code=400)
+    def __init__(self, window_ms, max_batch_size, batch_url=None):
+        self.window = window_ms / 1000
+        self.max_batch_size = max_batch_size
+        self.batch_url = batch_url
+        self.pending = {}  # key -> [payload, future, срок ожидания (loop.time()) или None]
+        self.flush_handle = None
+        self.tasks = set()  # отправляемые пакеты: без ссылки задачу может удалить сборщик мусора
+        self.requested = 0  # запросов цен от пайплайна
+        self.sent = 0  # вызовов апстрима
+
+    async def quote(self, payload, timeout=None):
+        """Возвращает ответ URL_PRICE для payload; ошибки httpx пробрасываются вызывающему."""
+        loop = asyncio.get_running_loop()
+        key = make_cache_key("price", payload)
+        expires_at = loop.time() + timeout if timeout is not None else None
+        self.requested += 1
+
+        if key in self.pending:
+            entry = self.pending[key]
+            future = entry[1]
+            entry[2] = self._latest((entry[2], expires_at))
+        else:
+            future = loop.create_future()
+            # Ошибку могут не забрать, если все ожидающие ушли по таймауту
+            future.add_done_callback(lambda f: f.cancelled() or f.exception())
+            self.pending[key] = [payload, future, expires_at]
+            if len(self.pending) >= self.max_batch_size:
+                self._flush()
+            elif self.flush_handle is None:
+                self.flush_handle = loop.call_later(self.window, self._flush)
 
-        for item in sku_data:
-            if not isinstance(item.get("sku"), str) or not isinstance(item.get("count_desired"), int):
-                return JSONResponse(content={"error": "Invalid SKU format or count type"}, status_code=400)
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout=timeout)
+        except asyncio.TimeoutError:
+            raise httpx.TimeoutException("Timed out waiting for coalesced URL_PRICE quote")
+
+    @staticmethod
+    def _latest(deadlines):
+        """Самый поздний срок; None, если хотя бы один ожидающий ждет без срока."""
+        deadlines = list(deadlines)
+        if any(expires_at is None for expires_at in deadlines):
+            return None
+        return max(deadlines)
+
+    @staticmethod
+    def _timeout(expires_at):
+        if expires_at is None:
+            return httpx.USE_CLIENT_DEFAULT
+        return max(0.001, expires_at - asyncio.get_running_loop().time())
+
+    def _flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        batch, self.pending = list(self.pending.values()), {}
+        if batch:
+            task = asyncio.get_running_loop().create_task(self._send(batch))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def _send(self, batch):
+        client = get_http_client()
+
+        if self.batch_url and len(batch) > 1:
+            self.sent += 1
+            expires_at = self._latest(entry_expires_at for _, _, entry_expires_at in batch)
+            try:
+                response = await client.post(self.batch_url, json=[payload for payload, _, _ in batch],
+                                             timeout=self._timeout(expires_at))
+                response.raise_for_status()
+                answers = response.json()
+                if not isinstance(answers, list) or len(answers) != len(batch):
+                    raise httpx.DecodingError("Batched URL_PRICE response does not match the request",
+                                              request=response.request)
+            except Exception as e:
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                return
+            for (_, future, _), answer in zip(batch, answers):
+                if future.done():
+                    continue
+                if isinstance(answer, dict):
+                    future.set_result(answer)
+                else:
+                    # Ошибка одного элемента пакета не затрагивает остальные
+                    future.set_exception(httpx.DecodingError("Batched URL_PRICE answer is not an object",
+                                                             request=response.request))
+            return
 
+        async def send_one(payload, future, expires_at):
+            self.sent += 1
+            try:
+                response = await client.post(URL_PRICE, json=payload, timeout=self._timeout(expires_at))
+                response.raise_for_status()
+                answer = response.json()
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+                return
+            if not future.done():
+                future.set_result(answer)
 
-        payload = [{"sku": item["sku"], "count_desired": item["count_desired"]} for item in sku_data]
+        await asyncio.gather(*(send_one(payload, future, expires_at) for payload, future, expires_at in batch))
 
-        # Поиск лекарств в аптеках
-        pharmacies = await find_medicines_in_pharmacies(encoded_city, payload)
-        # Проверка, если результат поиска пуст
-        if not pharmacies.get("result"):
-            logger.error("No pharmacies found with the provided SKU data")
-            return JSONResponse(content={"error": "No pharmacies found with the provided SKU data"}, status_code=500)
-        save_response_to_file(pharmacies, file_name='data1_found_all.json')
 
-        pharmacies_with_missing_items = await filter_pharmacies_with_missing_items(pharmacies, sku_data)
-        save_response_to_file(pharmacies_with_missing_items, file_name='data1_2_found_all__with_missing_items.json')
+_price_coalescer = None
+_price_coalescer_loop = None
 
-        # Поиск аптек с учетом наличия приоритетного товара
-        filtered_pharmacies = await filter_pharmacies_by_priority_items(pharmacies_with_missing_items, sku_data)
-        if isinstance(filtered_pharmacies, JSONResponse):
-            return filtered_pharmacies
-        save_response_to_file(filtered_pharmacies, file_name='data2_found_with_priority.json')
 
-        # Сортировка по наибольшему количеству доступных товаров
-        top_pharmacies = await sort_pharmacies_by_fulfillment(filtered_pharmacies)
-        save_response_to_file(top_pharmacies, file_name='data3_sorted_pharmacies.json')
+def get_price_coalescer():
+    global _price_coalescer, _price_coalescer_loop
+    loop = asyncio.get_running_loop()
+    if _price_coalescer is None or _price_coalescer_loop is not loop:
+        _price_coalescer = PriceQuoteCoalescer(PRICE_BATCH_WINDOW_MS, PRICE_BATCH_MAX_SIZE, URL_PRICE_BATCH)
+        _price_coalescer_loop = loop
+    return _price_coalescer
 
 
-        # Выбор ближайших и самых дешевых аптек
-        closest_pharmacies = await get_top_closest_pharmacies(top_pharmacies, user_lat, user_lon)
-        save_response_to_file(closest_pharmacies, file_name='data4_top_closest_pharmacies.json')
+async def request_delivery_quote(payload, deadline=None):
+    """Запрос к URL_PRICE (через объединение запросов, если оно включено)."""
+    if PRICE_BATCH_WINDOW_MS > 0:
+        return await get_price_coalescer().quote(payload, timeout=deadline.wait_timeout() if deadline else None)
+
+    timeout = deadline.timeout() if deadline else httpx.USE_CLIENT_DEFAULT
+    response = await get_http_client().post(URL_PRICE, json=payload, timeout=timeout)
+    response.raise_for_status()
+    return response.json()
+
+
+_stock_feed_task = None
+
+
+@app.on_event("startup")
+async def start_memory_tracking():
+    memory_tracker.start()
+
+
+@app.on_event("shutdown")
+async def stop_memory_tracking():
+    memory_tracker.stop()
+
+
+@app.on_event("startup")
+async def start_stock_index():
+    global _stock_feed_task
+    if not STOCK_INDEX_ENABLED:
+        return
+    stock_index.load_snapshot_dir(STOCK_INDEX_SNAPSHOT_DIR)
+    if STOCK_INDEX_FEED_PATH:
+        _stock_feed_task = asyncio.create_task(consume_feed(stock_index, FileTailFeed(STOCK_INDEX_FEED_PATH)))
+
+
+@app.on_event("shutdown")
+async def stop_stock_index():
+    if _stock_feed_task is not None:
+        _stock_feed_task.cancel()
+
+
+_cache_snapshot_task = None
+# Слот воркера для файлов снимков: (номер, открытый файл блокировки)
+_cache_snapshot_slot = None
+
+
+def snapshot_caches():
+    """Кэши, которые сохраняются в снимки: только кэши в памяти (sqlite и так на диске)."""
+    caches = {"upstream": upstream_cache, "response": response_cache, "negative": negative_cache}
+    return {name: cache for name, cache in caches.items() if isinstance(cache, MemoryCache)}
+
+
+def cache_snapshot_path(name):
+    # У каждого воркера свой файл: иначе воркеры перезаписывают снимки друг друга
+    return os.path.join(CACHE_SNAPSHOT_DIR, f"{name}_cache.{_cache_snapshot_slot[0]}.bin")
 
-        cheapest_pharmacies = await get_top_cheapest_pharmacies(top_pharmacies)
-        save_response_to_file(cheapest_pharmacies, file_name='data4_top_cheapest_pharmacies.json')
+
+def save_cache_snapshots():
+    for name, cache in snapshot_caches().items():
+        try:
+            written = cache.save_snapshot(cache_snapshot_path(name), max_entries=CACHE_SNAPSHOT_MAX_ENTRIES)
+            logger.info(f"Saved {written} entries of {name} cache snapshot")
+        except OSError as e:
+            logger.error(f"Failed to save {name} cache snapshot: {e}")
+
+
+async def save_cache_snapshots_periodically():
+    while True:
+        await asyncio.sleep(CACHE_SNAPSHOT_INTERVAL)
+        await asyncio.to_thread(save_cache_snapshots)
+
+
+@app.on_event("startup")
+async def restore_cache_snapshots():
+    global _cache_snapshot_task, _cache_snapshot_slot
+    if not CACHE_SNAPSHOT_DIR or not snapshot_caches():
+        return
+    os.makedirs(CACHE_SNAPSHOT_DIR, exist_ok=True)
+    try:
+        if _cache_snapshot_slot is None:
+            _cache_snapshot_slot = claim_snapshot_slot(CACHE_SNAPSHOT_DIR)
+    except OSError as e:
+        logger.error(f"Cache snapshots disabled: {e}")
+        return
+    for name, cache in snapshot_caches().items():
+        path = cache_snapshot_path(name)
+        if not os.path.exists(path):
+            continue
+        try:
+            logger.info(f"Attached {name} cache snapshot with {cache.attach_snapshot(path)} live entries")
+        except (OSError, ValueError) as e:
+            logger.error(f"Failed to load {name} cache snapshot {path}: {e}")
+    if CACHE_SNAPSHOT_INTERVAL > 0:
+        _cache_snapshot_task = asyncio.create_task(save_cache_snapshots_periodically())
+
+
+@app.on_event("shutdown")
+async def write_cache_snapshots():
+    if _cache_snapshot_task is not None:
+        _cache_snapshot_task.cancel()
+    if _cache_snapshot_slot is not None:
+        save_cache_snapshots()
+
+
+async def refresh_search_entry(cache_key, spec):
+    """Обновляет запись поиска для популярной пары город/корзина."""
+    encoded_city, payload = spec
+    pharmacies = await find_medicines_in_pharmacies(encoded_city, payload, refresh=True)
+    return not isinstance(pharmacies, JSONResponse)
+
+
+async def refresh_price_entry(cache_key, payload):
+    """Заново запрашивает цену доставки для популярной аптеки и ячейки адреса."""
+    delivery_data = await request_delivery_quote(payload)
+    if delivery_data.get("status") != "success":
+        return False
+    await set_upstream_cached(cache_key, delivery_data, PRICE_CACHE_TTL)
+    return True
+
+
+def create_cache_warmer(name, refresh, rate):
+    return CacheWarmer(name, refresh, capacity=CACHE_WARMER_TOP_K, min_hits=CACHE_WARMER_MIN_HITS,
+                       lead=CACHE_WARMER_LEAD, rate=rate / CACHE_WARMER_WORKERS, concurrency=CACHE_WARMER_CONCURRENCY,
+                       interval=CACHE_WARMER_INTERVAL, decay_interval=CACHE_WARMER_DECAY_INTERVAL)
+
+
+# Без кэша апстримов обновлять нечего
+search_warmer = None
+price_warmer = None
+if CACHE_WARMER_ENABLED and CACHE_BACKEND != "none":
+    if URL_SEARCH and CACHE_WARMER_SEARCH_RATE > 0:
+        search_warmer = create_cache_warmer("search", refresh_search_entry, CACHE_WARMER_SEARCH_RATE)
+    if URL_PRICE and CACHE_WARMER_PRICE_RATE > 0:
+        price_warmer = create_cache_warmer("price", refresh_price_entry, CACHE_WARMER_PRICE_RATE)
+elif CACHE_WARMER_ENABLED:
+    logger.warning("CACHE_WARMER_ENABLED requires CACHE_BACKEND, cache warmer disabled")
+cache_warmers = [warmer for warmer in (search_warmer, price_warmer) if warmer is not None]
+_cache_warmer_tasks = []
+
+
+@app.on_event("startup")
+async def start_cache_warmers():
+    for warmer in cache_warmers:
+        _cache_warmer_tasks.append(asyncio.create_task(warmer.run()))
+
+
+@app.on_event("shutdown")
+async def stop_cache_warmers():
+    for task in _cache_warmer_tasks:
+        task.cancel()
+    _cache_warmer_tasks.clear()
+
+
+_process_pool = None
+
+
+def get_process_pool():
+    """Пул процессов для тяжелой фильтрации (создается при первом использовании)."""
+    global _process_pool
+    if _process_pool is None:
+        # spawn: fork процесса с работающим event loop и потоками небезопасен
+        _process_pool = ProcessPoolExecutor(max_workers=PROCESS_POOL_WORKERS,
+                                            mp_context=multiprocessing.get_context("spawn"))
+    return _process_pool
+
+
+@app.on_event("shutdown")
+async def shutdown_process_pool():
+    if _process_pool is not None:
+        _process_pool.shutdown(wait=False, cancel_futures=True)
 
 
-        # Расчет вариантов доставки
-        delivery_options1 = await get_delivery_options(closest_pharmacies, user_lat, user_lon)
+class QuotePrefetcher:
+    """Спекулятивные запросы цен доставки.
+
+    Запросы к URL_PRICE стартуют в фоне, как только известны кандидаты, и идут,
+    пока пайплайн досчитывает остальные этапы. Каждая аптека запрашивается один раз.
+    """
+
+    def __init__(self, user_lat, user_lon, deadline):
+        self.user_lat = user_lat
+        self.user_lon = user_lon
+        self.deadline = deadline
+        self.tasks = {}  # code -> asyncio.Task
+        self.skipped = set()  # аптеки, отсеянные по прогнозу: цену не запрашиваем
+        self.part_tasks = {}  # части заказов из двух аптек: ключ части -> asyncio.Task
+
+    def skip(self, codes):
+        self.skipped.update(codes)
+        self.cancel(keep=set(self.tasks) - self.skipped, parts=False)
+
+    def prefetch_part(self, key, pharmacy):
+        """Запрос цены доставки для части заказа (аптека и только назначенные ей товары)."""
+        if key not in self.part_tasks:
+            self.part_tasks[key] = asyncio.create_task(
+                get_pharmacy_delivery_options(pharmacy, self.user_lat, self.user_lon, deadline=self.deadline)
+            )
+        return self.part_tasks[key]
+
+    def prefetch(self, pharmacies):
+        for pharmacy in pharmacies.get("list_pharmacies", []):
+            code = pharmacy.get("source", {}).get("code")
+            if code is not None and code not in self.tasks and code not in self.skipped:
+                self.tasks[code] = asyncio.create_task(
+                    get_pharmacy_delivery_options(pharmacy, self.user_lat, self.user_lon, deadline=self.deadline)
+                )
+
+    async def collect(self, pharmacies):
+        """То же, что get_delivery_options, но по уже запущенным запросам."""
+        if not pharmacies.get("list_pharmacies"):
+            return JSONResponse(content={"error": "No pharmacies available for delivery options"}, status_code=404)
+
+        self.prefetch(pharmacies)
+        results = []
+
+        for pharmacy in pharmacies["list_pharmacies"]:
+            code = pharmacy.get("source", {}).get("code")
+            if code is None or code in self.skipped:
+                continue
+
+            task = self.tasks[code]
+            if not task.done():
+                await asyncio.wait({task}, timeout=self.deadline.wait_timeout())
+            if not task.done():
+                logger.warning("Request deadline exceeded, dropping pending delivery quotes")
+                self.deadline.partial = True
+                break
+
+            pharmacy_options = task.result()
+            if isinstance(pharmacy_options, JSONResponse):
+                return pharmacy_options
+            if pharmacy_options is None:
+                break  # Бюджет исчерпан
+            results.extend(pharmacy_options)
+
+        return results
+
+    async def collect_split_orders(self, split_orders):
+        """Варианты доставки заказов из двух аптек в формате best_option.
+
+        Заказ, для части которого цену получить не удалось, пропускается: это дополнительные варианты.
+        """
+        results = []
+        for split_order in split_orders:
+            tasks = [self.part_tasks[part["key"]] for part in split_order["parts"]]
+            pending = {task for task in tasks if not task.done()}
+            if pending:
+                await asyncio.wait(pending, timeout=self.deadline.wait_timeout())
+            if not all(task.done() for task in tasks):
+                logger.warning("Request deadline exceeded, dropping pending split order quotes")
+                self.deadline.partial = True
+                break
+
+            parts_options = [task.result() for task in tasks]
+            if any(not isinstance(options, list) or not options for options in parts_options):
+                logger.warning("No delivery options for a split order part, skipping split order")
+                continue
+            results.extend(build_split_order_options(parts_options))
+        return results
+
+    def cancel(self, keep=(), parts=True):
+        """Отменяет запросы для кандидатов, выпавших из отбора (по умолчанию — все незавершенные)."""
+        for code, task in self.tasks.items():
+            if code not in keep and not task.done():
+                task.cancel()
+        if parts:
+            for task in self.part_tasks.values():
+                if not task.done():
+                    task.cancel()
+
+
+@app.post("/partial_availability")
+async def main_process(request: Request):
+
+    try:
+        if rss_budget.exceeded():
+            logger.warning("Worker RSS budget exceeded, shedding request")
+            return overloaded_response(RSS_BUDGET_RETRY_AFTER)
+
+        deadline = Deadline.from_request(request)
+        # Тело разбирается и проверяется по схеме запроса за один проход
+        request_data = parse_delivery_request(await request.body())
+        if isinstance(request_data, JSONResponse):
+            return request_data
+
+        recording = RECORD_TRAFFIC_PATH and random.random() < RECORD_TRAFFIC_SAMPLE_RATE
+        cache_key = response_cache_key(request_data) \
+            if RESPONSE_CACHE_BACKEND != "none" and not recording else None
+        if cache_key is not None:
+            cached = await get_cached_response(cache_key, request_data, request.headers.get("accept-encoding"))
+            if cached is not None:
+                return cached
+
+        # Ответы из кэша отдаются без очереди; слот нужен только для расчета
+        if not await admission.acquire(timeout=deadline.wait_timeout()):
+            logger.warning("Request rejected by admission control")
+            return overloaded_response(ADMISSION_RETRY_AFTER)
+        try:
+            if recording:
+                return encode_best_options(await compute_and_record(request_data, deadline))
+            if cache_key is None:
+                return encode_best_options(await compute_partial_availability(request_data, deadline))
+            result, variants = await compute_and_cache_response(cache_key, request_data, deadline)
+            if variants is None:
+                return encode_best_options(result)
+            encoding = choose_encoding(request.headers.get("accept-encoding"), variants)
+            return encoded_response(variants[encoding], encoding)
+        finally:
+            admission.release()
+
+    except Exception as e:
+        logger.error(f"Unexpected error: {e}")
+        return JSONResponse(content={"error": "An unexpected error occurred"}, status_code=500)
+
+
+async def compute_partial_availability(request_data, deadline):
+    """Полный пайплайн: поиск, фильтрация, цены доставки и выбор лучшего варианта."""
+    candidates = await prepare_delivery_candidates(request_data, deadline)
+    if isinstance(candidates, JSONResponse):
+        return candidates
+    closest_pharmacies = candidates["closest_pharmacies"]
+    cheapest_pharmacies = candidates["cheapest_pharmacies"]
+    quotes = candidates["quotes"]
+
+    try:
+        # Если бюджет истек еще до запросов цен, ответить нечем
+        if deadline.expired():
+            logger.error("Request deadline exceeded before delivery quotes")
+            return deadline_exceeded_response()
+
+        # Расчет вариантов доставки (запросы уже запущены в prepare_delivery_candidates)
+        with pipeline_stage("quotes"):
+            delivery_options1 = await quotes.collect(closest_pharmacies)
         if isinstance(delivery_options1, JSONResponse):
             return delivery_options1  # Возвращаем JSONResponse сразу, если это ошибка
         save_response_to_file(delivery_options1, file_name='data5_delivery_options_closest.json')
 
-        delivery_options2 = await get_delivery_options(cheapest_pharmacies, user_lat, user_lon)
+        with pipeline_stage("quotes"):
+            delivery_options2 = await quotes.collect(cheapest_pharmacies)
         if isinstance(delivery_options2, JSONResponse):
             return delivery_options1  # Возвращаем JSONResponse сразу, если это ошибка
         save_response_to_file(delivery_options2, file_name='data5_delivery_options_cheapest.json')
 
-        all_delivery_options = delivery_options1 + delivery_options2
-        save_response_to_file(all_delivery_options, file_name='data5_all_delivery_options.json')
+        split_order_options = []
+        if candidates["split_orders"]:
+            with pipeline_stage("quotes"):
+                split_order_options = await quotes.collect_split_orders(candidates["split_orders"])
+            save_response_to_file(split_order_options, file_name='data5_delivery_options_split.json')
+    finally:
+        quotes.cancel()
+
+    all_delivery_options = delivery_options1 + delivery_options2 + split_order_options
+    save_response_to_file(all_delivery_options, file_name='data5_all_delivery_options.json')
+
+    if not all_delivery_options and deadline.partial:
+        return deadline_exceeded_response()
+
+    # При истекшем бюджете выбираем лучший вариант из уже полученных цен
+    with pipeline_stage("best_option"):
+        result = await pipeline_stages.run("best_option", all_delivery_options)
+    if isinstance(result, dict):
+        result["partial"] = deadline.partial
+    save_response_to_file(result, file_name='data6_final_result.json')
+    return result
+
+
+async def compute_and_record(request_data, deadline):
+    """Пайплайн с записью запроса, обмена с апстримами и итога (кэш ответов не используется)."""
+    record = {"ts": time.time(), "request": request_data, "deadline_ms": deadline.budget_ms, "upstream": []}
+    token = _traffic_record.set(record)
+    started = time.perf_counter()
+    try:
+        result = await compute_partial_availability(request_data, deadline)
+    finally:
+        _traffic_record.reset(token)
+    record["latency_ms"] = round((time.perf_counter() - started) * 1000, 2)
+    record["status"] = result.status_code if isinstance(result, JSONResponse) else 200
+    write_traffic_record(record)
+    return result
 
-        result = await best_option(all_delivery_options)
-        save_response_to_file(result, file_name='data6_final_result.json')
-        return result
 
-    except json.JSONDecodeError:
-        return JSONResponse(content={"error": "Invalid JSON format"}, status_code=400)
+def response_cache_key(request_data):
+    """Ключ кэша ответа или None, если запрос некорректен (его разберет пайплайн)."""
+    try:
+        encoded_city = request_data["city"]
+        lat = request_data["address"]["lat"]
+        lon = request_data["address"]["lng"]
+        # Порядок товаров важен: первый товар приоритетный
+        basket = [(item["sku"], item["count_desired"]) for item in request_data["skus"]]
+        cell = (math.floor(lat / RESPONSE_CACHE_CELL_DEG), math.floor(lon / RESPONSE_CACHE_CELL_DEG))
+    except (KeyError, TypeError, AttributeError):
+        return None
+    time_bucket = int(time.time() // RESPONSE_CACHE_TIME_BUCKET)
+    return make_cache_key(f"response:{encoded_city}", basket, cell, time_bucket)
+
+
+def track_cache_dependency(cache_key, version):
+    dependencies = _cache_dependencies.get()
+    if dependencies is not None:
+        dependencies.append((cache_key, version))
+
+
+async def get_upstream_cached(cache_key):
+    value = await upstream_cache.aget(cache_key)
+    if value is not None and _cache_dependencies.get() is not None:
+        track_cache_dependency(cache_key, await upstream_cache.aget(f"ver:{cache_key}"))
+    return value
+
+
+async def set_upstream_cached(cache_key, value, ttl):
+    # Версия записи позволяет понять, что кэшированный ответ собран из устаревших данных.
+    # Версия — хеш содержимого: запись теми же данными (например, фоновым обновлением)
+    # не делает недействительными ответы, собранные из нее
+    raw = encode_value(value)
+    version = hashlib.sha1(raw).hexdigest() if RESPONSE_CACHE_BACKEND != "none" else None
+    await upstream_cache.aset_raw(cache_key, raw, ttl)
+    if version is not None:
+        await upstream_cache.aset(f"ver:{cache_key}", version, ttl)
+    track_cache_dependency(cache_key, version)
+    for warmer in cache_warmers:
+        warmer.stored(cache_key, ttl)
+
+
+_refreshing_responses = set()
+# Ссылки на фоновые пересчеты: задачу без ссылки event loop может удалить посреди работы
+_response_refresh_tasks = set()
+
+
+async def get_cached_response(cache_key, request_data, accept_encoding=None):
+    """Ответ из кэша в подходящей кодировке; устаревший отдается, а в фоне запускается пересчет."""
+    entry = await response_cache.aget(cache_key)
+    if entry is None or "encodings" not in entry:
+        return None
+
+    # Если исходные данные поиска или цен обновились, ответ недействителен
+    for dependency_key, version in entry["dependencies"]:
+        current_version = await upstream_cache.aget(f"ver:{dependency_key}")
+        if current_version is not None and current_version != version:
+            await delete_cached_response(cache_key, entry["encodings"])
+            return None
+
+    encoding = choose_encoding(accept_encoding, entry["encodings"])
+    body = await response_cache.aget_raw(f"{cache_key}:{encoding}")
+    if body is None:
+        # Вариант вытеснен раньше описания ответа
+        await delete_cached_response(cache_key, entry["encodings"])
+        return None
+
+    if time.time() - entry["created_at"] > RESPONSE_CACHE_TTL and cache_key not in _refreshing_responses:
+        _refreshing_responses.add(cache_key)
+        task = asyncio.create_task(refresh_cached_response(cache_key, request_data))
+        _response_refresh_tasks.add(task)
+        task.add_done_callback(_response_refresh_tasks.discard)
+    return encoded_response(body, encoding)
+
+
+async def store_cached_response(cache_key, result, dependencies):
+    """Кодирует ответ один раз, сжимает и записывает все варианты; возвращает {кодировка: байты}."""
+    variants = compress_variants(best_options_json(result), response_encodings, min_size=RESPONSE_COMPRESSION_MIN_BYTES,
+                                 gzip_level=RESPONSE_GZIP_LEVEL, brotli_quality=RESPONSE_BROTLI_QUALITY)
+    ttl = RESPONSE_CACHE_TTL + RESPONSE_CACHE_STALE_TTL
+    # Сначала варианты, затем описание: описание не ссылается на еще не записанные байты
+    for encoding, body in variants.items():
+        await response_cache.aset_raw(f"{cache_key}:{encoding}", body, ttl)
+    await response_cache.aset(cache_key, {
+        "created_at": time.time(),
+        "dependencies": dependencies,
+        "encodings": list(variants),
+    }, ttl)
+    return variants
+
+
+async def delete_cached_response(cache_key, encodings):
+    await response_cache.adelete(cache_key)
+    for encoding in encodings:
+        await response_cache.adelete(f"{cache_key}:{encoding}")
+
+
+async def compute_and_cache_response(cache_key, request_data, deadline):
+    """Расчет с записью в кэш. Возвращает результат и варианты байтов, если ответ закэширован (иначе None)."""
+    dependencies = []
+    token = _cache_dependencies.set(dependencies)
+    try:
+        result = await compute_partial_availability(request_data, deadline)
+    finally:
+        _cache_dependencies.reset(token)
+
+    # Ошибки и неполные ответы не кэшируем
+    if isinstance(result, dict) and not result.get("partial"):
+        return result, await store_cached_response(cache_key, result, dependencies)
+    return result, None
+
+
+async def refresh_cached_response(cache_key, request_data):
+    try:
+        await compute_and_cache_response(cache_key, request_data, Deadline(REQUEST_DEADLINE_MS))
+    except Exception as e:
+        logger.error(f"Background response refresh failed: {e}")
+    finally:
+        _refreshing_responses.discard(cache_key)
+
+
+@app.post("/partial_availability/stream")
+async def main_process_stream(request: Request):
+    """Потоковый вариант /partial_availability (Server-Sent Events).
+
+    События: provisional — промежуточный лучший вариант после каждой полученной цены,
+    final — итог в формате best_option, error — ошибка после начала потока.
+    """
+    try:
+        if rss_budget.exceeded():
+            logger.warning("Worker RSS budget exceeded, shedding request")
+            return overloaded_response(RSS_BUDGET_RETRY_AFTER)
+
+        deadline = Deadline.from_request(request)
+        if not await admission.acquire(timeout=deadline.wait_timeout()):
+            logger.warning("Request rejected by admission control")
+            return overloaded_response(ADMISSION_RETRY_AFTER)
     except Exception as e:
         logger.error(f"Unexpected error: {e}")
         return JSONResponse(content={"error": "An unexpected error occurred"}, status_code=500)
 
+    # Слот занят до конца потока и освобождается после отправки ответа
+    streaming = False
+    try:
+        try:
+            request_data = parse_delivery_request(await request.body())
+            if isinstance(request_data, JSONResponse):
+                return request_data
+            candidates = await prepare_delivery_candidates(request_data, deadline, with_split_orders=False)
+            if isinstance(candidates, JSONResponse):
+                return candidates
+        except Exception as e:
+            logger.error(f"Unexpected error: {e}")
+            return JSONResponse(content={"error": "An unexpected error occurred"}, status_code=500)
+
+        if not candidates["quotes"].tasks:
+            return JSONResponse(content={"error": "No pharmacies available for delivery options"}, status_code=404)
+
+        # Слот освобождает сам генератор (в том числе при ошибке внутри потока, когда starlette
+        # не запускает background), а background — если генератор так и не был запущен
+        streaming = True
+        release = admission.releaser()
+        return StreamingResponse(stream_delivery_options(candidates, deadline, on_close=release),
+                                 media_type="text/event-stream",
+                                 headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+                                 background=BackgroundTask(release))
+    finally:
+        if not streaming:
+            admission.release()
+
+
+def format_sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+async def stream_delivery_options(candidates, deadline, on_close=None):
+    """Отдает промежуточный лучший вариант по мере поступления цен от параллельных запросов.
+
+    on_close вызывается при завершении генератора, в том числе по ошибке или отключению клиента.
+    """
+    quotes = candidates["quotes"]
+    tasks = {task: code for code, task in quotes.tasks.items()}
+    # Порядок как в обычной ручке: сначала ближайшие, затем самые дешевые
+    pharmacies_by_code = quotes.tasks
+    options_by_code = {}
 
+    try:
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, timeout=deadline.wait_timeout(),
+                                               return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                logger.warning("Request deadline exceeded, cancelling remaining delivery quotes")
+                deadline.partial = True
+                break
 
-async def find_medicines_in_pharmacies(encoded_city, payload):
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.post(URL_SEARCH, params={"city": encoded_city}, json=payload)
-            response.raise_for_status()
-            data = response.json()
-            # Проверка на наличие ожидаемых ключей в ответе
-            if not isinstance(data, dict) or "result" not in data:
-                return JSONResponse(content={"error": "Invalid response format from search API"}, status_code=502)
-            return data
-        except httpx.RequestError as e:
-            logger.error(f"Request error while accessing URL_SEARCH: {e}")
-            return JSONResponse(content={"error": "Request error while accessing search API"}, status_code=503)
-        except httpx.HTTPStatusError as e:
-            logger.error(f"HTTP error while accessing URL_SEARCH: {e}")
-            return JSONResponse(content={"error": f"HTTP error {e.response.status_code}"},
-                                status_code=e.response.status_code)
+            for task in done:
+                try:
+                    options = task.result()
+                except Exception as e:
+                    logger.error(f"Unexpected error while fetching delivery quote: {e}")
+                    # Ошибки остальных завершившихся запросов забираем, чтобы они не попали в лог asyncio
+                    for other in done:
+                        other.cancelled() or other.exception()
+                    yield format_sse_event("error", {"error": "An unexpected error occurred"})
+                    return
+                if isinstance(options, JSONResponse):
+                    yield format_sse_event("error", json.loads(options.body))
+                    return
+                options_by_code[tasks[task]] = options or []
+
+            arrived = [option for code in pharmacies_by_code for option in options_by_code.get(code, [])]
+            if pending and arrived:
+                provisional = await pipeline_stages.run("best_option", arrived)
+                if isinstance(provisional, dict):
+                    provisional["partial"] = True
+                    yield format_sse_event("provisional", provisional)
+
+        all_delivery_options = [option for code in pharmacies_by_code for option in options_by_code.get(code, [])]
+        if not all_delivery_options:
+            yield format_sse_event("error", {"error": "Request deadline exceeded" if deadline.partial
+                                             else "No delivery options found"})
+            return
+
+        result = await pipeline_stages.run("best_option", all_delivery_options)
+        if isinstance(result, JSONResponse):
+            yield format_sse_event("error", json.loads(result.body))
+            return
+        result["partial"] = deadline.partial
+        yield format_sse_event("final", result)
+    finally:
+        quotes.cancel()
+        if on_close is not None:
+            on_close()
+
+
+async def prepare_delivery_candidates(request_data, deadline, with_split_orders=True):
+    """Ищет и фильтрует аптеки, выбирает кандидатов для расчета доставки.
+
+    request_data — запрос, уже проверенный parse_delivery_request (в skus только sku и count_desired).
+    Возвращает JSONResponse с ошибкой либо словарь с ближайшими и самыми дешевыми аптеками
+    (и заказами из двух аптек, если with_split_orders).
+    """
+    encoded_city = request_data["city"]
+    sku_data = payload = request_data["skus"]
+    user_lat = request_data["address"]["lat"]
+    user_lon = request_data["address"]["lng"]
+
+    # Корзины, для которых недавно не нашлось ни одной аптеки, не ищем повторно
+    negative_key = make_cache_key("negative", encoded_city, sorted(payload, key=lambda item: item["sku"])) \
+        if NEGATIVE_CACHE_BACKEND != "none" else None
+    if negative_key is not None and await negative_cache.aget(negative_key) is not None:
+        logger.info(f"Negative cache hit for city {encoded_city}")
+        return no_pharmacies_found_response()
+
+    # Поиск лекарств в аптеках
+    with pipeline_stage("search"):
+        pharmacies = await find_medicines_in_pharmacies(encoded_city, payload, deadline=deadline)
+    if isinstance(pharmacies, JSONResponse):
+        return deadline_exceeded_response() if deadline.expired() else pharmacies
+    # Проверка, если результат поиска пуст
+    if not pharmacies.get("result"):
+        if negative_key is not None:
+            await negative_cache.aset(negative_key, True, NEGATIVE_CACHE_TTL)
+        return no_pharmacies_found_response()
+    save_response_to_file(pharmacies, file_name='data1_found_all.json')
+
+    # Отсев аптек, из которых доставка невозможна, до тяжелой фильтрации по SKU и аналогам
+    with pipeline_stage("radius_filter"):
+        pharmacies = await pipeline_stages.run("radius_filter", pharmacies, user_lat, user_lon)
+
+    # Заказы из двух аптек ищутся по полному ответу поиска, до фильтров, которые оставляют
+    # только аптеки с наибольшей частью корзины
+    split_orders = []
+    if SPLIT_ORDER_ENABLED and with_split_orders and len(payload) > 1:
+        with pipeline_stage("split_order"):
+            split_orders = find_split_orders(pharmacies.get("result", []), payload, user_lat, user_lon)
+
+    # Большие ответы поиска фильтруем в отдельном процессе, маленькие — на месте
+    if PROCESS_POOL_THRESHOLD and len(pharmacies.get("result", [])) >= PROCESS_POOL_THRESHOLD:
+        with pipeline_stage("filter_pool"):
+            top_pharmacies = await run_filter_stages_in_pool(pharmacies, payload, deadline)
+    else:
+        top_pharmacies = await run_filter_stages(pharmacies, sku_data)
+    if isinstance(top_pharmacies, JSONResponse):
+        return top_pharmacies
+
+
+    # Выбор ближайших и самых дешевых аптек
+    with pipeline_stage("closest"):
+        closest_pharmacies = await pipeline_stages.run("closest", top_pharmacies, user_lat, user_lon)
+
+    # Цены для ближайших аптек запрашиваем сразу, не дожидаясь ранжирования по стоимости.
+    # С оценщиком сначала отсеиваем кандидатов по прогнозу, чтобы не тратить запросы впустую
+    quotes = QuotePrefetcher(user_lat, user_lon, deadline)
+    if not ESTIMATOR_ENABLED:
+        quotes.prefetch(closest_pharmacies)
+        await asyncio.sleep(0)  # даем фоновым запросам стартовать
+
+    try:
+        save_response_to_file(closest_pharmacies, file_name='data4_top_closest_pharmacies.json')
+
+        with pipeline_stage("cheapest"):
+            cheapest_pharmacies = await pipeline_stages.run("cheapest", top_pharmacies)
+        if ESTIMATOR_ENABLED:
+            quotes.skip(prune_candidates_by_estimate(closest_pharmacies, cheapest_pharmacies, user_lat, user_lon))
+            quotes.prefetch(closest_pharmacies)
+        quotes.prefetch(cheapest_pharmacies)
+        for split_order in split_orders:
+            for part in split_order["parts"]:
+                quotes.prefetch_part(part["key"], part["pharmacy"])
+        save_response_to_file(cheapest_pharmacies, file_name='data4_top_cheapest_pharmacies.json')
+    except BaseException:
+        quotes.cancel()
+        raise
+
+    return {
+        "closest_pharmacies": closest_pharmacies,
+        "cheapest_pharmacies": cheapest_pharmacies,
+        "user_lat": user_lat,
+        "user_lon": user_lon,
+        "quotes": quotes,
+        "split_orders": split_orders,
+    }
+
+
+
+def find_split_orders(pharmacies_list, payload, user_lat, user_lon):
+    """Самые дешевые заказы из двух аптек, покрывающие всю корзину.
+
+    Каждая часть — аптека только с назначенными ей товарами (товар или аналог), в формате,
+    который принимает get_pharmacy_delivery_options.
+    """
+    def expected_delivery_fee(pharmacy):
+        source = pharmacy.get("source", {})
+        if ESTIMATOR_ENABLED and source.get("lat") is not None and source.get("lon") is not None:
+            estimate = delivery_estimator.predict(
+                source.get("code"),
+                great_circle_distance_km(user_lat, user_lon, source["lat"], source["lon"]),
+                current_almaty_hour(),
+            )
+            if estimate is not None:
+                return estimate[0]
+        return SPLIT_ORDER_DELIVERY_FEE
+
+    solutions = split_order_solver.solve(pharmacies_list, payload, delivery_fee=expected_delivery_fee)
+
+    split_orders = []
+    for solution in solutions:
+        if len(solution["parts"]) != 2:
+            continue  # заказы из одной аптеки и так рассматривает основной пайплайн
+        parts = []
+        for part in solution["parts"]:
+            source = part["pharmacy"].get("source", {})
+            products = [
+                dict(product, quantity_desired=payload[position]["count_desired"])
+                for position, product in zip(part["positions"], part["products"])
+            ]
+            parts.append({
+                "key": f"{source.get('code')}:{','.join(product['sku'] for product in products)}",
+                "pharmacy": {"source": source, "products": products, "total_sum": part["goods"]},
+            })
+        split_orders.append({"cost": solution["cost"], "parts": parts})
+
+    logger.info(f"Found {len(split_orders)} split orders from two pharmacies")
+    return split_orders
+
+
+def build_split_order_options(parts_options):
+    """Объединяет варианты доставки частей заказа: самый дешевый и самый быстрый для каждой части.
+
+    Для best_option заказ выглядит как одна аптека: код и название через «+», самое раннее закрытие
+    и самое позднее открытие частей. Цены доставки складываются, время — максимальное из частей.
+    """
+    options = []
+    for pick in (lambda option: option["delivery_option"]["price"], lambda option: option["delivery_option"]["eta"]):
+        chosen = [min(part_options, key=pick) for part_options in parts_options]
+        pharmacies = [option["pharmacy"] for option in chosen]
+        sources = [pharmacy.get("source", {}) for pharmacy in pharmacies]
+
+        source = {
+            "code": "+".join(str(part_source.get("code")) for part_source in sources),
+            "name": " + ".join(str(part_source.get("name", "")) for part_source in sources),
+        }
+        scheduled = [part_source for part_source in sources if part_source.get("opening_hours") != "Круглосуточно"]
+        if scheduled:
+            closes = [part_source["closes_at"] for part_source in scheduled if part_source.get("closes_at")]
+            opens = [part_source["opens_at"] for part_source in scheduled if part_source.get("opens_at")]
+            source["closes_at"] = min(closes) if closes else None
+            source["opens_at"] = max(opens) if opens else None
+            source["opening_hours"] = scheduled[0].get("opening_hours", "")
+        else:
+            source["opening_hours"] = "Круглосуточно"
+
+        delivery_price = sum(option["delivery_option"]["price"] for option in chosen)
+        total_sum = sum(pharmacy.get("total_sum", 0) for pharmacy in pharmacies)
+        option = {
+            "pharmacy": {
+                "source": source,
+                "products": [product for pharmacy in pharmacies for product in pharmacy.get("products", [])],
+                "total_sum": total_sum,
+            },
+            "total_price": total_sum + delivery_price,
+            "delivery_option": {
+                "price": delivery_price,
+                "eta": max(option["delivery_option"]["eta"] for option in chosen),
+            },
+            "parts": [{"pharmacy": option["pharmacy"], "delivery_option": option["delivery_option"]}
+                      for option in chosen],
+        }
+        if option not in options:
+            options.append(option)
+    return options
+
+
+async def run_filter_stages(pharmacies, sku_data):
+    """Этапы фильтрации: аптеки с неполной корзиной, приоритетные товары, сортировка по наполненности."""
+    with pipeline_stage("missing_items_filter"):
+        pharmacies_with_missing_items = await pipeline_stages.run("missing_items_filter", pharmacies, sku_data)
+    save_response_to_file(pharmacies_with_missing_items, file_name='data1_2_found_all__with_missing_items.json')
+
+    # Поиск аптек с учетом наличия приоритетного товара
+    with pipeline_stage("priority_filter"):
+        filtered_pharmacies = await pipeline_stages.run("priority_filter", pharmacies_with_missing_items, sku_data)
+    if isinstance(filtered_pharmacies, JSONResponse):
+        return filtered_pharmacies
+    save_response_to_file(filtered_pharmacies, file_name='data2_found_with_priority.json')
+
+    # Сортировка по наибольшему количеству доступных товаров
+    with pipeline_stage("fulfillment_sort"):
+        top_pharmacies = await pipeline_stages.run("fulfillment_sort", filtered_pharmacies)
+    save_response_to_file(top_pharmacies, file_name='data3_sorted_pharmacies.json')
+    return top_pharmacies
+
+
+async def run_filter_stages_in_pool(pharmacies, sku_data, deadline):
+    """Этапы фильтрации в пуле процессов: туда уходят только SKU, остатки и цены, обратно — индексы."""
+    pharmacies_list = pharmacies.get("result", [])
+    if not isinstance(pharmacies_list, list):
+        logger.error("Invalid pharmacies data format.")
+        return JSONResponse(content={"error": "Invalid pharmacies data format"}, status_code=502)
+
+    loop = asyncio.get_running_loop()
+    future = loop.run_in_executor(get_process_pool(), plan_filter_stages,
+                                  compact_search_result(pharmacies_list), compact_basket(sku_data))
+    try:
+        plan = await asyncio.wait_for(future, timeout=deadline.wait_timeout())
+    except asyncio.TimeoutError:
+        logger.error("Request deadline exceeded while filtering pharmacies in process pool")
+        return deadline_exceeded_response()
+    return apply_filter_plan(pharmacies_list, sku_data, plan)
+
+
+async def find_medicines_in_pharmacies(encoded_city, payload, deadline=None, refresh=False):
+    """Поиск аптек с товарами корзины; refresh=True — запрос к URL_SEARCH в обход индекса и кэша."""
+    # Индекс остатков отвечает без сетевого запроса, пока он актуален
+    if STOCK_INDEX_ENABLED and not refresh:
+        indexed = stock_index.search(encoded_city, payload)
+        if indexed is not None:
+            return indexed
+
+    cache_key = make_cache_key(f"search:{encoded_city}", payload)
+    if not refresh:
+        if search_warmer is not None:
+            search_warmer.record(cache_key, cache_key, (encoded_city, payload))
+        cached = await get_upstream_cached(cache_key)
+        if cached is not None:
+            return cached
+
+    timeout = deadline.timeout() if deadline else httpx.USE_CLIENT_DEFAULT
+    client = get_http_client()
+    try:
+        response = await client.post(URL_SEARCH, params={"city": encoded_city}, json=payload, timeout=timeout)
+        response.raise_for_status()
+        data = response.json()
+        # Проверка на наличие ожидаемых ключей в ответе
+        if not isinstance(data, dict) or "result" not in data:
+            return JSONResponse(content={"error": "Invalid response format from search API"}, status_code=502)
+        await set_upstream_cached(cache_key, data, SEARCH_CACHE_TTL)
+        return data
+    except httpx.RequestError as e:
+        logger.error(f"Request error while accessing URL_SEARCH: {e}")
+        return JSONResponse(content={"error": "Request error while accessing search API"}, status_code=503)
+    except httpx.HTTPStatusError as e:
+        logger.error(f"HTTP error while accessing URL_SEARCH: {e}")
+        return JSONResponse(content={"error": f"HTTP error {e.response.status_code}"},
+                            status_code=e.response.status_code)
 
 
 # QUANTITY_ADJUSTMENT = 1  # Количество продуктов, которое будет добавлено к каждому продукту в списке продуктов аптеки
@@ -227,6 +1535,52 @@ async def find_medicines_in_pharmacies(encoded_city, payload):
 
 
 
+# Предварительный отсев аптек по радиусу доставки
+@pipeline_stages.engine("radius_filter")
+async def filter_pharmacies_by_radius(pharmacies, user_lat, user_lon):
+    """Оставляет аптеки в радиусе DELIVERY_RADIUS_KM от пользователя.
+
+    Сначала дешевая проверка по ограничивающему прямоугольнику, затем точное расстояние.
+    Если аптек в радиусе слишком мало, радиус удваивается до DELIVERY_RADIUS_MAX_KM.
+    Аптеки без координат не отсеиваются.
+    """
+    if DELIVERY_RADIUS_KM <= 0:
+        return pharmacies
+
+    all_pharmacies = pharmacies.get("result", [])
+    radius = DELIVERY_RADIUS_KM
+
+    while True:
+        lat_delta = math.degrees(radius / EARTH_RADIUS_KM)
+        lon_delta = lat_delta / max(math.cos(math.radians(user_lat)), 1e-6)
+
+        pharmacies_in_radius = []
+        for pharmacy in all_pharmacies:
+            source = pharmacy.get("source", {})
+            pharmacy_lat = source.get("lat")
+            pharmacy_lon = source.get("lon")
+
+            if pharmacy_lat is None or pharmacy_lon is None:
+                pharmacies_in_radius.append(pharmacy)
+                continue
+
+            if abs(pharmacy_lat - user_lat) > lat_delta or abs(pharmacy_lon - user_lon) > lon_delta:
+                continue
+
+            if great_circle_distance_km(user_lat, user_lon, pharmacy_lat, pharmacy_lon) <= radius:
+                pharmacies_in_radius.append(pharmacy)
+
+        if len(pharmacies_in_radius) >= MIN_PHARMACIES_IN_RADIUS or radius >= DELIVERY_RADIUS_MAX_KM:
+            break
+
+        radius = min(radius * 2, DELIVERY_RADIUS_MAX_KM)
+        logger.info(f"Only {len(pharmacies_in_radius)} pharmacies within radius, widening to {radius} km")
+
+    logger.info(f"Pharmacies within {radius} km: {len(pharmacies_in_radius)} of {len(all_pharmacies)}")
+    return {**pharmacies, "result": pharmacies_in_radius}
+
+
+@pipeline_stages.engine("missing_items_filter")
 async def filter_pharmacies_with_missing_items(pharmacies, priority_skus):
     pharmacies_with_missing_items = []
 
@@ -270,6 +1624,7 @@ async def filter_pharmacies_with_missing_items(pharmacies, priority_skus):
 
 
 # Фильтр аптек с учетом приоритетности товаров от первого в списке запроса и далее
+@pipeline_stages.engine("priority_filter")
 async def filter_pharmacies_by_priority_items(pharmacies, priority_skus):
     """
     Функция для последовательного фильтрации аптек по приоритетным товарам с учетом аналогов.
@@ -314,23 +1669,8 @@ async def filter_pharmacies_by_priority_items(pharmacies, priority_skus):
                         if cheapest_analog and cheapest_analog["quantity"] >= priority_sku["count_desired"]:
 
                             product["quantity_desired"] = priority_sku["count_desired"]
-                            product["analogs"] = [{
-                                "source_code": cheapest_analog["source_code"],
-                                "sku": cheapest_analog["sku"],
-                                "name": cheapest_analog["name"],
-                                "base_price": cheapest_analog["base_price"],
-                                "price_with_warehouse_discount": cheapest_analog["price_with_warehouse_discount"],
-                                "warehouse_discount": cheapest_analog["warehouse_discount"],
-                                "quantity": cheapest_analog["quantity"],
-                                "quantity_desired": priority_sku["count_desired"],
-                                "diff": product["diff"],
-                                "avg_price": product["avg_price"],
-                                "min_price": product["min_price"],
-                                "pp_packing": cheapest_analog.get("pp_packing", ""),
-                                "manufacturer_id": cheapest_analog.get("manufacturer_id", ""),
-                                "recipe_needed": cheapest_analog["recipe_needed"],
-                                "strong_recipe": cheapest_analog["strong_recipe"],
-                            }]
+                            product["analogs"] = [analog_replacement(product, cheapest_analog,
+                                                                     priority_sku["count_desired"])]
                             replacements_needed += 1
                             replaced_skus.append({
                                 "original_sku": product["sku"],
@@ -377,15 +1717,7 @@ async def filter_pharmacies_by_priority_items(pharmacies, priority_skus):
 
     # Финальный подсчет total_sum после всех раундов
     for pharmacy in filtered_pharmacies:
-        pharmacy["total_sum"] = sum(
-            # Если у продукта есть аналог с достаточным количеством, используем его для подсчета суммы
-            (product["analogs"][0]["base_price"] * product["analogs"][0]["quantity"]
-             if product.get("analogs") and product["analogs"][0]["quantity"] >= product["quantity_desired"]
-             # Иначе считаем только основной продукт, если его количество соответствует желаемому
-             else product["base_price"] * product["quantity"])
-            for product in pharmacy["products"]
-            if "quantity_desired" in product
-        )
+        pharmacy["total_sum"] = basket_total_sum(pharmacy)
 
     # Итоговое сохранение после всех кругов обработки
     save_response_to_file({"filtered_pharmacies": filtered_pharmacies}, file_name="final_filtered_pharmacies.json")
@@ -401,6 +1733,7 @@ async def filter_pharmacies_by_priority_items(pharmacies, priority_skus):
 
 
 # Сортировка аптек по количеству доступных товаров и выбор аптек с наибольшей корзиной
+@pipeline_stages.engine("fulfillment_sort")
 async def sort_pharmacies_by_fulfillment(pharmacies_with_partial_availability):
     # Группируем аптеки по количеству доступных товаров в корзине
     grouped_pharmacies = defaultdict(list)
@@ -422,9 +1755,20 @@ async def sort_pharmacies_by_fulfillment(pharmacies_with_partial_availability):
     return {"filtered_pharmacies": top_pharmacies}
 
 
+@pipeline_stages.engine("fulfillment_sort", "single_pass")
+async def sort_pharmacies_by_fulfillment_single_pass(pharmacies_with_partial_availability):
+    """То же, что sort_pharmacies_by_fulfillment, без группировки: максимум и отбор за два прохода."""
+    pharmacies = pharmacies_with_partial_availability.get("filtered_pharmacies", [])
+    max_products = max((len(pharmacy.get("products", [])) for pharmacy in pharmacies), default=0)
+    top_pharmacies = [pharmacy for pharmacy in pharmacies if len(pharmacy.get("products", [])) == max_products]
+    logger.info(f"Выбрано {len(top_pharmacies)} аптек с максимальной корзиной из {max_products} товаров")
+    return {"filtered_pharmacies": top_pharmacies}
+
+
 
 
 # Функция для выбора ближайших 2 аптек
+@pipeline_stages.engine("closest")
 async def get_top_closest_pharmacies(pharmacies, user_lat, user_lon):
     pharmacies_with_distance = []
     for pharmacy in pharmacies.get("filtered_pharmacies", []):
@@ -449,6 +1793,7 @@ async def get_top_closest_pharmacies(pharmacies, user_lat, user_lon):
 
 
 # Функция для выбора самых дешевых 3 аптек
+@pipeline_stages.engine("cheapest")
 async def get_top_cheapest_pharmacies(pharmacies):
     sorted_pharmacies = sorted(
         pharmacies.get("filtered_pharmacies", []),
@@ -463,6 +1808,15 @@ def haversine_distance(lat1, lon1, lat2, lon2):
     return math.sqrt((lat2 - lat1) ** 2 + (lon2 - lon1) ** 2)
 
 
+# Расстояние по поверхности Земли в километрах (для радиуса доставки)
+def great_circle_distance_km(lat1, lon1, lat2, lon2):
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(lon2 - lon1)
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
 def is_pharmacy_open_soon(closes_at, opens_at, opening_hours):
     """Проверяет, закроется ли аптека через 1 час или если аптека работает круглосуточно."""
     almaty_tz = pytz.timezone('Asia/Almaty')
@@ -524,8 +1878,83 @@ def is_pharmacy_closed(closes_at, opens_at, opening_hours):
     return not (opens_time <= current_time < closes_time)
 
 
-async def get_delivery_options(pharmacies, user_lat, user_lon):
-    """Функция возвращает все данные о доставке для аптек без принятия решений."""
+def current_almaty_hour():
+    return datetime.now(pytz.timezone('Asia/Almaty')).hour
+
+
+def prune_candidates_by_estimate(closest_pharmacies, cheapest_pharmacies, user_lat, user_lon):
+    """Возвращает коды аптек, цену доставки для которых можно не запрашивать.
+
+    Для каждого кандидата оценщик прогнозирует цену и время доставки. Запрашиваются только те,
+    кто по прогнозу может стать самым дешевым или самым быстрым (в пределах ESTIMATOR_MARGIN),
+    альтернативой для аптеки, которая скоро закрывается, или закрытой аптекой на 30% дешевле/быстрее.
+    Если хотя бы для одного кандидата прогноза нет, запрашиваются все. Аптеки без свежих
+    наблюдений (ESTIMATOR_MAX_AGE) не отсеиваются.
+    """
+    hour = current_almaty_hour()
+    candidates = {}
+    stale = set()
+    for pharmacy in closest_pharmacies.get("list_pharmacies", []) + cheapest_pharmacies.get("list_pharmacies", []):
+        source = pharmacy.get("source", {})
+        code = source.get("code")
+        if code is None or code in candidates:
+            continue
+        if source.get("lat") is None or source.get("lon") is None:
+            return set()
+
+        distance_km = great_circle_distance_km(user_lat, user_lon, source["lat"], source["lon"])
+        prediction = delivery_estimator.predict(code, distance_km, hour)
+        if prediction is None:
+            return set()
+        if not delivery_estimator.is_fresh(code, distance_km, ESTIMATOR_MAX_AGE):
+            stale.add(code)
+
+        closes_at, opens_at = source.get("closes_at"), source.get("opens_at")
+        opening_hours = source.get("opening_hours", "")
+        candidates[code] = {
+            "total": pharmacy.get("total_sum", 0) + prediction[0],
+            "eta": prediction[1],
+            "closed": is_pharmacy_closed(closes_at, opens_at, opening_hours),
+            "closes_soon": is_pharmacy_open_soon(closes_at, opens_at, opening_hours) if closes_at else False,
+        }
+
+    open_candidates = {code: c for code, c in candidates.items() if not c["closed"]}
+    if not open_candidates:
+        return set()
+
+    tolerance = 1 + ESTIMATOR_MARGIN
+    best_total = min(c["total"] for c in open_candidates.values())
+    best_eta = min(c["eta"] for c in open_candidates.values())
+
+    keep = set()
+    for code, c in open_candidates.items():
+        if c["total"] <= best_total * tolerance or c["eta"] <= best_eta * tolerance:
+            keep.add(code)
+
+    # Если победитель может скоро закрыться, нужна альтернатива, работающая дольше
+    if any(open_candidates[code]["closes_soon"] for code in keep):
+        long_working = {code: c for code, c in open_candidates.items() if not c["closes_soon"]}
+        if long_working:
+            keep.add(min(long_working, key=lambda code: long_working[code]["total"]))
+            keep.add(min(long_working, key=lambda code: long_working[code]["eta"]))
+
+    # Закрытая аптека попадает в ответ, только если она на 30% дешевле или быстрее открытой
+    for code, c in candidates.items():
+        if c["closed"] and (c["total"] <= best_total * 0.7 * tolerance or c["eta"] <= best_eta * 0.7 * tolerance):
+            keep.add(code)
+
+    pruned = set(candidates) - keep - stale
+    if pruned:
+        logger.info(f"Skipping delivery quotes for {len(pruned)} of {len(candidates)} pharmacies by estimate")
+    return pruned
+
+
+async def get_delivery_options(pharmacies, user_lat, user_lon, deadline=None):
+    """Функция возвращает все данные о доставке для аптек без принятия решений.
+
+    Если передан deadline и бюджет истекает, возвращает уже полученные варианты
+    и помечает deadline.partial.
+    """
 
     # Проверка на наличие аптек
     if not pharmacies.get("list_pharmacies"):
@@ -534,77 +1963,123 @@ async def get_delivery_options(pharmacies, user_lat, user_lon):
     results = []
 
     for pharmacy in pharmacies["list_pharmacies"]:
-        source = pharmacy.get("source", {})
-        products = pharmacy.get("products", [])
+        pharmacy_options = await get_pharmacy_delivery_options(pharmacy, user_lat, user_lon, deadline=deadline)
+        if isinstance(pharmacy_options, JSONResponse):
+            return pharmacy_options
+        if pharmacy_options is None:
+            break  # Бюджет исчерпан: остальные аптеки не запрашиваем
+        results.extend(pharmacy_options)
 
-        if "code" not in source:
-            continue
+    return results
 
-        pharmacy_total_sum = pharmacy.get("total_sum", 0)
 
-        # Формирование списка товаров с учетом оригиналов и аналогов
-        items = []
-        for product in products:
-            if product["quantity"] >= product["quantity_desired"]:
-                items.append({"sku": product["sku"], "quantity": product["quantity_desired"]})
-            elif "analogs" in product and product["analogs"]:
-                cheapest_analog = min(product["analogs"], key=lambda analog: analog["base_price"])
-                items.append({"sku": cheapest_analog["sku"], "quantity": product["quantity_desired"]})
+async def get_pharmacy_delivery_options(pharmacy, user_lat, user_lon, deadline=None):
+    """Запрашивает варианты доставки для одной аптеки.
 
-        if not items:
-            continue
+    Возвращает список вариантов, JSONResponse с ошибкой или None, если бюджет запроса истек.
+    """
+    source = pharmacy.get("source", {})
+    products = pharmacy.get("products", [])
+
+    if "code" not in source:
+        return []
+
+    pharmacy_total_sum = pharmacy.get("total_sum", 0)
+
+    # Формирование списка товаров с учетом оригиналов и аналогов
+    items = []
+    for product in products:
+        if product["quantity"] >= product["quantity_desired"]:
+            items.append({"sku": product["sku"], "quantity": product["quantity_desired"]})
+        elif "analogs" in product and product["analogs"]:
+            cheapest_analog = min(product["analogs"], key=lambda analog: analog["base_price"])
+            items.append({"sku": cheapest_analog["sku"], "quantity": product["quantity_desired"]})
+
+    if not items:
+        return []
+
+    if deadline and deadline.expired():
+        logger.warning("Request deadline exceeded, skipping remaining delivery quotes")
+        deadline.partial = True
+        return None
+
+    # Формируем запрос для расчета доставки
+    payload = {
+        "items": items,
+        "dst": {
+            "lat": user_lat,
+            "lng": user_lon
+        },
+        "source_code": source["code"]
+    }
 
-        # Формируем запрос для расчета доставки
-        payload = {
-            "items": items,
-            "dst": {
-                "lat": user_lat,
-                "lng": user_lon
-            },
-            "source_code": source["code"]
-        }
+    cache_key = make_cache_key(f"price:{source['code']}", payload)
+    if price_warmer is not None:
+        # Популярность считается по аптеке, товарам и ячейке адреса; обновляется последний адрес ячейки
+        cell = (math.floor(user_lat / CACHE_WARMER_CELL_DEG), math.floor(user_lon / CACHE_WARMER_CELL_DEG))
+        price_warmer.record(make_cache_key(f"price_cell:{source['code']}", items, cell), cache_key, payload)
+    delivery_data = await get_upstream_cached(cache_key)
+    from_cache = delivery_data is not None
 
-        async with httpx.AsyncClient() as client:
-            try:
-                response = await client.post(URL_PRICE, json=payload)
-                response.raise_for_status()
-                delivery_data = response.json()
+    if delivery_data is None:
+        try:
+            delivery_data = await request_delivery_quote(payload, deadline=deadline)
+            if delivery_data.get("status") == "success":
+                await set_upstream_cached(cache_key, delivery_data, PRICE_CACHE_TTL)
+
+        except httpx.TimeoutException as e:
+            if deadline and deadline.cut_call():
+                logger.warning(f"URL_PRICE quote cut by request deadline: {e}")
+                deadline.partial = True
+                return None
+            logger.error(f"Request error while accessing URL_PRICE: {e}")
+            return JSONResponse(content={"error": "Request error while accessing URL_PRICE", "details": str(e)},
+                                status_code=502)
 
-                if delivery_data.get("status") == "success":
-                    delivery_options = delivery_data["result"]["delivery"]
+        except httpx.RequestError as e:
+            logger.error(f"Request error while accessing URL_PRICE: {e}")
+            return JSONResponse(content={"error": "Request error while accessing URL_PRICE", "details": str(e)},
+                                status_code=502)
 
-                    for option in delivery_options:
-                        results.append({
-                            "pharmacy": pharmacy,
-                            "total_price": pharmacy_total_sum + option["price"],
-                            "delivery_option": option
-                        })
-                else:
-                    logger.error(f"Unexpected response format from URL_PRICE API: {delivery_data}")
-                    return JSONResponse(
-                        content={"error": "Unexpected response format from URL_PRICE API", "details": delivery_data},
-                        status_code=502
-                    )
-
-            except httpx.RequestError as e:
-                logger.error(f"Request error while accessing URL_PRICE: {e}")
-                return JSONResponse(content={"error": "Request error while accessing URL_PRICE", "details": str(e)},
-                                    status_code=502)
-
-            except httpx.HTTPStatusError as e:
-                error_details = e.response.json() if e.response.content else {"error": str(e)}
-                logger.error(f"HTTP error while accessing URL_PRICE: {e}")
-                return JSONResponse(
-                    content={
-                        "error": f"HTTP error {e.response.status_code}",
-                        "details": error_details
-                    },
-                    status_code=e.response.status_code
-                )
+        except httpx.HTTPStatusError as e:
+            error_details = e.response.json() if e.response.content else {"error": str(e)}
+            logger.error(f"HTTP error while accessing URL_PRICE: {e}")
+            return JSONResponse(
+                content={
+                    "error": f"HTTP error {e.response.status_code}",
+                    "details": error_details
+                },
+                status_code=e.response.status_code
+            )
+
+    if delivery_data.get("status") != "success":
+        logger.error(f"Unexpected response format from URL_PRICE API: {delivery_data}")
+        return JSONResponse(
+            content={"error": "Unexpected response format from URL_PRICE API", "details": delivery_data},
+            status_code=502
+        )
+
+    if ESTIMATOR_ENABLED and source.get("lat") is not None and source.get("lon") is not None:
+        distance_km = great_circle_distance_km(user_lat, user_lon, source["lat"], source["lon"])
+        if from_cache:
+            # Ответ из кэша уже учтен при получении: он только подтверждает, что прогноз свежий
+            delivery_estimator.touch(source["code"], distance_km)
+        else:
+            delivery_estimator.observe(source["code"], distance_km, current_almaty_hour(),
+                                       delivery_data["result"]["delivery"])
+
+    results = []
+    for option in delivery_data["result"]["delivery"]:
+        results.append({
+            "pharmacy": pharmacy,
+            "total_price": pharmacy_total_sum + option["price"],
+            "delivery_option": option
+        })
 
     return results
 
 
+@pipeline_stages.engine("best_option")
 async def best_option(delivery_data):
     """Функция для сравнения аптек и выбора лучших опций с учетом времени закрытия, цены и условий."""
 
@@ -772,6 +2247,143 @@ def save_response_to_file(data, file_name='data.json'):
 
 
 
+@app.get("/metrics")
+async def metrics():
+    """Метрики воркера в JSON: память по этапам, кэши, индекс остатков."""
+    return JSONResponse(content={
+        "pid": os.getpid(),
+        "memory": dict(memory_tracker.stats(), rss_budget_bytes=rss_budget.budget_bytes, shed=rss_budget.shed),
+        "upstream_cache": await upstream_cache.astats(),
+        "response_cache": await response_cache.astats(),
+        "negative_cache": await negative_cache.astats(),
+        "stock_index": stock_index.stats(),
+        "estimator": delivery_estimator.stats(),
+        "admission": admission.stats(),
+        "stages": pipeline_stages.stats(),
+        "startup": worker_warmup.report(),
+        "cache_warmer": {warmer.name: warmer.stats() for warmer in cache_warmers},
+    })
+
+
+def warm_timezone():
+    """Первые вызовы pytz и strptime загружают данные часового пояса и модуль _strptime."""
+    now = datetime.utcnow()
+    closes_at = (now + timedelta(hours=1)).strftime("%Y-%m-%dT%H:%M:%SZ")
+    opens_at = (now - timedelta(hours=8)).strftime("%Y-%m-%dT%H:%M:%SZ")
+    is_pharmacy_closed(closes_at, opens_at, "")
+    is_pharmacy_open_soon(closes_at, opens_at, "")
+    current_almaty_hour()
+
+
+async def warm_http_pool():
+    """Открывает WARMUP_CONNECTIONS соединений к каждому апстриму; статус ответа не важен."""
+    client = get_http_client()
+    urls = {str(httpx.URL(url).copy_with(query=None)) for url in (URL_SEARCH, URL_PRICE, URL_PRICE_BATCH) if url}
+
+    async def touch(url):
+        try:
+            await client.head(url)
+        except httpx.HTTPError as e:
+            logger.warning(f"Warmup request to {url} failed: {e}")
+
+    await asyncio.gather(*(touch(url) for url in urls for _ in range(WARMUP_CONNECTIONS)))
+
+
+async def warm_city_catalogs():
+    """Поиск по WARMUP_SKUS в каждом из WARMUP_CITIES: заполняет кэш апстримов."""
+    payload = [{"sku": sku, "count_desired": 1} for sku in WARMUP_SKUS]
+    for city in WARMUP_CITIES:
+        pharmacies = await find_medicines_in_pharmacies(city, payload)
+        if isinstance(pharmacies, JSONResponse):
+            logger.warning(f"Warmup search for city {city} failed with status {pharmacies.status_code}")
+
+
+# Обработчик регистрируется последним: прогрев идет после остальных обработчиков старта,
+# а uvicorn не принимает соединения, пока старт не завершен
+@app.on_event("startup")
+async def warm_up_worker():
+    if WARMUP_ENABLED:
+        step_timeout = WARMUP_STEP_TIMEOUT_MS / 1000
+        await worker_warmup.step("timezone", warm_timezone)
+        if URL_SEARCH or URL_PRICE:
+            await worker_warmup.step("http_pool", warm_http_pool, timeout=step_timeout)
+        if WARMUP_CITIES and WARMUP_SKUS and URL_SEARCH:
+            await worker_warmup.step("city_catalogs", warm_city_catalogs, timeout=step_timeout)
+        if WARMUP_GC_FREEZE:
+            worker_warmup.freeze_heap()
+    worker_warmup.mark_ready()
+
+
+@app.get("/health/live")
+async def health_live():
+    return JSONResponse(content={"status": "ok"})
+
+
+@app.get("/health/ready")
+async def health_ready():
+    """Готовность к трафику (для readiness-проб): 503, пока воркер не прогрет."""
+    if not worker_warmup.ready:
+        return JSONResponse(content={"status": "warming_up", "startup": worker_warmup.report()}, status_code=503)
+    return JSONResponse(content={"status": "ready", "startup": worker_warmup.report()})
+
+
+def profile_access_denied(request):
+    """Ручки профилей доступны только с токеном в заголовке X-Profile-Token."""
+    if not PROFILE_TOKEN or request.headers.get("X-Profile-Token") != PROFILE_TOKEN:
+        return JSONResponse(content={"error": "Not found"}, status_code=404)
+    return None
+
+
+@app.get("/debug/profiles")
+async def list_profiles(request: Request):
+    denied = profile_access_denied(request)
+    if denied is not None:
+        return denied
+    return JSONResponse(content={"profiles": profile_store.list()})
+
+
+@app.get("/debug/profiles/{request_id}")
+async def get_profile(request_id: str, request: Request, format: str = "auto"):
+    """Профиль запроса: collapsed (свернутые стеки для flamegraph), pstats (бинарный дамп) или text."""
+    denied = profile_access_denied(request)
+    if denied is not None:
+        return denied
+
+    profile = profile_store.get(request_id)
+    if profile is None:
+        return JSONResponse(content={"error": "Profile not found"}, status_code=404)
+
+    if format == "auto":
+        format = "collapsed" if profile["mode"] == "sample" else "pstats"
+    if format == "collapsed" and "collapsed" in profile:
+        return PlainTextResponse(profile["collapsed"])
+    if format == "pstats" and "pstats" in profile:
+        return Response(
+            content=profile["pstats"],
+            media_type="application/octet-stream",
+            headers={"Content-Disposition": f'attachment; filename="{request_id}.pstats"'},
+        )
+    if format == "text" and "pstats" in profile:
+        return PlainTextResponse(pstats_text(profile["pstats"]))
+    return JSONResponse(content={"error": f"Format '{format}' is not available for {profile['mode']} profile"},
+                        status_code=400)
+
+
+@app.get("/debug/memory")
+async def memory_report(request: Request, limit: int = 20, group_by: str = "lineno"):
+    """Топ мест выделения памяти (tracemalloc), group_by: lineno, filename или traceback."""
+    denied = profile_access_denied(request)
+    if denied is not None:
+        return denied
+    if group_by not in ("lineno", "filename", "traceback"):
+        return JSONResponse(content={"error": f"Unknown group_by '{group_by}'"}, status_code=400)
+    report = memory_tracker.report(limit=limit, group_by=group_by)
+    if report is None:
+        return JSONResponse(content={"error": "tracemalloc is not enabled (MEMORY_TRACKING=tracemalloc)"},
+                            status_code=400)
+    return PlainTextResponse(report)
+
+
 # мок ручки для возврата тестовых результатов запроса поиска аптек
 @app.get("/search_medicines")
 async def search_medicines():
@@ -1396,3 +3008,6 @@ async def search_medicines():
             # }
         ]
     })
+
+
+worker_warmup.imported()
@@ -0,0 +1,170 @@
+import gc
+import logging
+import os
+import resource
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+
+logger = logging.getLogger(__name__)
+
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def current_rss_bytes():
+    """Текущий RSS процесса. Вне Linux — пиковый RSS из getrusage."""
+    try:
+        with open("/proc/self/statm", "rb") as file:
+            return int(file.read().split()[1]) * _PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class _StageMemory:
+    """Накопленная статистика памяти одного этапа."""
+
+    __slots__ = ("count", "rss_delta_sum", "rss_delta_max", "allocated_sum", "allocated_max", "peak_max")
+
+    def __init__(self):
+        self.count = 0
+        self.rss_delta_sum = 0
+        self.rss_delta_max = 0
+        self.allocated_sum = 0
+        self.allocated_max = 0
+        self.peak_max = 0
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "rss_delta_avg": self.rss_delta_sum // self.count if self.count else 0,
+            "rss_delta_max": self.rss_delta_max,
+            "allocated_avg": self.allocated_sum // self.count if self.count else 0,
+            "allocated_max": self.allocated_max,
+            "peak_max": self.peak_max,
+        }
+
+
+class MemoryTracker:
+    """Учет памяти по этапам пайплайна.
+
+    Режимы:
+    - off — ничего не замеряется;
+    - rss — прирост RSS процесса за этап;
+    - tracemalloc — дополнительно прирост занятой Python-памяти и пик над уровнем начала этапа
+      (tracemalloc заметно замедляет весь процесс, включать на время разбора).
+
+    Замеры общие для процесса: если этапы соседних запросов идут одновременно, их память смешивается.
+    """
+
+    def __init__(self, mode="off", frames=10):
+        self.mode = mode
+        self.frames = frames
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.mode in ("rss", "tracemalloc")
+
+    def start(self):
+        if self.mode == "tracemalloc" and not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+            logger.info(f"tracemalloc started with {self.frames} frames")
+        elif self.mode not in ("off", "rss", "tracemalloc"):
+            logger.warning(f"Unknown memory tracking mode '{self.mode}', tracking disabled")
+            self.mode = "off"
+
+    def stop(self):
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def stage(self, name):
+        if not self.enabled:
+            return nullcontext()
+        return self._measure(name)
+
+    @contextmanager
+    def _measure(self, name):
+        tracing = tracemalloc.is_tracing()
+        rss_started = current_rss_bytes()
+        if tracing:
+            traced_started, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+        try:
+            yield
+        finally:
+            rss_delta = current_rss_bytes() - rss_started
+            allocated = peak = 0
+            if tracing:
+                traced, traced_peak = tracemalloc.get_traced_memory()
+                allocated = traced - traced_started
+                peak = traced_peak - traced_started
+            with self._lock:
+                stats = self.stages.get(name)
+                if stats is None:
+                    stats = self.stages[name] = _StageMemory()
+                stats.count += 1
+                stats.rss_delta_sum += rss_delta
+                stats.rss_delta_max = max(stats.rss_delta_max, rss_delta)
+                stats.allocated_sum += allocated
+                stats.allocated_max = max(stats.allocated_max, allocated)
+                stats.peak_max = max(stats.peak_max, peak)
+
+    def stats(self):
+        result = {"mode": self.mode, "rss_bytes": current_rss_bytes()}
+        if tracemalloc.is_tracing():
+            traced, traced_peak = tracemalloc.get_traced_memory()
+            result["traced_bytes"] = traced
+            result["traced_peak_bytes"] = traced_peak
+        with self._lock:
+            result["stages"] = {name: stats.as_dict() for name, stats in self.stages.items()}
+        return result
+
+    def report(self, limit=20, group_by="lineno"):
+        """Топ мест выделения памяти по текущему снимку tracemalloc (None, если трассировка выключена)."""
+        if not tracemalloc.is_tracing():
+            return None
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ))
+        top = snapshot.statistics(group_by)
+        lines = [f"Top {limit} allocations by {group_by}:"]
+        for index, statistic in enumerate(top[:limit], 1):
+            frame = statistic.traceback[0]
+            lines.append(f"#{index}: {frame.filename}:{frame.lineno}: "
+                         f"{statistic.size / 1024:.1f} KiB in {statistic.count} blocks")
+            if group_by == "traceback":
+                lines.extend(f"    {line}" for line in statistic.traceback.format())
+        other = top[limit:]
+        if other:
+            lines.append(f"{len(other)} other: {sum(statistic.size for statistic in other) / 1024:.1f} KiB")
+        lines.append(f"Total allocated size: {sum(statistic.size for statistic in top) / 1024:.1f} KiB")
+        return "\n".join(lines)
+
+
+class RssBudget:
+    """Ограничение RSS воркера: при превышении новые запросы отклоняются, пока память не освободится.
+
+    Перед отказом не чаще раза в gc_interval секунд запускается сборка мусора и RSS проверяется снова.
+    """
+
+    def __init__(self, budget_mb=0, gc_interval=1.0):
+        self.budget_bytes = int(budget_mb * 1024 * 1024)
+        self.gc_interval = gc_interval
+        self._last_gc = 0.0
+        self.shed = 0
+
+    def exceeded(self):
+        if self.budget_bytes <= 0 or current_rss_bytes() <= self.budget_bytes:
+            return False
+        now = time.monotonic()
+        if now - self._last_gc >= self.gc_interval:
+            self._last_gc = now
+            gc.collect()
+            if current_rss_bytes() <= self.budget_bytes:
+                return False
+        self.shed += 1
+        return True
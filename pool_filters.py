@@ -0,0 +1,155 @@
+"""Фильтрация аптек в пуле процессов.
+
+Процессу пула передается только компактное описание ответа поиска (SKU, остатки и цены аналогов),
+а возвращается план: индексы отобранных аптек и какие товары в них выбраны. Словари аптек
+собирает родительский процесс (apply_filter_plan). Результат совпадает с этапами
+missing_items_filter, priority_filter и fulfillment_sort (движки default).
+
+Модуль не должен ничего делать при импорте: его импортируют процессы пула (spawn).
+"""
+
+
+def compact_search_result(pharmacies_list):
+    """[аптека] -> [(sku, остаток, ((остаток аналога, цена аналога), ...)) по каждому товару]."""
+    return [
+        [
+            (product["sku"], product["quantity"],
+             tuple((analog["quantity"], analog["base_price"]) for analog in product.get("analogs", [])))
+            for product in pharmacy.get("products", [])
+        ]
+        for pharmacy in pharmacies_list
+    ]
+
+
+def compact_basket(sku_data):
+    return [(item["sku"], item["count_desired"]) for item in sku_data]
+
+
+def _has_missing_item(products, basket):
+    for sku, desired in basket:
+        for product_sku, quantity, analogs in products:
+            if product_sku == sku:
+                if quantity >= desired or any(analog_quantity >= desired for analog_quantity, _ in analogs):
+                    break
+                return True
+        else:
+            return True
+    return False
+
+
+def plan_filter_stages(pharmacies, basket):
+    """Точка входа в процессе пула: компактные аптеки и корзина -> план.
+
+    План: (отобранные, замены), где отобранные — [(индекс аптеки, индексы оставшихся товаров
+    или None, если аптека не менялась, номера замен последнего изменившего список круга)],
+    а замены — {индекс аптеки: [(индекс товара, позиция корзины, индекс аналога или None)]}
+    в порядке применения.
+    """
+    # missing_items_filter: остаются аптеки, в которых не хватает хотя бы одного товара
+    filtered = [(index, None, []) for index, products in enumerate(pharmacies) if _has_missing_item(products, basket)]
+
+    # priority_filter: круг на каждую позицию корзины, по порядку приоритета
+    changes = {}
+    analogs_now = {}  # (аптека, товар) -> аналоги после замены на самый дешевый
+    for position, (sku, desired) in enumerate(basket):
+        kept = []
+        for index, product_indices, _ in filtered:
+            products = pharmacies[index]
+            updated = list(range(len(products)) if product_indices is None else product_indices)
+            replaced = []
+            found = False
+            for product_index in updated:
+                product_sku, quantity, analogs = products[product_index]
+                if product_sku != sku:
+                    continue
+                if quantity >= desired:
+                    changes.setdefault(index, []).append((product_index, position, None))
+                    found = True
+                    break
+                analogs = analogs_now.get((index, product_index), analogs)
+                if analogs:
+                    cheapest = min(range(len(analogs)), key=lambda analog_index: analogs[analog_index][1])
+                    if analogs[cheapest][0] >= desired:
+                        product_changes = changes.setdefault(index, [])
+                        product_changes.append((product_index, position, cheapest))
+                        replaced.append(len(product_changes) - 1)
+                        analogs_now[(index, product_index)] = (analogs[cheapest],)
+                        found = True
+                        break
+            if found:
+                kept.append((index, updated, replaced))
+        # Если в круге не нашлось ни одной аптеки, список не меняется
+        if kept:
+            filtered = kept
+
+    # fulfillment_sort: аптеки с наибольшим числом товаров
+    def size(entry):
+        index, product_indices, _ = entry
+        return len(pharmacies[index]) if product_indices is None else len(product_indices)
+
+    max_products = max(map(size, filtered), default=0)
+    top = [entry for entry in filtered if size(entry) == max_products]
+    return top, {index: changes.get(index, []) for index, _, _ in top}
+
+
+def analog_replacement(product, analog, count_desired):
+    """Аналог, которым заменяется товар: поля аналога и цены исходного товара."""
+    return {
+        "source_code": analog["source_code"],
+        "sku": analog["sku"],
+        "name": analog["name"],
+        "base_price": analog["base_price"],
+        "price_with_warehouse_discount": analog["price_with_warehouse_discount"],
+        "warehouse_discount": analog["warehouse_discount"],
+        "quantity": analog["quantity"],
+        "quantity_desired": count_desired,
+        "diff": product["diff"],
+        "avg_price": product["avg_price"],
+        "min_price": product["min_price"],
+        "pp_packing": analog.get("pp_packing", ""),
+        "manufacturer_id": analog.get("manufacturer_id", ""),
+        "recipe_needed": analog["recipe_needed"],
+        "strong_recipe": analog["strong_recipe"],
+    }
+
+
+def basket_total_sum(pharmacy):
+    """Сумма по выбранным товарам аптеки (аналог, если его хватает, иначе сам товар)."""
+    return sum(
+        (product["analogs"][0]["base_price"] * product["analogs"][0]["quantity"]
+         if product.get("analogs") and product["analogs"][0]["quantity"] >= product["quantity_desired"]
+         else product["base_price"] * product["quantity"])
+        for product in pharmacy["products"]
+        if "quantity_desired" in product
+    )
+
+
+def apply_filter_plan(pharmacies_list, sku_data, plan):
+    """Собирает результат fulfillment_sort по плану из plan_filter_stages (в родительском процессе)."""
+    top, changes = plan
+    filtered_pharmacies = []
+    for index, product_indices, replaced in top:
+        pharmacy = pharmacies_list[index]
+        products = pharmacy.get("products", [])
+        swaps = []
+        for product_index, position, analog_index in changes[index]:
+            product = products[product_index]
+            count_desired = sku_data[position]["count_desired"]
+            product["quantity_desired"] = count_desired
+            if analog_index is None:
+                swaps.append(None)
+                continue
+            analog = product["analogs"][analog_index]
+            product["analogs"] = [analog_replacement(product, analog, count_desired)]
+            swaps.append({"original_sku": product["sku"], "replacement_sku": analog["sku"]})
+
+        if product_indices is not None:
+            pharmacy = {
+                "source": pharmacy["source"],
+                "products": [products[product_index] for product_index in product_indices],
+                "replacements_needed": len(replaced),
+                "replaced_skus": [swaps[change] for change in replaced],
+            }
+        pharmacy["total_sum"] = basket_total_sum(pharmacy)
+        filtered_pharmacies.append(pharmacy)
+    return {"filtered_pharmacies": filtered_pharmacies}
@@ -0,0 +1,176 @@
+import cProfile
+import io
+import logging
+import marshal
+import os
+import pstats
+import random
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
+
+
+logger = logging.getLogger(__name__)
+
+
+class ProfileStore:
+    """Последние профили запросов в памяти процесса, по request id."""
+
+    def __init__(self, max_profiles=100):
+        self.max_profiles = max_profiles
+        self._profiles = OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, request_id, profile):
+        with self._lock:
+            self._profiles[request_id] = profile
+            self._profiles.move_to_end(request_id)
+            while len(self._profiles) > self.max_profiles:
+                self._profiles.popitem(last=False)
+
+    def get(self, request_id):
+        with self._lock:
+            return self._profiles.get(request_id)
+
+    def list(self):
+        with self._lock:
+            return [
+                {"request_id": request_id, "mode": profile["mode"], "path": profile["path"],
+                 "duration_ms": profile["duration_ms"], "created_at": profile["created_at"]}
+                for request_id, profile in self._profiles.items()
+            ]
+
+
+def pstats_text(stats_dump, limit=50, sort="cumulative"):
+    """Текстовая сводка из дампа cProfile (формат pstats)."""
+    with tempfile.NamedTemporaryFile(suffix=".pstats") as file:
+        file.write(stats_dump)
+        file.flush()
+        output = io.StringIO()
+        pstats.Stats(file.name, stream=output).sort_stats(sort).print_stats(limit)
+    return output.getvalue()
+
+
+class StackSampler:
+    """Семплирующий профайлер: раз в interval секунд снимает стек потока и копит свернутые стеки."""
+
+    def __init__(self, thread_id, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def collapsed(self):
+        return "\n".join(f"{stack} {count}" for stack, count in self.stacks.most_common())
+
+
+class ProfilingMiddleware:
+    """ASGI-middleware профилирования отдельных запросов.
+
+    Профилируется запрос с заголовком X-Profile, равным token, либо случайная доля sample_rate запросов.
+    Режим задается заголовком X-Profile-Mode: cprofile (детерминированный, дамп pstats) или sample
+    (семплирующий, свернутые стеки). Профиль сохраняется в store по X-Request-ID (или новому id),
+    id возвращается в заголовке ответа X-Profile-Id. Без профилирования запрос проходит без изменений.
+
+    Профилируется весь поток event loop: параллельные запросы попадают в профиль вместе с нужным.
+    cProfile одновременно может работать только для одного запроса, остальные в это время не профилируются.
+    """
+
+    def __init__(self, app, store, token=None, sample_rate=0.0, default_mode="sample", paths=None):
+        self.app = app
+        self.store = store
+        self.token = token
+        self.sample_rate = sample_rate
+        self.default_mode = default_mode
+        self.paths = paths
+        self._cprofile_lock = threading.Lock()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or (self.paths and scope["path"] not in self.paths):
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope["headers"])
+        requested = self.token and headers.get(b"x-profile", b"").decode("latin-1") == self.token
+        if not requested and not (self.sample_rate and random.random() < self.sample_rate):
+            await self.app(scope, receive, send)
+            return
+
+        mode = headers.get(b"x-profile-mode", self.default_mode.encode()).decode("latin-1")
+        request_id = headers.get(b"x-request-id", b"").decode("latin-1") or uuid.uuid4().hex
+
+        async def send_with_profile_id(message):
+            if message["type"] == "http.response.start":
+                message = dict(message, headers=list(message.get("headers", [])) +
+                               [(b"x-profile-id", request_id.encode("latin-1"))])
+            await send(message)
+
+        if mode == "cprofile":
+            await self._run_cprofile(scope, receive, send_with_profile_id, request_id)
+        else:
+            await self._run_sampler(scope, receive, send_with_profile_id, request_id)
+
+    async def _run_cprofile(self, scope, receive, send, request_id):
+        if not self._cprofile_lock.acquire(blocking=False):
+            logger.info(f"Another request is being profiled with cProfile, skipping {request_id}")
+            await self.app(scope, receive, send)
+            return
+
+        profiler = cProfile.Profile()
+        started = time.perf_counter()
+        try:
+            profiler.enable()
+            try:
+                await self.app(scope, receive, send)
+            finally:
+                profiler.disable()
+        finally:
+            self._cprofile_lock.release()
+
+        profiler.create_stats()
+        self.store.put(request_id, {
+            "mode": "cprofile",
+            "path": scope["path"],
+            "duration_ms": round((time.perf_counter() - started) * 1000, 2),
+            "created_at": time.time(),
+            "pstats": marshal.dumps(profiler.stats),
+        })
+
+    async def _run_sampler(self, scope, receive, send, request_id):
+        sampler = StackSampler(threading.get_ident())
+        started = time.perf_counter()
+        sampler.start()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            sampler.stop()
+
+        self.store.put(request_id, {
+            "mode": "sample",
+            "path": scope["path"],
+            "duration_ms": round((time.perf_counter() - started) * 1000, 2),
+            "created_at": time.time(),
+            "collapsed": sampler.collapsed(),
+        })
@@ -0,0 +1,376 @@
+"""Замороженные копии этапов пайплайна — эталон для fuzz_engines.py.
+
+Код скопирован из main.py без изменений логики; убраны только регистрация в реестре,
+параметр analogs и сохранение промежуточных файлов. Не редактировать при оптимизации
+main.py: расхождение с этими функциями и есть то, что ищет фаззер.
+"""
+import logging
+import math
+from datetime import datetime, timedelta
+
+import pytz
+from fastapi.responses import JSONResponse
+
+
+logger = logging.getLogger(__name__)
+
+
+async def filter_pharmacies_by_priority_items(pharmacies, priority_skus):
+    """
+    Функция для последовательного фильтрации аптек по приоритетным товарам с учетом аналогов.
+    """
+    if "result" not in pharmacies or not isinstance(pharmacies["result"], list):
+        logger.error("Invalid pharmacies data format.")
+        return JSONResponse(content={"error": "Invalid pharmacies data format"}, status_code=502)
+
+    filtered_pharmacies = pharmacies.get("result", [])
+    logger.info(f"Initial pharmacies count: {len(filtered_pharmacies)}")
+    found_any_product = False  # Флаг для проверки наличия хотя бы одного товара в аптеках
+
+    for round_number, priority_sku in enumerate(priority_skus, start=1):
+        logger.info(f"Processing priority SKU {round_number}/{len(priority_skus)}: {priority_sku}")
+        temp_filtered_pharmacies = []
+
+        for pharmacy in filtered_pharmacies:
+            logger.info(f"Checking pharmacy: {pharmacy.get('source', {}).get('name', 'Unknown')}")
+            products = pharmacy.get("products", [])
+            updated_products = products[:]
+            replacements_needed = 0
+            replaced_skus = []
+            product_found = False
+
+            for product in updated_products:
+                if product["sku"] == priority_sku["sku"]:
+                    if product["quantity"] >= priority_sku["count_desired"]:
+                        # Если оригинал найден и достаточно, добавляем его
+                        logger.info(f"Product {product['sku']} has sufficient quantity")
+                        product["quantity_desired"] = priority_sku["count_desired"]
+                        product_found = True
+                        found_any_product = True
+                        break
+                    else:
+                        # Если недостаточно, проверяем аналоги
+                        logger.info(f"Insufficient quantity for SKU: {product['sku']}, checking analogs")
+                        cheapest_analog = min(
+                            product.get("analogs", []),
+                            key=lambda analog: analog["base_price"],
+                            default=None
+                        )
+                        if cheapest_analog and cheapest_analog["quantity"] >= priority_sku["count_desired"]:
+
+                            product["quantity_desired"] = priority_sku["count_desired"]
+                            product["analogs"] = [{
+                                "source_code": cheapest_analog["source_code"],
+                                "sku": cheapest_analog["sku"],
+                                "name": cheapest_analog["name"],
+                                "base_price": cheapest_analog["base_price"],
+                                "price_with_warehouse_discount": cheapest_analog["price_with_warehouse_discount"],
+                                "warehouse_discount": cheapest_analog["warehouse_discount"],
+                                "quantity": cheapest_analog["quantity"],
+                                "quantity_desired": priority_sku["count_desired"],
+                                "diff": product["diff"],
+                                "avg_price": product["avg_price"],
+                                "min_price": product["min_price"],
+                                "pp_packing": cheapest_analog.get("pp_packing", ""),
+                                "manufacturer_id": cheapest_analog.get("manufacturer_id", ""),
+                                "recipe_needed": cheapest_analog["recipe_needed"],
+                                "strong_recipe": cheapest_analog["strong_recipe"],
+                            }]
+                            replacements_needed += 1
+                            replaced_skus.append({
+                                "original_sku": product["sku"],
+                                "replacement_sku": cheapest_analog["sku"]
+                            })
+                            product_found = True
+                            found_any_product = True
+                            logger.info(f"replaced_skus1: {replaced_skus}")
+                            break
+
+            # Если ни оригинала, ни аналога не хватает, удаляем продукт только для текущего priority_sku
+            if not product_found:
+                updated_products = [p for p in updated_products if p["sku"] != priority_sku["sku"]]
+                logger.info(f"Removing product SKU: {priority_sku['sku']} from pharmacy due to insufficient stock")
+
+            # Проверка финального списка продуктов в аптеке после всех удалений и замен
+            logger.info(f"Final product list for pharmacy after SKU '{priority_sku['sku']}': {[p['sku'] for p in updated_products]}")
+
+            logger.info(f"replaced_skus2: {replaced_skus}")
+
+            # Сохраняем аптеку только если продукт найден (оригинал или аналог) или это не последний SKU
+            if product_found:
+                temp_filtered_pharmacies.append({
+                    "source": pharmacy["source"],
+                    "products": updated_products,
+                    "replacements_needed": replacements_needed,
+                    "replaced_skus": replaced_skus
+                })
+
+        # Обновляем список аптек для следующего SKU
+        if temp_filtered_pharmacies:
+            filtered_pharmacies = temp_filtered_pharmacies
+            logger.info(f"Filtered pharmacies count after SKU '{priority_sku['sku']}': {len(filtered_pharmacies)}")
+        elif not found_any_product:
+            logger.info(f"No pharmacies found after filtering for SKU '{priority_sku['sku']}'")
+            continue
+            # return JSONResponse(content={
+            #     "error": "No pharmacies found meeting the SKU requirements or available quantities."
+            # }, status_code=500)
+
+    # Финальный подсчет total_sum после всех раундов
+    for pharmacy in filtered_pharmacies:
+        pharmacy["total_sum"] = sum(
+            # Если у продукта есть аналог с достаточным количеством, используем его для подсчета суммы
+            (product["analogs"][0]["base_price"] * product["analogs"][0]["quantity"]
+             if product.get("analogs") and product["analogs"][0]["quantity"] >= product["quantity_desired"]
+             # Иначе считаем только основной продукт, если его количество соответствует желаемому
+             else product["base_price"] * product["quantity"])
+            for product in pharmacy["products"]
+            if "quantity_desired" in product
+        )
+
+    return {"filtered_pharmacies": filtered_pharmacies}
+
+
+async def get_top_closest_pharmacies(pharmacies, user_lat, user_lon):
+    pharmacies_with_distance = []
+    for pharmacy in pharmacies.get("filtered_pharmacies", []):
+        source_info = pharmacy.get("source", {})
+        pharmacy_lat = source_info.get("lat")
+        pharmacy_lon = source_info.get("lon")
+
+        # Проверяем если lat/lon существует, перед расчетом дистанции
+        if pharmacy_lat is None or pharmacy_lon is None:
+            continue  # пропускаем если lat/lon отсутствуют
+
+        distance = haversine_distance(user_lat, user_lon, pharmacy_lat, pharmacy_lon)
+        pharmacies_with_distance.append({"pharmacy": pharmacy, "distance": distance})
+
+    # сортируем аптеки по дистанции от самой близкой и дальше
+    sorted_pharmacies = sorted(pharmacies_with_distance, key=lambda x: x["distance"])
+
+    # получаем ТОП 2 ближайшие аптеки
+    closest_pharmacies = [item["pharmacy"] for item in sorted_pharmacies[:2]]
+
+    return {"list_pharmacies": closest_pharmacies}
+
+
+async def get_top_cheapest_pharmacies(pharmacies):
+    sorted_pharmacies = sorted(
+        pharmacies.get("filtered_pharmacies", []),
+        key=lambda x: x["pharmacy"].get("total_sum", float('inf')) if "pharmacy" in x else float('inf')
+    )
+
+    return {"list_pharmacies": sorted_pharmacies[:3]}
+
+
+# Алгоритм расчета расстояния
+def haversine_distance(lat1, lon1, lat2, lon2):
+    return math.sqrt((lat2 - lat1) ** 2 + (lon2 - lon1) ** 2)
+
+
+def is_pharmacy_open_soon(closes_at, opens_at, opening_hours):
+    """Проверяет, закроется ли аптека через 1 час или если аптека работает круглосуточно."""
+    almaty_tz = pytz.timezone('Asia/Almaty')
+    current_time = datetime.now(almaty_tz)
+
+    # Мок для тестов (замените на текущую дату при работе в продакшн)
+    # current_time = almaty_tz.localize(datetime(2024, 10, 21, 22, 30, 0))
+
+    # Проверка для круглосуточных аптек
+    if opening_hours == "Круглосуточно":
+        return False  # Круглосуточная аптека не закроется скоро
+
+    try:
+        # Конвертация времени открытия и закрытия в текущий часовой пояс
+        closes_time = datetime.strptime(closes_at, "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=pytz.UTC).astimezone(almaty_tz)
+        opens_time = datetime.strptime(opens_at, "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=pytz.UTC).astimezone(almaty_tz)
+    except ValueError as e:
+        logger.error(f"Time opens\closes parsing error: {e}")
+        return True  # Если ошибка, считаем, что аптека закрыта для избежания ошибок
+
+
+    # Проверяем, если аптека еще не открылась
+    if current_time < opens_time:
+        return False  # Если аптека еще не открылась, она не закроется скоро
+
+    # Проверка, закроется ли аптека через 1 час или меньше
+    return timedelta(0) <= closes_time - current_time <= timedelta(hours=1)
+
+
+def is_pharmacy_closed(closes_at, opens_at, opening_hours):
+    """Проверяет, закрыта ли аптека на момент запроса, учитывая расписание."""
+    almaty_tz = pytz.timezone('Asia/Almaty')
+    current_time = datetime.now(almaty_tz)
+
+    # Мок для тестов (замените на текущую дату при работе в продакшн)
+    # current_time = almaty_tz.localize(datetime(2024, 10, 21, 22, 30, 0))
+
+    # Проверка, если аптека круглосуточная
+    if opening_hours == "Круглосуточно":
+        return False
+
+    try:
+        # Конвертация времени открытия и закрытия
+        closes_time = datetime.strptime(closes_at, "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=pytz.UTC).astimezone(almaty_tz)
+        opens_time = datetime.strptime(opens_at, "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=pytz.UTC).astimezone(almaty_tz)
+    except ValueError as e:
+        logger.error(f"Time opens\closes parsing error: {e}")
+        return True  # Если ошибка, считаем, что аптека закрыта для избежания ошибок
+
+    # Проверка если аптека закрыта сейчас и еще не открылась
+    if current_time < opens_time:
+        return True
+
+    # Проверка если аптека уже закрылась, но еще не наступило новое время открытия
+    if current_time >= closes_time and current_time < (opens_time + timedelta(days=1)):
+        return True
+
+    # Если текущее время находится в пределах открытия и закрытия
+    return not (opens_time <= current_time < closes_time)
+
+
+async def best_option(delivery_data):
+    """Функция для сравнения аптек и выбора лучших опций с учетом времени закрытия, цены и условий."""
+
+    # Проверка наличия данных о доставке
+    if not delivery_data:
+        return JSONResponse(content={"error": "No delivery options found"}, status_code=404)
+
+    # Проверка корректности формата данных
+    for option in delivery_data:
+        if "pharmacy" not in option or "total_price" not in option or "delivery_option" not in option:
+            return JSONResponse(content={"error": "Invalid delivery option data format"}, status_code=502)
+
+    cheapest_open_pharmacy = None
+    cheapest_closed_pharmacy = None
+    alternative_cheapest_option = None
+
+    fastest_open_pharmacy = None
+    fastest_closed_pharmacy = None
+    alternative_fastest_option = None
+
+    # Первый проход для выбора самой дешевой и самой быстрой открытых аптек
+    for option in delivery_data:
+        pharmacy = option.get("pharmacy", {})
+        source = pharmacy.get("source", {})
+        closes_at = source.get("closes_at")
+        opens_at = source.get("opens_at")
+        opening_hours = source.get("opening_hours", "")
+
+        if 'code' not in source:
+            logger.warning(f"Missing 'code' in pharmacy source: {source}")
+            continue
+
+        pharmacy_closed = is_pharmacy_closed(closes_at, opens_at, opening_hours)
+        pharmacy_closes_soon = is_pharmacy_open_soon(closes_at, opens_at, opening_hours) if closes_at else False
+
+        if not pharmacy_closed:
+            # Самая дешевая открытая аптека
+            if cheapest_open_pharmacy is None or option["total_price"] < cheapest_open_pharmacy["total_price"]:
+                cheapest_open_pharmacy = option
+                if not pharmacy_closes_soon:
+                    alternative_cheapest_option = None
+                else:
+                    logger.info(f"Step 4: Pharmacy {source['code']} closes soon, looking for an alternative")
+                    # Ищем самую дешевую аптеку, которая не закрывается скоро
+                    if not alternative_cheapest_option:
+                        for alt_option in delivery_data:
+                            alt_pharmacy = alt_option.get("pharmacy", {})
+                            alt_source = alt_pharmacy.get("source", {})
+                            alt_closes_at = alt_source.get("closes_at")
+                            alt_opens_at = alt_source.get("opens_at")
+                            alt_opening_hours = alt_source.get("opening_hours", "")
+
+                            alt_pharmacy_closes_soon = is_pharmacy_open_soon(alt_closes_at, alt_opens_at, alt_opening_hours)
+                            alt_pharmacy_closed = is_pharmacy_closed(alt_closes_at, alt_opens_at, alt_opening_hours)
+
+                            # Логика для поиска самой дешевой альтернативы, которая не закрывается скоро
+                            if not alt_pharmacy_closes_soon and not alt_pharmacy_closed and \
+                                    (alternative_cheapest_option is None or alt_option["total_price"] <
+                                     alternative_cheapest_option["total_price"]):
+                                logger.info(
+                                    f"Step 5: Found alternative_cheapest_option with code {alt_source.get('code')}, works longer than 1 hour, and price {alt_option['total_price']}")
+                                alternative_cheapest_option = alt_option
+
+            # Самая быстрая открытая аптека
+            if fastest_open_pharmacy is None or option["delivery_option"]["eta"] < \
+                    fastest_open_pharmacy["delivery_option"]["eta"]:
+                fastest_open_pharmacy = option
+                if not pharmacy_closes_soon:
+                    alternative_fastest_option = None
+                else:
+                    logger.info(
+                        f"Step 4.1: Pharmacy {source['code']} closes soon, looking for an alternative fastest pharmacy")
+                    # Ищем самую быструю аптеку, которая не закрывается скоро
+                    if not alternative_fastest_option:
+                        for alt_option in delivery_data:
+                            alt_pharmacy = alt_option.get("pharmacy", {})
+                            alt_source = alt_pharmacy.get("source", {})
+                            alt_closes_at = alt_source.get("closes_at")
+                            alt_opens_at = alt_source.get("opens_at")
+                            alt_opening_hours = alt_source.get("opening_hours", "")
+
+                            alt_pharmacy_closes_soon = is_pharmacy_open_soon(alt_closes_at, alt_opens_at, alt_opening_hours)
+                            alt_pharmacy_closed = is_pharmacy_closed(alt_closes_at, alt_opens_at, alt_opening_hours)
+
+                            # Логика для поиска самой быстрой альтернативы, которая не закрывается скоро
+                            if not alt_pharmacy_closes_soon and not alt_pharmacy_closed and \
+                                    (alternative_fastest_option is None or alt_option["delivery_option"]["eta"] <
+                                     alternative_fastest_option["delivery_option"]["eta"]):
+                                logger.info(
+                                    f"Step 5.1: Found alternative_fastest_option with code {alt_source.get('code')}, works longer than 1 hour, and eta {alt_option['delivery_option']['eta']}")
+                                alternative_fastest_option = alt_option
+
+    # Второй проход для анализа закрытых аптек с учетом уже выбранных открытых аптек
+    for option in delivery_data:
+        pharmacy = option.get("pharmacy", {})
+        source = pharmacy.get("source", {})
+        closes_at = source.get("closes_at")
+        opens_at = source.get("opens_at")
+        opening_hours = source.get("opening_hours", "")
+
+        if 'code' not in source:
+            continue
+
+        pharmacy_closed = is_pharmacy_closed(closes_at, opens_at, opening_hours)
+
+        if pharmacy_closed and cheapest_open_pharmacy:
+            logger.info(
+                f"Checking closed pharmacy {source['code']} with total price {option['total_price']} against cheapest_open_pharmacy: {cheapest_open_pharmacy['total_price']}")
+
+            if option["total_price"] <= cheapest_open_pharmacy["total_price"] * 0.7:
+                if cheapest_closed_pharmacy is None or option["total_price"] < cheapest_closed_pharmacy["total_price"]:
+                    cheapest_closed_pharmacy = option
+
+            logger.info(f"Closed pharmacy {source['code']} is not 30% cheaper than the open one.")
+
+        if pharmacy_closed and fastest_open_pharmacy:
+            logger.info(
+                f"Checking closed pharmacy {source['code']} with eta {option['delivery_option']['eta']} against fastest_open_pharmacy eta: {fastest_open_pharmacy['delivery_option']['eta']}")
+
+            if option["delivery_option"]["eta"] <= fastest_open_pharmacy["delivery_option"]["eta"] * 0.7:
+                if fastest_closed_pharmacy is None or option["delivery_option"]["eta"] < \
+                        fastest_closed_pharmacy["delivery_option"]["eta"]:
+                    fastest_closed_pharmacy = option
+
+            logger.info(f"Closed pharmacy {source['code']} is not 30% faster than the open one.")
+
+
+    if cheapest_closed_pharmacy and cheapest_open_pharmacy:
+        logger.info("Step 7: Returning both cheapest open and cheapest closed pharmacies due to 30% discount")
+        return {
+            "cheapest_delivery_option": cheapest_open_pharmacy,
+            "alternative_cheapest_option": cheapest_closed_pharmacy,
+            "fastest_delivery_option": fastest_open_pharmacy,
+            "alternative_fastest_option": fastest_closed_pharmacy
+        }
+
+    logger.info(
+        f"Step 8: Returning the standard results"
+    )
+    return {
+        "cheapest_delivery_option": cheapest_open_pharmacy,
+        "alternative_cheapest_option": alternative_cheapest_option,
+        "fastest_delivery_option": fastest_open_pharmacy,
+        "alternative_fastest_option": alternative_fastest_option
+    }
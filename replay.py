@@ -0,0 +1,307 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+
+import httpx
+
+
+# Адреса апстримов, которые подставляются при офлайн-прогоне вместо настоящих
+REPLAY_URL_SEARCH = "http://replay-search/search"
+REPLAY_URL_PRICE = "http://replay-price/price"
+REPLAY_URL_PRICE_BATCH = "http://replay-price/batch"
+
+
+def load_records(path):
+    records = []
+    with open(path, encoding="utf-8") as file:
+        for line in file:
+            if line.strip():
+                records.append(json.loads(line))
+    return records
+
+
+def exchange_key(kind, params, payload):
+    return json.dumps([kind, params or {}, payload], sort_keys=True, ensure_ascii=False)
+
+
+def percentile(values, q):
+    """Процентиль по ближайшему рангу (values — отсортированный список)."""
+    if not values:
+        return None
+    index = min(len(values) - 1, max(0, int(round(q / 100 * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+class ReplayTransport(httpx.AsyncBaseTransport):
+    """Отвечает записанными ответами апстримов с записанной задержкой."""
+
+    def __init__(self, records, latency_scale=1.0):
+        self.latency_scale = latency_scale
+        self.responses = {}
+        self.missing = 0
+        for record in records:
+            for exchange in record.get("upstream", []):
+                if exchange["kind"] == "price_batch":
+                    # Пакетный ответ раскладываем по отдельным запросам: в прогоне пакетирование может быть выключено
+                    if isinstance(exchange["response"], list):
+                        for payload, answer in zip(exchange["payload"], exchange["response"]):
+                            self.responses.setdefault(exchange_key("price", None, payload),
+                                                      (exchange["status"], answer, exchange["latency_ms"]))
+                    continue
+                params = exchange["params"] if exchange["kind"] == "search" else None
+                self.responses.setdefault(exchange_key(exchange["kind"], params, exchange["payload"]),
+                                          (exchange["status"], exchange["response"], exchange["latency_ms"]))
+
+    async def handle_async_request(self, request):
+        payload = json.loads(request.content) if request.content else None
+        url = str(request.url.copy_with(query=None))
+
+        if url == REPLAY_URL_SEARCH:
+            answers = [self.responses.get(exchange_key("search", dict(request.url.params), payload))]
+        elif url == REPLAY_URL_PRICE_BATCH:
+            answers = [self.responses.get(exchange_key("price", None, item)) for item in payload]
+        else:
+            answers = [self.responses.get(exchange_key("price", None, payload))]
+
+        if any(answer is None for answer in answers):
+            self.missing += 1
+            return httpx.Response(599, json={"error": "Upstream response was not recorded"}, request=request)
+
+        await asyncio.sleep(max(answer[2] for answer in answers) / 1000 * self.latency_scale)
+        if url == REPLAY_URL_PRICE_BATCH:
+            return httpx.Response(200, json=[answer[1] for answer in answers], request=request)
+        status, body, _ = answers[0]
+        return httpx.Response(status, json=body, request=request)
+
+
+def replay_worker(options):
+    """Прогон части записей в отдельном процессе; возвращает замеры по каждому запросу."""
+    os.environ["URL_SEARCH"] = REPLAY_URL_SEARCH
+    os.environ["URL_PRICE"] = REPLAY_URL_PRICE
+    if os.environ.get("URL_PRICE_BATCH"):
+        os.environ["URL_PRICE_BATCH"] = REPLAY_URL_PRICE_BATCH
+    os.chdir(options["workdir"])  # промежуточные файлы save_response_to_file пишутся сюда
+
+    import logging
+    import main
+
+    logging.disable(logging.WARNING if options["quiet"] else logging.NOTSET)
+    if options["no_dumps"]:
+        main.save_response_to_file = lambda data, file_name='data.json': None
+
+    records = load_records(options["path"])
+    requests = records[options["worker_index"]::options["workers"]] * options["repeat"]
+    transport = ReplayTransport(records, latency_scale=options["latency_scale"])
+
+    async def run():
+        client = httpx.AsyncClient(transport=transport)
+        main.get_http_client = lambda: client
+        semaphore = asyncio.Semaphore(options["concurrency"])
+        measurements = []
+
+        async def replay_one(record):
+            async with semaphore:
+                timings = {}
+                token = main._stage_timings.set(timings)
+                started = time.perf_counter()
+                try:
+                    # Записанное тело проверяется той же схемой, что и в HTTP-ручке
+                    request_data = main.parse_delivery_request(json.dumps(record["request"]))
+                    if isinstance(request_data, main.JSONResponse):
+                        result = request_data
+                    else:
+                        result = await main.compute_partial_availability(
+                            request_data, main.Deadline(record.get("deadline_ms", 0))
+                        )
+                    status = result.status_code if isinstance(result, main.JSONResponse) else 200
+                except Exception as e:
+                    status = f"exception: {type(e).__name__}"
+                finally:
+                    main._stage_timings.reset(token)
+                measurements.append({
+                    "latency_ms": (time.perf_counter() - started) * 1000,
+                    "status": status,
+                    "stages": {name: [wall * 1000, cpu * 1000] for name, (wall, cpu) in timings.items()},
+                })
+
+        await asyncio.gather(*(replay_one(record) for record in requests))
+        await client.aclose()
+        return measurements
+
+    cpu_started = time.process_time()
+    measurements = asyncio.run(run())
+    return {
+        "measurements": measurements,
+        "cpu_ms": (time.process_time() - cpu_started) * 1000,
+        "missing_upstream": transport.missing,
+    }
+
+
+def build_report(results, wall_seconds):
+    measurements = [m for result in results for m in result["measurements"]]
+    latencies = sorted(m["latency_ms"] for m in measurements)
+
+    stage_wall = defaultdict(list)
+    stage_cpu = defaultdict(list)
+    for m in measurements:
+        for name, (wall, cpu) in m["stages"].items():
+            stage_wall[name].append(wall)
+            stage_cpu[name].append(cpu)
+
+    stages = {}
+    for name in stage_wall:
+        walls = sorted(stage_wall[name])
+        stages[name] = {
+            "wall_mean_ms": round(sum(walls) / len(walls), 3),
+            "wall_p95_ms": round(percentile(walls, 95), 3),
+            "cpu_mean_ms": round(sum(stage_cpu[name]) / len(stage_cpu[name]), 3),
+        }
+
+    return {
+        "requests": len(measurements),
+        "wall_seconds": round(wall_seconds, 3),
+        "throughput_rps": round(len(measurements) / wall_seconds, 2) if wall_seconds else None,
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50), 3) if latencies else None,
+            "p90": round(percentile(latencies, 90), 3) if latencies else None,
+            "p99": round(percentile(latencies, 99), 3) if latencies else None,
+            "max": round(latencies[-1], 3) if latencies else None,
+        },
+        "cpu_ms_per_request": round(sum(r["cpu_ms"] for r in results) / len(measurements), 3) if measurements else None,
+        "statuses": {str(status): count for status, count in Counter(m["status"] for m in measurements).items()},
+        "missing_upstream_responses": sum(r["missing_upstream"] for r in results),
+        "stages": stages,
+    }
+
+
+def print_report(report):
+    print(f"Requests:        {report['requests']} in {report['wall_seconds']} s")
+    print(f"Throughput:      {report['throughput_rps']} req/s")
+    latency = report["latency_ms"]
+    print(f"Latency, ms:     p50={latency['p50']} p90={latency['p90']} p99={latency['p99']} max={latency['max']}")
+    print(f"CPU per request: {report['cpu_ms_per_request']} ms")
+    print(f"Statuses:        {report['statuses']}")
+    if report["missing_upstream_responses"]:
+        print(f"Missing upstream responses: {report['missing_upstream_responses']}")
+    print()
+    print(f"{'stage':<22}{'wall mean':>12}{'wall p95':>12}{'cpu mean':>12}")
+    for name, stage in sorted(report["stages"].items(), key=lambda item: -item[1]["wall_mean_ms"]):
+        print(f"{name:<22}{stage['wall_mean_ms']:>12}{stage['wall_p95_ms']:>12}{stage['cpu_mean_ms']:>12}")
+
+
+def compare_with_baseline(report, baseline, max_regression):
+    """Список регрессий относительно базового отчета (доля ухудшения больше max_regression)."""
+    regressions = []
+    for metric in ("p50", "p90", "p99"):
+        before, after = baseline["latency_ms"].get(metric), report["latency_ms"].get(metric)
+        if before and after and after > before * (1 + max_regression):
+            regressions.append(f"latency {metric}: {before} -> {after} ms")
+    before, after = baseline.get("cpu_ms_per_request"), report.get("cpu_ms_per_request")
+    if before and after and after > before * (1 + max_regression):
+        regressions.append(f"cpu per request: {before} -> {after} ms")
+    before, after = baseline.get("throughput_rps"), report.get("throughput_rps")
+    if before and after and after < before / (1 + max_regression):
+        regressions.append(f"throughput: {before} -> {after} req/s")
+    return regressions
+
+
+def command_run(args):
+    workdir = args.workdir or tempfile.mkdtemp(prefix="replay_")
+    options = [{
+        "path": os.path.abspath(args.path),
+        "workdir": workdir,
+        "worker_index": index,
+        "workers": args.processes,
+        "repeat": args.repeat,
+        "concurrency": args.concurrency,
+        "latency_scale": args.latency_scale,
+        "no_dumps": args.no_dumps,
+        "quiet": not args.verbose,
+    } for index in range(args.processes)]
+
+    started = time.perf_counter()
+    with multiprocessing.get_context("spawn").Pool(args.processes) as pool:
+        results = pool.map(replay_worker, options)
+    report = build_report(results, time.perf_counter() - started)
+    print_report(report)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(report, file, ensure_ascii=False, indent=4)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as file:
+            regressions = compare_with_baseline(report, json.load(file), args.max_regression)
+        if regressions:
+            print("\nRegressions against baseline:")
+            for regression in regressions:
+                print(f"  {regression}")
+            return 1
+        print("\nNo regressions against baseline")
+    return 0
+
+
+def command_stats(args):
+    records = load_records(args.path)
+    upstream_latency = defaultdict(list)
+    basket_sizes = Counter()
+    pharmacies_found = []
+    for record in records:
+        basket_sizes[len(record["request"].get("skus", []))] += 1
+        for exchange in record.get("upstream", []):
+            upstream_latency[exchange["kind"]].append(exchange["latency_ms"])
+            if exchange["kind"] == "search" and isinstance(exchange["response"], dict):
+                pharmacies_found.append(len(exchange["response"].get("result", [])))
+
+    print(f"Requests: {len(records)}")
+    print(f"Basket sizes: {dict(sorted(basket_sizes.items()))}")
+    if pharmacies_found:
+        pharmacies_found.sort()
+        print(f"Pharmacies per search: p50={percentile(pharmacies_found, 50)} "
+              f"p99={percentile(pharmacies_found, 99)} max={pharmacies_found[-1]}")
+    for kind, latencies in sorted(upstream_latency.items()):
+        latencies.sort()
+        print(f"{kind} latency, ms: n={len(latencies)} p50={percentile(latencies, 50)} "
+              f"p99={percentile(latencies, 99)}")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Офлайн-прогон записанного трафика /partial_availability. "
+                    "Трафик записывается сервисом при заданной RECORD_TRAFFIC_PATH."
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="прогнать записи через пайплайн с имитацией апстримов")
+    run_parser.add_argument("path", help="JSONL-файл с записанным трафиком")
+    run_parser.add_argument("--processes", type=int, default=os.cpu_count() or 1)
+    run_parser.add_argument("--concurrency", type=int, default=8, help="параллельных запросов в процессе")
+    run_parser.add_argument("--repeat", type=int, default=1, help="сколько раз прогнать записи")
+    run_parser.add_argument("--latency-scale", type=float, default=1.0,
+                            help="множитель записанных задержек апстримов (0 — без задержек)")
+    run_parser.add_argument("--no-dumps", action="store_true", help="не писать промежуточные файлы этапов")
+    run_parser.add_argument("--workdir", help="каталог для промежуточных файлов (по умолчанию временный)")
+    run_parser.add_argument("--output", help="сохранить отчет в JSON")
+    run_parser.add_argument("--baseline", help="отчет для сравнения; при регрессии код выхода 1")
+    run_parser.add_argument("--max-regression", type=float, default=0.1,
+                            help="допустимая доля ухудшения относительно baseline")
+    run_parser.add_argument("--verbose", action="store_true", help="не подавлять логи пайплайна")
+    run_parser.set_defaults(handler=command_run)
+
+    stats_parser = subparsers.add_parser("stats", help="сводка по записанному трафику")
+    stats_parser.add_argument("path")
+    stats_parser.set_defaults(handler=command_stats)
+
+    args = parser.parse_args()
+    return args.handler(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
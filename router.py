@@ -0,0 +1,366 @@
+import argparse
+import asyncio
+import bisect
+import hashlib
+import json
+import logging
+import os
+import socket
+import time
+
+import httpx
+
+
+logger = logging.getLogger(__name__)
+
+# Заголовки одного соединения, которые прокси не пересылает
+HOP_BY_HOP_HEADERS = {
+    b"connection", b"keep-alive", b"proxy-authenticate", b"proxy-authorization",
+    b"te", b"trailer", b"transfer-encoding", b"upgrade", b"host",
+}
+# Запрос, уже прошедший маршрутизацию, обрабатывается на месте: кольца узлов могут на миг различаться.
+# Заголовку верят только от адресов участников, у остальных запросов он удаляется
+ROUTED_HEADER = b"x-routed-by"
+
+
+class HashRing:
+    """Консистентное хеширование с виртуальными узлами.
+
+    Каждый участник занимает replicas точек на кольце; ключ принадлежит первой точке по часовой
+    стрелке. При добавлении или удалении участника переезжает примерно 1/N ключей.
+    """
+
+    def __init__(self, members=(), replicas=100):
+        self.replicas = replicas
+        self._points = []  # отсортированные хеши точек
+        self._owners = {}  # хеш точки -> участник
+        self.members = set()
+        for member in members:
+            self.add(member)
+
+    @staticmethod
+    def _hash(value):
+        return int.from_bytes(hashlib.md5(value.encode("utf-8")).digest()[:8], "big")
+
+    def add(self, member):
+        if member in self.members:
+            return
+        self.members.add(member)
+        for replica in range(self.replicas):
+            point = self._hash(f"{member}#{replica}")
+            self._owners[point] = member
+            bisect.insort(self._points, point)
+
+    def remove(self, member):
+        if member not in self.members:
+            return
+        self.members.discard(member)
+        self._points = [point for point in self._points if self._owners[point] != member]
+        self._owners = {point: owner for point, owner in self._owners.items() if owner != member}
+
+    def lookup(self, key, exclude=()):
+        """Участник для ключа; exclude — участники, которые пропускаются (следующий по кольцу)."""
+        if not self._points:
+            return None
+        start = bisect.bisect(self._points, self._hash(key))
+        for offset in range(len(self._points)):
+            owner = self._owners[self._points[(start + offset) % len(self._points)]]
+            if owner not in exclude:
+                return owner
+        return None
+
+
+def resolve_addresses(members):
+    """IP-адреса хостов участников (для проверки, что запрос пришел от участника)."""
+    addresses = set()
+    for member in members:
+        try:
+            addresses.update(info[4][0] for info in socket.getaddrinfo(httpx.URL(member).host, None))
+        except (OSError, httpx.InvalidURL) as e:
+            logger.warning(f"Failed to resolve router member {member}: {e}")
+    return addresses
+
+
+def read_members_file(path):
+    with open(path, encoding="utf-8") as file:
+        return [line.strip() for line in file if line.strip() and not line.startswith("#")]
+
+
+class CityRouter:
+    """Маршрутизация запросов /partial_availability по городу на воркеры или узлы.
+
+    Город из тела запроса хешируется на кольцо здоровых участников (базовых URL), запрос
+    пересылается выбранному участнику, ответ передается потоком (годится и для SSE).
+    Без app работает как отдельный прокси: остальные пути тоже пересылаются, по хешу пути.
+    С app — как ASGI-middleware: запросы города, принадлежащего self_member, и все остальные
+    пути обрабатывает app.
+
+    Участники опрашиваются по health_path раз в health_interval секунд. Не ответившие
+    выводятся из кольца, ответившие возвращаются. Список участников можно менять в
+    members_file. При ошибке соединения запрос уходит следующему участнику по кольцу;
+    после отправки запроса (например, при таймауте чтения) он не повторяется.
+    """
+
+    def __init__(self, members, app=None, self_member=None, paths=None, members_file=None, replicas=100,
+                 health_path="/health/ready", health_interval=5.0, timeout=30.0):
+        self.app = app
+        self.self_member = self_member
+        self.paths = paths or {"/partial_availability", "/partial_availability/stream"}
+        self.members_file = members_file
+        self.health_path = health_path
+        self.health_interval = health_interval
+        self.timeout = timeout
+        self.static_members = set(members)
+        self.configured = set(members)
+        self._members_mtime = None
+        self._reload_members_file()
+        self.ring = HashRing(sorted(self.configured), replicas=replicas)
+        self.member_addresses = resolve_addresses(self.configured)
+        self.forwarded = {}
+        self.failures = {}
+        self.local = 0
+        self._client = None
+        self._health_task = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan" and self.app is None:
+            await self._lifespan(receive, send)
+            return
+        if scope["type"] != "http":
+            if self.app is not None:
+                await self.app(scope, receive, send)
+            return
+        self._start_health_checks()
+
+        if scope["path"] == "/router/status":
+            await self._send_json(send, 200, self.status())
+            return
+        already_routed = False
+        if any(name == ROUTED_HEADER for name, _ in scope["headers"]):
+            client = scope.get("client")
+            # Отдельный прокси сам не участник: ему заголовок не присылают
+            already_routed = self.app is not None and client is not None and client[0] in self.member_addresses
+            if not already_routed:
+                scope = dict(scope, headers=[(name, value) for name, value in scope["headers"] if name != ROUTED_HEADER])
+        routed = scope["path"] in self.paths and scope["method"] == "POST" and not already_routed
+        if self.app is not None and not routed:
+            await self.app(scope, receive, send)
+            return
+
+        body = await self._read_body(receive)
+        key = self.city_of(body) if routed else scope["path"]
+        tried = set()
+        while True:
+            member = self.ring.lookup(key, exclude=tried)
+            if member is None:
+                await self._send_json(send, 502, {"error": "No healthy upstream workers"})
+                return
+            if member == self.self_member and self.app is not None:
+                self.local += 1
+                await self.app(scope, self._replay(body, receive), send)
+                return
+            if await self._forward(member, scope, body, send):
+                return
+            tried.add(member)
+
+    @staticmethod
+    def city_of(body):
+        """Город из тела запроса; некорректные тела расходятся по хешу пустой строки."""
+        try:
+            city = json.loads(body).get("city")
+        except (ValueError, AttributeError):
+            return ""
+        return city if isinstance(city, str) else ""
+
+    @staticmethod
+    async def _read_body(receive):
+        chunks = []
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                break
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body"):
+                break
+        return b"".join(chunks)
+
+    @staticmethod
+    def _replay(body, receive):
+        sent = False
+
+        async def replay_receive():
+            nonlocal sent
+            if not sent:
+                sent = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            return await receive()
+
+        return replay_receive
+
+    def _get_client(self):
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(timeout=self.timeout)
+        return self._client
+
+    async def _forward(self, member, scope, body, send):
+        """Пересылает запрос; False — участник недоступен (ответ клиенту еще не начат)."""
+        url = member.rstrip("/") + scope["path"]
+        if scope.get("query_string"):
+            url += "?" + scope["query_string"].decode("latin-1")
+        headers = [(name, value) for name, value in scope["headers"]
+                   if name.lower() not in HOP_BY_HOP_HEADERS and name != ROUTED_HEADER]
+        headers.append((ROUTED_HEADER, (self.self_member or "router").encode("latin-1")))
+
+        client = self._get_client()
+        try:
+            request = client.build_request(scope["method"], url, headers=headers, content=body)
+            response = await client.send(request, stream=True)
+        except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+            # Запрос до участника не дошел: его можно повторить на следующем по кольцу
+            logger.warning(f"Router member {member} failed: {e}")
+            self.failures[member] = self.failures.get(member, 0) + 1
+            self._eject(member)
+            return False
+        except httpx.TransportError as e:
+            # Запрос мог уже выполняться (например, таймаут чтения): не повторяем и не выводим участника
+            logger.error(f"Router member {member} did not respond: {e}")
+            self.failures[member] = self.failures.get(member, 0) + 1
+            status = 504 if isinstance(e, httpx.TimeoutException) else 502
+            await self._send_json(send, status, {"error": "Upstream worker did not respond"})
+            return True
+
+        self.forwarded[member] = self.forwarded.get(member, 0) + 1
+        try:
+            await send({
+                "type": "http.response.start",
+                "status": response.status_code,
+                "headers": [(name, value) for name, value in response.headers.raw
+                            if name.lower() not in HOP_BY_HOP_HEADERS],
+            })
+            # Тело передается как есть, в том числе сжатое (Content-Encoding сохраняется)
+            async for chunk in response.aiter_raw():
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+        finally:
+            await response.aclose()
+        return True
+
+    @staticmethod
+    async def _send_json(send, status, content):
+        body = json.dumps(content, ensure_ascii=False).encode("utf-8")
+        await send({"type": "http.response.start", "status": status,
+                    "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]})
+        await send({"type": "http.response.body", "body": body})
+
+    def _eject(self, member):
+        if member in self.ring.members and member != self.self_member:
+            self.ring.remove(member)
+            logger.warning(f"Router member {member} removed from the ring, {len(self.ring.members)} left")
+
+    def _start_health_checks(self):
+        if self._health_task is None and self.health_interval > 0:
+            self._health_task = asyncio.create_task(self._check_health_periodically())
+
+    async def _check_health_periodically(self):
+        while True:
+            try:
+                await self.check_members()
+            except Exception as e:
+                logger.error(f"Router health check failed: {e}")
+            await asyncio.sleep(self.health_interval)
+
+    async def check_members(self):
+        """Перечитывает members_file и опрашивает участников; кольцо перестраивается по результату."""
+        self._reload_members_file()
+        client = self._get_client()
+
+        async def healthy(member):
+            if member == self.self_member:
+                return True
+            try:
+                response = await client.get(member.rstrip("/") + self.health_path, timeout=min(self.timeout, 2.0))
+                return response.status_code == 200
+            except httpx.HTTPError:
+                return False
+
+        members = sorted(self.configured)
+        self.member_addresses = await asyncio.to_thread(resolve_addresses, members)
+        results = await asyncio.gather(*(healthy(member) for member in members))
+        for member, ok in zip(members, results):
+            if ok and member not in self.ring.members:
+                self.ring.add(member)
+                logger.info(f"Router member {member} added to the ring, {len(self.ring.members)} total")
+            elif not ok:
+                self._eject(member)
+        for member in self.ring.members - self.configured:
+            self.ring.remove(member)
+            logger.info(f"Router member {member} is no longer configured, removed from the ring")
+
+    def _reload_members_file(self):
+        if not self.members_file:
+            return
+        try:
+            mtime = os.path.getmtime(self.members_file)
+            if mtime == self._members_mtime:
+                return
+            members = self.static_members | set(read_members_file(self.members_file))
+        except OSError as e:
+            logger.error(f"Failed to read router members file {self.members_file}: {e}")
+            return
+        self._members_mtime = mtime
+        if members != self.configured:
+            logger.info(f"Router members changed: +{sorted(members - self.configured)} "
+                        f"-{sorted(self.configured - members)}")
+            self.configured = members
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                self._start_health_checks()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                if self._health_task is not None:
+                    self._health_task.cancel()
+                if self._client is not None:
+                    await self._client.aclose()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    def status(self):
+        return {
+            "self": self.self_member,
+            "configured": sorted(self.configured),
+            "ring": sorted(self.ring.members),
+            "forwarded": self.forwarded,
+            "failures": self.failures,
+            "local": self.local,
+            "checked_at": time.time(),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Прокси, направляющий запросы одного города на один воркер")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", "8000")))
+    parser.add_argument("--members", default="", help="базовые URL воркеров через запятую")
+    parser.add_argument("--members-file", help="файл со списком воркеров (по строке), перечитывается при изменении")
+    parser.add_argument("--replicas", type=int, default=100, help="виртуальных узлов на воркер")
+    parser.add_argument("--health-interval", type=float, default=5.0)
+    parser.add_argument("--timeout", type=float, default=30.0)
+    args = parser.parse_args()
+
+    members = [member.strip() for member in args.members.split(",") if member.strip()]
+    if not members and not args.members_file:
+        parser.error("no members: use --members or --members-file")
+
+    import uvicorn
+
+    logging.basicConfig(level=logging.INFO)
+    router = CityRouter(members, members_file=args.members_file, replicas=args.replicas,
+                        health_interval=args.health_interval, timeout=args.timeout)
+    uvicorn.run(router, host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+from fastapi.responses import JSONResponse, Response
+from pydantic_core import SchemaSerializer, SchemaValidator, ValidationError, core_schema
+
+
+def _field(schema, required=True):
+    return core_schema.typed_dict_field(schema, required=required)
+
+
+_number = core_schema.union_schema([core_schema.int_schema(), core_schema.float_schema()])
+
+
+# Запрос /partial_availability. Проверки строгие: строки не приводятся к числам,
+# count_desired — только целое. Лишние поля отбрасываются.
+DELIVERY_REQUEST_SCHEMA = core_schema.typed_dict_schema({
+    "city": _field(core_schema.str_schema(min_length=1, strict=True)),
+    "skus": _field(core_schema.list_schema(core_schema.typed_dict_schema({
+        "sku": _field(core_schema.str_schema(strict=True)),
+        "count_desired": _field(core_schema.int_schema(strict=True)),
+    }), min_length=1)),
+    "address": _field(core_schema.typed_dict_schema({
+        "lat": _field(core_schema.float_schema(strict=True)),
+        "lng": _field(core_schema.float_schema(strict=True)),
+    })),
+})
+
+# Ответ best_option. Поля апстримов, не описанные в схеме, сохраняются как есть
+_PHARMACY_SCHEMA = core_schema.typed_dict_schema({
+    "source": _field(core_schema.dict_schema(core_schema.str_schema(), core_schema.any_schema())),
+    "products": _field(core_schema.list_schema(core_schema.any_schema()), required=False),
+    "total_sum": _field(_number, required=False),
+}, extra_behavior="allow")
+
+_DELIVERY_OPTION_SCHEMA = core_schema.typed_dict_schema({
+    "price": _field(_number),
+    "eta": _field(_number),
+}, extra_behavior="allow")
+
+_OPTION_SCHEMA = core_schema.typed_dict_schema({
+    "pharmacy": _field(_PHARMACY_SCHEMA),
+    "total_price": _field(_number),
+    "delivery_option": _field(_DELIVERY_OPTION_SCHEMA),
+    "parts": _field(core_schema.list_schema(core_schema.typed_dict_schema({
+        "pharmacy": _field(_PHARMACY_SCHEMA),
+        "delivery_option": _field(_DELIVERY_OPTION_SCHEMA),
+    }, extra_behavior="allow")), required=False),
+}, extra_behavior="allow")
+
+BEST_OPTIONS_SCHEMA = core_schema.typed_dict_schema({
+    "cheapest_delivery_option": _field(core_schema.nullable_schema(_OPTION_SCHEMA)),
+    "alternative_cheapest_option": _field(core_schema.nullable_schema(_OPTION_SCHEMA)),
+    "fastest_delivery_option": _field(core_schema.nullable_schema(_OPTION_SCHEMA)),
+    "alternative_fastest_option": _field(core_schema.nullable_schema(_OPTION_SCHEMA)),
+    "partial": _field(core_schema.bool_schema(), required=False),
+}, extra_behavior="allow")
+
+delivery_request_validator = SchemaValidator(DELIVERY_REQUEST_SCHEMA)
+best_options_serializer = SchemaSerializer(BEST_OPTIONS_SCHEMA)
+
+
+def _request_error(errors):
+    """Ошибка валидации в тех же сообщениях, что и прежние ручные проверки запроса."""
+    if any(error["type"] == "json_invalid" for error in errors):
+        return JSONResponse(content={"error": "Invalid JSON format"}, status_code=400)
+
+    def missing(error):
+        loc = error["loc"]
+        if not loc:
+            return True  # тело — не объект
+        if loc[0] == "address":
+            return len(loc) == 1 or error["type"] == "missing" or error.get("input") is None
+        return len(loc) == 1
+
+    if any(missing(error) for error in errors):
+        return JSONResponse(content={"error": "City, SKU data, and user coordinates are required"}, status_code=400)
+    if any(error["loc"][0] == "address" for error in errors):
+        return JSONResponse(content={"error": "Invalid data type for user coordinates"}, status_code=400)
+    return JSONResponse(content={"error": "Invalid SKU format or count type"}, status_code=400)
+
+
+def parse_delivery_request(body):
+    """Разбор и проверка тела запроса за один проход; возвращает запрос либо JSONResponse с ошибкой 400."""
+    try:
+        return delivery_request_validator.validate_json(body)
+    except ValidationError as e:
+        return _request_error(e.errors(include_url=False))
+
+
+def best_options_json(result):
+    """Результат best_option в байтах JSON по схеме ответа."""
+    # Данные апстримов могут отличаться от схемы — такие значения кодируются по фактическому типу
+    return best_options_serializer.to_json(result, warnings=False)
+
+
+def encode_best_options(result):
+    """Ответ best_option сериализуется по схеме сразу в байты JSON, минуя jsonable_encoder FastAPI."""
+    if isinstance(result, Response):
+        return result
+    return Response(content=best_options_json(result), media_type="application/json")
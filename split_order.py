@@ -0,0 +1,216 @@
+import heapq
+import math
+
+
+class Coverage:
+    """Что аптека может собрать из корзины: битовая маска позиций и стоимость каждой позиции.
+
+    Позиция считается покрытой, если товара или одного из его аналогов хватает на count_desired.
+    Стоимость позиции — base_price самого дешевого подходящего варианта, умноженная на count_desired.
+    order — место аптеки в ответе поиска: при равной цене позиция достается аптеке, стоящей раньше.
+    """
+
+    __slots__ = ("pharmacy", "mask", "costs", "choices", "total", "fee", "order")
+
+    def __init__(self, pharmacy, basket, fee=0.0, order=0):
+        self.pharmacy = pharmacy
+        self.order = order
+        self.mask = 0
+        self.costs = [math.inf] * len(basket)
+        self.choices = [None] * len(basket)
+        self.fee = fee
+
+        index = {item["sku"]: position for position, item in enumerate(basket)}
+        for product in pharmacy.get("products", []):
+            position = index.get(product.get("sku"))
+            if position is None:
+                continue
+            desired = basket[position]["count_desired"]
+            for variant in [product] + product.get("analogs", []):
+                if variant.get("quantity", 0) >= desired and variant.get("base_price") is not None:
+                    cost = variant["base_price"] * desired
+                    if cost < self.costs[position]:
+                        self.costs[position] = cost
+                        self.choices[position] = variant
+                        self.mask |= 1 << position
+
+        self.total = sum(cost for cost in self.costs if cost != math.inf)
+
+    def dominates(self, other):
+        """Не хуже other по взносу за доставку и по каждой позиции other (маска other — подмножество)."""
+        if self.fee > other.fee or other.mask & ~self.mask:
+            return False
+        mask = other.mask
+        position = 0
+        while mask:
+            if mask & 1 and self.costs[position] > other.costs[position]:
+                return False
+            mask >>= 1
+            position += 1
+        return True
+
+
+def pareto_front(coverages, depth, limit=None):
+    """Аптеки одной маски, которые доминирует меньше depth других.
+
+    Если аптеку доминируют depth аптек, в любом решении с ней ее можно заменить на каждую из них
+    (на одну из них — нельзя, если она уже вторая в паре), поэтому для top_k решений достаточно
+    depth = top_k + 1. limit дополнительно ограничивает группу самыми дешевыми (приближенно).
+    """
+    front = []
+    for coverage in sorted(coverages, key=lambda item: item.total + item.fee):
+        dominated_by = 0
+        for kept in front:
+            if kept.dominates(coverage):
+                dominated_by += 1
+                if dominated_by >= depth:
+                    break
+        if dominated_by < depth:
+            front.append(coverage)
+            if limit and len(front) >= limit:
+                break
+    return front
+
+
+def _both_contribute(first, second):
+    """Каждая аптека пары строго дешевле другой хотя бы по одной позиции.
+
+    Пара, в которой аптека выигрывает позиции только по равной цене, стоит не меньше, чем
+    другая аптека в одиночку, и решением из двух аптек не считается. Условие не зависит от
+    порядка аптек в паре. Проверять нужно, только если одна из масок полная: иначе каждая
+    аптека сама покрывает позицию, которой у другой нет.
+    """
+    first_gets = second_gets = False
+    for first_cost, second_cost in zip(first.costs, second.costs):
+        if first_cost < second_cost:
+            first_gets = True
+        elif second_cost < first_cost:
+            second_gets = True
+    return first_gets and second_gets
+
+
+def _submasks(mask):
+    submask = mask
+    while True:
+        yield submask
+        if submask == 0:
+            return
+        submask = (submask - 1) & mask
+
+
+class SplitOrderSolver:
+    """Поиск самых дешевых способов собрать всю корзину в одной или двух аптеках.
+
+    Аптеки группируются по маске покрытия, внутри группы отсекаются доминируемые
+    (см. pareto_front; max_per_mask — необязательное приближенное ограничение группы). Пары перебираются только по парам масок, дающим всю корзину:
+    для маски m вторая маска — надмножество ее дополнения, то есть дополнение плюс подмаска m.
+    Пары групп с нижней оценкой не лучше худшего решения в куче top_k пропускаются.
+
+    Стоимость решения — сумма стоимостей позиций (каждая позиция берется там, где дешевле)
+    плюс взнос за доставку из каждой аптеки.
+    """
+
+    def __init__(self, top_k=5, max_per_mask=None):
+        self.top_k = top_k
+        self.max_per_mask = max_per_mask
+
+    def solve(self, pharmacies, basket, delivery_fee=0.0):
+        """Возвращает до top_k решений по возрастанию стоимости.
+
+        delivery_fee — число или функция аптека -> ожидаемая цена доставки.
+        Решение: {"cost", "goods", "parts": [{"pharmacy", "positions", "products", "goods"}]}.
+        """
+        size = len(basket)
+        if size == 0:
+            return []
+        full = (1 << size) - 1
+        fee_of = delivery_fee if callable(delivery_fee) else (lambda pharmacy: delivery_fee)
+
+        groups = {}
+        for order, pharmacy in enumerate(pharmacies):
+            coverage = Coverage(pharmacy, basket, fee=fee_of(pharmacy), order=order)
+            if coverage.mask:
+                groups.setdefault(coverage.mask, []).append(coverage)
+        groups = {mask: pareto_front(members, self.top_k + 1, self.max_per_mask) for mask, members in groups.items()}
+
+        # Минимальная стоимость каждой позиции и взнос по группе — для нижних оценок пар групп
+        group_min = {
+            mask: ([min(member.costs[position] for member in members) for position in range(size)],
+                   min(member.fee for member in members))
+            for mask, members in groups.items()
+        }
+
+        heap = []  # (-стоимость, порядковый номер, решение): на вершине худшее из лучших
+        counter = 0
+
+        def worst():
+            return -heap[0][0] if len(heap) >= self.top_k else math.inf
+
+        def offer(cost, solution):
+            nonlocal counter
+            counter += 1
+            if len(heap) < self.top_k:
+                heapq.heappush(heap, (-cost, counter, solution))
+            elif cost < -heap[0][0]:
+                heapq.heapreplace(heap, (-cost, counter, solution))
+
+        for member in groups.get(full, []):
+            offer(member.total + member.fee, (member,))
+
+        ordered_masks = sorted(groups, key=lambda mask: groups[mask][0].total + groups[mask][0].fee)
+        for first_mask in ordered_masks:
+            complement = full & ~first_mask
+            for submask in _submasks(first_mask):
+                second_mask = complement | submask
+                if second_mask < first_mask or second_mask not in groups:
+                    continue  # каждая пара масок рассматривается один раз
+                first_min, first_fee = group_min[first_mask]
+                second_min, second_fee = group_min[second_mask]
+                bound = first_fee + second_fee + sum(map(min, first_min, second_min))
+                if bound >= worst():
+                    continue
+
+                first_members = groups[first_mask]
+                second_members = groups[second_mask]
+                for first_index, first in enumerate(first_members):
+                    if first.fee + second_fee + sum(map(min, first.costs, second_min)) >= worst():
+                        continue  # с этой аптекой ни одна пара группы не попадет в top_k
+                    for second_index, second in enumerate(second_members):
+                        if second_mask == first_mask and second_index <= first_index:
+                            continue
+                        cost = first.fee + second.fee + sum(map(min, first.costs, second.costs))
+                        if cost < worst() and (first_mask != full and second_mask != full or
+                                               _both_contribute(first, second)):
+                            offer(cost, (first, second))
+
+        return [self._solution(-item[0], item[2], size) for item in sorted(heap, key=lambda item: -item[0])]
+
+    @staticmethod
+    def _solution(cost, coverages, size):
+        # Части идут в порядке ответа поиска, равные по цене позиции достаются первой из них
+        coverages = sorted(coverages, key=lambda coverage: coverage.order)
+        parts = [{"pharmacy": coverage.pharmacy, "positions": [], "products": [], "goods": 0} for coverage in coverages]
+        for position in range(size):
+            best = min(range(len(coverages)), key=lambda index: coverages[index].costs[position])
+            parts[best]["positions"].append(position)
+            parts[best]["products"].append(coverages[best].choices[position])
+            parts[best]["goods"] += coverages[best].costs[position]
+        return {"cost": cost, "goods": sum(part["goods"] for part in parts), "parts": parts}
+
+
+def brute_force_solve(pharmacies, basket, top_k=5, delivery_fee=0.0):
+    """Эталон для сравнения: перебор всех аптек и всех пар без отсечений."""
+    size = len(basket)
+    full = (1 << size) - 1
+    fee_of = delivery_fee if callable(delivery_fee) else (lambda pharmacy: delivery_fee)
+    coverages = [Coverage(pharmacy, basket, fee=fee_of(pharmacy), order=order)
+                 for order, pharmacy in enumerate(pharmacies)]
+
+    costs = []
+    for first_index, first in enumerate(coverages):
+        if first.mask == full:
+            costs.append(first.total + first.fee)
+        for second in coverages[first_index + 1:]:
+            if first.mask | second.mask == full and _both_contribute(first, second):
+                costs.append(first.fee + second.fee + sum(map(min, first.costs, second.costs)))
+    return sorted(costs)[:top_k]
@@ -0,0 +1,201 @@
+import copy
+import logging
+import random
+import threading
+import time
+from typing import Any, TypedDict
+
+from fastapi.responses import JSONResponse
+
+
+logger = logging.getLogger(__name__)
+
+
+# Данные, которыми обмениваются этапы пайплайна
+class SearchResult(TypedDict):
+    """Ответ URL_SEARCH: аптеки с товарами."""
+    result: list
+
+
+class FilteredPharmacies(TypedDict):
+    """Аптеки после фильтров по SKU (с total_sum после filter_pharmacies_by_priority_items)."""
+    filtered_pharmacies: list
+
+
+class PharmacyList(TypedDict):
+    """Кандидаты для запроса цен доставки."""
+    list_pharmacies: list
+
+
+class BestOptions(TypedDict):
+    """Итог best_option."""
+    cheapest_delivery_option: Any
+    alternative_cheapest_option: Any
+    fastest_delivery_option: Any
+    alternative_fastest_option: Any
+
+
+class StageSpec:
+    """Описание этапа: входы (для документации) и тип результата, который обязан вернуть любой движок.
+
+    errors — может ли этап вернуть JSONResponse с ошибкой вместо результата.
+    """
+
+    def __init__(self, name, inputs, output, errors=False):
+        self.name = name
+        self.inputs = inputs
+        self.output = output
+        self.errors = errors
+
+    def check_output(self, value):
+        if self.errors and isinstance(value, JSONResponse):
+            return
+        if not isinstance(value, dict) or not self.output.__required_keys__ <= value.keys():
+            raise TypeError(f"Stage '{self.name}' must return {self.output.__name__}, got {type(value).__name__}")
+
+
+class _ShadowStats:
+    __slots__ = ("runs", "mismatches", "errors", "active_time", "shadow_time")
+
+    def __init__(self):
+        self.runs = 0
+        self.mismatches = 0
+        self.errors = 0
+        self.active_time = 0.0
+        self.shadow_time = 0.0
+
+    def as_dict(self):
+        return {
+            "runs": self.runs,
+            "mismatches": self.mismatches,
+            "errors": self.errors,
+            "active_ms_avg": round(self.active_time / self.runs * 1000, 3) if self.runs else None,
+            "shadow_ms_avg": round(self.shadow_time / self.runs * 1000, 3) if self.runs else None,
+        }
+
+
+def same_result(first, second):
+    """Сравнение результатов движков; ошибки сравниваются по статусу и телу ответа."""
+    if isinstance(first, JSONResponse) or isinstance(second, JSONResponse):
+        return isinstance(first, JSONResponse) and isinstance(second, JSONResponse) and \
+            first.status_code == second.status_code and first.body == second.body
+    return first == second
+
+
+class StageRegistry:
+    """Реестр этапов пайплайна и их реализаций (движков).
+
+    У каждого этапа есть движок default — исходная реализация — и, возможно, альтернативные.
+    Активный движок выбирается конфигурацией. Теневой движок на доле запросов sample_rate
+    выполняется после активного на копии входных данных; результаты и время сравниваются
+    и накапливаются в статистике, ответ пользователю всегда дает активный движок.
+    Запросы из выборки ждут и теневой движок.
+    """
+
+    def __init__(self):
+        self.specs = {}
+        self.engines = {}  # этап -> {движок -> функция}
+        self.active = {}
+        self.shadow = {}  # этап -> (движок, доля запросов)
+        self.comparators = {}
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def define(self, name, inputs, output, errors=False, comparator=same_result):
+        self.specs[name] = StageSpec(name, inputs, output, errors=errors)
+        self.engines.setdefault(name, {})
+        self.comparators[name] = comparator
+
+    def engine(self, stage, name="default"):
+        """Декоратор: регистрирует функцию как движок этапа."""
+        def register(func):
+            if stage not in self.specs:
+                raise KeyError(f"Unknown pipeline stage '{stage}'")
+            self.engines[stage][name] = func
+            return func
+        return register
+
+    def configure(self, active=None, shadow=None, shadow_sample_rate=0.0):
+        """active и shadow — строки вида "этап=движок,этап=движок" (например, из переменных окружения).
+
+        Движки проверяются при первом запуске этапа: модули регистрируют их после настройки реестра.
+        """
+        for stage, engine in self._parse(active):
+            self.active[stage] = engine
+        for stage, engine in self._parse(shadow):
+            self.shadow[stage] = (engine, shadow_sample_rate)
+
+    @staticmethod
+    def _parse(value):
+        pairs = []
+        for item in (value or "").split(","):
+            if item.strip():
+                stage, _, engine = item.partition("=")
+                pairs.append((stage.strip(), engine.strip()))
+        return pairs
+
+    def _resolve(self, stage):
+        """Активный и теневой движки этапа; неизвестные движки отключаются с ошибкой в логе."""
+        engines = self.engines[stage]
+        active_name = self.active.get(stage, "default")
+        if active_name not in engines:
+            logger.error(f"Unknown engine '{active_name}' for pipeline stage '{stage}', using default")
+            active_name = self.active[stage] = "default"
+        shadow_name, sample_rate = self.shadow.get(stage, (None, 0.0))
+        if shadow_name is not None and shadow_name not in engines:
+            logger.error(f"Unknown shadow engine '{shadow_name}' for pipeline stage '{stage}', shadowing disabled")
+            del self.shadow[stage]
+            shadow_name = None
+        return active_name, shadow_name, sample_rate
+
+    async def run(self, stage, *args):
+        active_name, shadow_name, sample_rate = self._resolve(stage)
+        active = self.engines[stage][active_name]
+
+        if shadow_name is None or shadow_name == active_name or random.random() >= sample_rate:
+            result = await active(*args)
+            if active_name != "default":
+                self.specs[stage].check_output(result)
+            return result
+
+        # Активный движок может изменять входные данные на месте — теневому нужна своя копия
+        shadow_args = copy.deepcopy(args)
+        started = time.perf_counter()
+        result = await active(*args)
+        active_time = time.perf_counter() - started
+
+        stats = self._stage_stats(stage, shadow_name)
+        try:
+            started = time.perf_counter()
+            shadow_result = await self.engines[stage][shadow_name](*shadow_args)
+            shadow_time = time.perf_counter() - started
+            self.specs[stage].check_output(shadow_result)
+        except Exception as e:
+            logger.error(f"Shadow engine '{shadow_name}' of stage '{stage}' failed: {e}")
+            with self._lock:
+                stats.errors += 1
+            return result
+
+        matched = self.comparators[stage](result, shadow_result)
+        with self._lock:
+            stats.runs += 1
+            stats.active_time += active_time
+            stats.shadow_time += shadow_time
+            if not matched:
+                stats.mismatches += 1
+        if not matched:
+            logger.warning(f"Shadow engine '{shadow_name}' of stage '{stage}' returned a different result")
+        return result
+
+    def _stage_stats(self, stage, engine):
+        with self._lock:
+            return self._stats.setdefault((stage, engine), _ShadowStats())
+
+    def stats(self):
+        with self._lock:
+            shadow = {f"{stage}:{engine}": stats.as_dict() for (stage, engine), stats in self._stats.items()}
+        return {
+            "engines": {stage: sorted(engines) for stage, engines in self.engines.items()},
+            "active": {stage: self.active.get(stage, "default") for stage in self.specs},
+            "shadow": shadow,
+        }
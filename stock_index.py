@@ -0,0 +1,228 @@
+import asyncio
+import glob
+import json
+import logging
+import os
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class CityStockIndex:
+    """Остатки одного города: SKU -> аптека -> запись товара (количество, цены, атрибуты).
+
+    Строится из снимка — ответа URL_SEARCH в исходном формате — и поддерживается событиями изменений.
+    """
+
+    def __init__(self):
+        self.sources = {}  # code -> source
+        self.stock = {}  # sku -> {code -> запись товара без аналогов}
+        self.analogs = {}  # sku -> [analog sku] в порядке появления
+        self.updated_at = None
+
+    def load_snapshot(self, search_response):
+        self.sources.clear()
+        self.stock.clear()
+        self.analogs.clear()
+        for pharmacy in search_response.get("result", []):
+            source = pharmacy.get("source", {})
+            code = source.get("code")
+            if code is None:
+                continue
+            self.sources[code] = source
+            for product in pharmacy.get("products", []):
+                self._add_product(code, product)
+        self.touch()
+
+    def _add_product(self, code, product):
+        record = {key: value for key, value in product.items() if key != "analogs"}
+        self.stock.setdefault(product["sku"], {})[code] = record
+
+        analog_skus = self.analogs.setdefault(product["sku"], [])
+        for analog in product.get("analogs", []):
+            self.stock.setdefault(analog["sku"], {})[code] = dict(analog)
+            if analog["sku"] not in analog_skus:
+                analog_skus.append(analog["sku"])
+
+    def apply(self, event):
+        """Применяет событие изменения остатков.
+
+        Типы событий:
+        - stock (по умолчанию): source_code, sku и изменившиеся поля записи (quantity, base_price, ...),
+          либо полная запись товара в поле product;
+        - source: обновленные данные аптеки в поле source (режим работы и т.п.);
+        - remove_source: аптека source_code больше не работает;
+        - heartbeat: изменений нет, индекс актуален.
+        """
+        event_type = event.get("type", "stock")
+
+        if event_type == "stock":
+            code = event["source_code"]
+            if "product" in event:
+                self._add_product(code, event["product"])
+            else:
+                record = self.stock.get(event["sku"], {}).get(code)
+                if record is None:
+                    logger.warning(f"Stock delta for unknown product {event['sku']} in {code}, skipped")
+                    return
+                for key, value in event.items():
+                    if key not in ("type", "city", "source_code", "sku"):
+                        record[key] = value
+        elif event_type == "source":
+            self.sources[event["source"]["code"]] = event["source"]
+        elif event_type == "remove_source":
+            code = event["source_code"]
+            self.sources.pop(code, None)
+            for by_pharmacy in self.stock.values():
+                by_pharmacy.pop(code, None)
+        elif event_type != "heartbeat":
+            logger.warning(f"Unknown stock event type '{event_type}', skipped")
+            return
+
+        self.touch()
+
+    def touch(self):
+        self.updated_at = time.monotonic()
+
+    def search(self, payload):
+        """Ответ в формате URL_SEARCH или None, если какой-то SKU индексу неизвестен."""
+        if any(item["sku"] not in self.stock for item in payload):
+            return None
+
+        result = []
+        for code, source in self.sources.items():
+            products = []
+            for item in payload:
+                record = self.stock[item["sku"]].get(code)
+                if record is None:
+                    continue
+                product = dict(record, quantity_desired=item["count_desired"])
+                pharmacy_analogs = [
+                    dict(self.stock[analog_sku][code], quantity_desired=item["count_desired"])
+                    for analog_sku in self.analogs.get(item["sku"], [])
+                    if code in self.stock.get(analog_sku, {})
+                ]
+                if pharmacy_analogs:
+                    product["analogs"] = pharmacy_analogs
+                products.append(product)
+
+            if products:
+                result.append({"source": dict(source), "products": products})
+
+        return {"result": result}
+
+
+class StockIndex:
+    """Индекс остатков по городам в памяти процесса."""
+
+    def __init__(self, max_age):
+        self.max_age = max_age
+        self.cities = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def load_snapshot(self, city, search_response):
+        index = CityStockIndex()
+        index.load_snapshot(search_response)
+        with self._lock:
+            self.cities[city] = index
+        logger.info(f"Stock index for city {city} loaded: {len(index.sources)} pharmacies, {len(index.stock)} SKUs")
+
+    def load_snapshot_dir(self, path):
+        """Загружает снимки из каталога: файлы *.json вида {"city": ..., "result": [...]}."""
+        for file_name in sorted(glob.glob(os.path.join(path, "*.json"))):
+            try:
+                with open(file_name, encoding="utf-8") as file:
+                    snapshot = json.load(file)
+                self.load_snapshot(snapshot["city"], snapshot)
+            except (OSError, ValueError, KeyError) as e:
+                logger.error(f"Failed to load stock snapshot {file_name}: {e}")
+
+    def apply(self, event):
+        with self._lock:
+            index = self.cities.get(event.get("city"))
+            if index is None:
+                return
+            try:
+                index.apply(event)
+            except KeyError as e:
+                logger.error(f"Malformed stock event {event}: missing {e}")
+
+    def is_fresh(self, city):
+        index = self.cities.get(city)
+        return index is not None and index.updated_at is not None and \
+            time.monotonic() - index.updated_at <= self.max_age
+
+    def search(self, city, payload):
+        """Ответ из индекса или None, если индекс устарел или не знает каких-то SKU."""
+        with self._lock:
+            data = self.cities[city].search(payload) if self.is_fresh(city) else None
+        if data is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return data
+
+    def stats(self):
+        return {
+            "cities": {city: {"pharmacies": len(index.sources), "skus": len(index.stock), "fresh": self.is_fresh(city)}
+                       for city, index in self.cities.items()},
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+class FileTailFeed:
+    """Источник событий: JSONL-файл, в который дописываются изменения остатков (по событию на строку)."""
+
+    def __init__(self, path, poll_interval=0.5):
+        self.path = path
+        self.poll_interval = poll_interval
+
+    async def events(self):
+        position = 0
+        buffer = ""
+        while True:
+            try:
+                with open(self.path, encoding="utf-8") as file:
+                    file.seek(0, os.SEEK_END)
+                    if file.tell() < position:
+                        position = 0  # файл перезаписан или ротирован
+                    file.seek(position)
+                    buffer += file.read()
+                    position = file.tell()
+            except FileNotFoundError:
+                pass
+
+            *lines, buffer = buffer.split("\n")
+            for line in lines:
+                if line.strip():
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        logger.error(f"Malformed stock event line: {line[:200]}")
+
+            await asyncio.sleep(self.poll_interval)
+
+
+class QueueFeed:
+    """Источник событий из локальной очереди (заглушка брокера сообщений)."""
+
+    def __init__(self):
+        self.queue = asyncio.Queue()
+
+    def publish(self, event):
+        self.queue.put_nowait(event)
+
+    async def events(self):
+        while True:
+            yield await self.queue.get()
+
+
+async def consume_feed(index, feed):
+    """Применяет события источника к индексу, пока задача не будет отменена."""
+    async for event in feed.events():
+        index.apply(event)
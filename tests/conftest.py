@@ -0,0 +1,6 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("URL_SEARCH", "http://search.test/search_medicines")
+os.environ.setdefault("URL_PRICE", "http://price.test/calculate_price")
@@ -0,0 +1,85 @@
+import asyncio
+
+import httpx
+
+import main
+from admission import AdmissionController
+
+REQUEST = {"city": "almaty", "skus": [{"sku": "aspirin", "count_desired": 1}], "address": {"lat": 43.24, "lng": 76.88}}
+
+
+def test_queued_request_times_out_when_no_slot_is_freed():
+    async def scenario():
+        controller = AdmissionController(max_limit=1, max_wait=0.05)
+        assert await controller.acquire()
+        started = asyncio.get_running_loop().time()
+        admitted = await controller.acquire()
+        return controller, admitted, asyncio.get_running_loop().time() - started
+
+    controller, admitted, waited = asyncio.run(scenario())
+
+    assert not admitted
+    assert 0.04 <= waited < 0.5
+    assert controller.timed_out == 1 and controller.in_flight == 1
+    assert controller.stats()["queued"] == 0
+
+
+def test_queued_request_gets_the_released_slot():
+    async def scenario():
+        controller = AdmissionController(max_limit=1, max_wait=1.0)
+        assert await controller.acquire()
+        waiting = asyncio.create_task(controller.acquire())
+        await asyncio.sleep(0)
+        controller.release()
+        return controller, await waiting
+
+    controller, admitted = asyncio.run(scenario())
+
+    assert admitted
+    assert controller.in_flight == 1 and controller.admitted == 2
+
+
+def test_full_queue_returns_503_with_retry_after(monkeypatch):
+    controller = AdmissionController(max_limit=1, queue_size=0)
+    controller.in_flight = 1  # единственный слот занят другим запросом
+    monkeypatch.setattr(main, "admission", controller)
+    monkeypatch.setattr(main, "RESPONSE_CACHE_BACKEND", "none")
+
+    async def scenario():
+        async with httpx.AsyncClient(app=main.app, base_url="http://test") as client:
+            return await client.post("/partial_availability", json=REQUEST)
+
+    response = asyncio.run(scenario())
+
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == str(main.ADMISSION_RETRY_AFTER)
+    assert response.json() == {"error": "Service is overloaded"}
+    assert controller.rejected == 1 and controller.in_flight == 1
+
+
+def test_slow_upstream_multiplies_limit_by_backoff_once_per_interval():
+    controller = AdmissionController(max_limit=20, min_limit=2, latency_target=0.1,
+                                     backoff=0.5, decrease_interval=60.0, smoothing=1.0)
+
+    controller.observe(0.5)
+    assert int(controller.limit) == 10
+
+    # Следующее снижение — не раньше чем через decrease_interval
+    controller.observe(0.5)
+    controller.observe(0.01, failed=True)
+    assert int(controller.limit) == 10
+
+
+def test_limit_never_drops_below_min_limit_and_recovers_additively():
+    controller = AdmissionController(max_limit=4, min_limit=2, latency_target=0.1,
+                                     backoff=0.1, decrease_interval=0.0, smoothing=1.0)
+
+    controller.observe(1.0)
+    controller.observe(1.0, failed=True)
+    assert controller.limit == 2.0
+
+    controller.observe(0.01)
+    assert controller.limit == 2.5
+    controller.observe(0.01)
+    controller.observe(0.01)
+    assert 2.5 < controller.limit < 4
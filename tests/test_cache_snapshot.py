@@ -0,0 +1,106 @@
+import time
+
+import pytest
+
+from cache import MemoryCache, claim_snapshot_slot, write_snapshot
+
+
+def test_snapshot_round_trip_restores_values_and_expiry(tmp_path):
+    path = str(tmp_path / "response_cache.0.bin")
+    cache = MemoryCache()
+    cache.set("a", {"options": [1, 2]}, ttl=60)
+    cache.set_raw("b", b"\x1f\x8b raw", ttl=60)
+    cache.set("expired", "x", ttl=-1)
+
+    assert cache.save_snapshot(path) == 2
+
+    restored = MemoryCache()
+    assert restored.attach_snapshot(path) == 2
+    assert restored.get("a") == {"options": [1, 2]}
+    assert restored.get_raw("b") == b"\x1f\x8b raw"
+    assert restored.get("expired") is None
+    assert restored._entries["a"][0] == cache._entries["a"][0]
+    assert restored.stats()["restored"] == 2
+
+
+def test_expired_records_in_file_are_skipped(tmp_path):
+    path = str(tmp_path / "snapshot.bin")
+    now = time.time()
+    write_snapshot(path, [("live", now + 60, b"1"), ("dead", now - 1, b"2")])
+
+    cache = MemoryCache()
+
+    assert cache.attach_snapshot(path) == 1
+    assert cache.get_raw("live") == b"1"
+    assert cache.get_raw("dead") is None
+
+
+def test_resaving_keeps_records_not_yet_loaded_from_previous_snapshot(tmp_path):
+    first, second = str(tmp_path / "first.bin"), str(tmp_path / "second.bin")
+    cache = MemoryCache()
+    for key in "abc":
+        cache.set(key, key.upper(), ttl=60)
+    cache.save_snapshot(first)
+
+    restarted = MemoryCache()
+    restarted.attach_snapshot(first)
+    assert restarted.get("a") == "A"
+    restarted.set("d", "D", ttl=60)
+    assert restarted.save_snapshot(second) == 4
+
+    again = MemoryCache()
+    again.attach_snapshot(second)
+    assert {key: again.get(key) for key in "abcd"} == {"a": "A", "b": "B", "c": "C", "d": "D"}
+
+
+def test_max_entries_keeps_most_recently_used(tmp_path):
+    path = str(tmp_path / "snapshot.bin")
+    cache = MemoryCache()
+    for key in "abc":
+        cache.set(key, key, ttl=60)
+    cache.get("a")
+
+    assert cache.save_snapshot(path, max_entries=2) == 2
+
+    restored = MemoryCache()
+    restored.attach_snapshot(path)
+    assert restored.get("a") == "a" and restored.get("c") == "c"
+    assert restored.get("b") is None
+
+
+def test_set_after_attach_wins_over_snapshot(tmp_path):
+    path = str(tmp_path / "snapshot.bin")
+    cache = MemoryCache()
+    cache.set("a", "old", ttl=60)
+    cache.save_snapshot(path)
+
+    restored = MemoryCache()
+    restored.attach_snapshot(path)
+    restored.set("a", "new", ttl=60)
+
+    assert restored.get("a") == "new"
+    assert restored.stats()["restored"] == 0
+
+
+def test_truncated_snapshot_is_rejected(tmp_path):
+    path = tmp_path / "snapshot.bin"
+    cache = MemoryCache()
+    cache.set("a", "x" * 100, ttl=60)
+    cache.save_snapshot(str(path))
+    path.write_bytes(path.read_bytes()[:-10])
+
+    with pytest.raises(ValueError):
+        MemoryCache().attach_snapshot(str(path))
+
+
+def test_snapshot_slots_are_exclusive_until_released(tmp_path):
+    first_slot, first_file = claim_snapshot_slot(str(tmp_path))
+    second_slot, second_file = claim_snapshot_slot(str(tmp_path))
+    assert (first_slot, second_slot) == (0, 1)
+
+    first_file.close()
+    slot, file = claim_snapshot_slot(str(tmp_path))
+    assert slot == 0
+
+    file.close()
+    second_file.close()
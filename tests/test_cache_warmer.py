@@ -0,0 +1,53 @@
+import asyncio
+
+from cache_warmer import CacheWarmer, HotKeyTracker
+
+
+def test_first_key_after_tracker_fills_does_not_evict_an_equally_frequent_one():
+    tracker = HotKeyTracker(capacity=2)
+    tracker.add("a", "spec-a")
+    tracker.add("b", "spec-b")
+
+    tracker.add("c", "spec-c")
+
+    assert "a" in tracker and "b" in tracker and "c" not in tracker
+
+
+def test_full_tracker_admits_a_more_frequent_key():
+    tracker = HotKeyTracker(capacity=2)
+    tracker.add("a", "spec-a")
+    for _ in range(3):
+        tracker.add("b", "spec-b")
+    for _ in range(2):
+        tracker.add("c", "spec-c")
+
+    assert "c" in tracker and "b" in tracker and "a" not in tracker
+
+
+def make_warmer(refreshed):
+    async def refresh(cache_key, spec):
+        refreshed.append(cache_key)
+        return True
+
+    return CacheWarmer("test", refresh, min_hits=1, lead=10, rate=100, interval=1)
+
+
+def test_hot_key_without_stored_entry_is_not_refreshed():
+    refreshed = []
+    warmer = make_warmer(refreshed)
+    warmer.record("hot", "cache:hot", {})
+
+    assert asyncio.run(warmer.run_once()) == 0
+    assert refreshed == []
+
+
+def test_hot_key_is_refreshed_only_when_its_entry_is_about_to_expire():
+    refreshed = []
+    warmer = make_warmer(refreshed)
+    warmer.record("soon", "cache:soon", {})
+    warmer.record("later", "cache:later", {})
+    warmer.stored("cache:soon", 5)
+    warmer.stored("cache:later", 600)
+
+    assert asyncio.run(warmer.run_once()) == 1
+    assert refreshed == ["cache:soon"]
@@ -0,0 +1,54 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+from fastapi.responses import JSONResponse
+
+import main
+from cache import NullCache
+
+PHARMACY = {
+    "source": {"code": "apteka_1", "lat": 43.25, "lon": 76.89},
+    "products": [{"sku": "aspirin", "quantity": 5, "quantity_desired": 1}],
+    "total_sum": 1000,
+}
+
+
+@pytest.fixture
+def timing_out_price(monkeypatch):
+    """URL_PRICE, который не отвечает: перед ошибкой вызывается on_call."""
+    state = {"on_call": lambda: None}
+
+    def handler(request):
+        state["on_call"]()
+        raise httpx.ReadTimeout("timed out", request=request)
+
+    client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    monkeypatch.setattr(main, "get_http_client", lambda: client)
+    monkeypatch.setattr(main, "upstream_cache", NullCache())
+    monkeypatch.setattr(main, "PRICE_BATCH_WINDOW_MS", 0)
+    return state
+
+
+def test_upstream_timeout_with_budget_left_is_an_error(timing_out_price):
+    deadline = main.Deadline(10_000)
+
+    result = asyncio.run(main.get_pharmacy_delivery_options(PHARMACY, 43.24, 76.88, deadline=deadline))
+
+    assert isinstance(result, JSONResponse) and result.status_code == 502
+    assert not deadline.partial
+
+
+def test_timeout_when_budget_ran_out_gives_partial_answer(timing_out_price):
+    deadline = main.Deadline(10_000)
+
+    def budget_spent():
+        deadline.expires_at = time.monotonic() + main.DEADLINE_RESERVE_MS / 1000
+
+    timing_out_price["on_call"] = budget_spent
+
+    result = asyncio.run(main.get_pharmacy_delivery_options(PHARMACY, 43.24, 76.88, deadline=deadline))
+
+    assert result is None
+    assert deadline.partial
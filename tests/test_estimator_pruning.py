@@ -0,0 +1,111 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+
+import main
+from cache import MemoryCache
+from estimator import DeliveryEstimator
+
+USER_LAT, USER_LON = 43.24, 76.88
+
+
+def pharmacy(code, total_sum, lat=43.25, lon=76.89):
+    return {
+        "source": {"code": code, "lat": lat, "lon": lon, "opening_hours": "Круглосуточно"},
+        "products": [{"sku": "aspirin", "quantity": 5, "quantity_desired": 1}],
+        "total_sum": total_sum,
+    }
+
+
+def distance_km(item):
+    return main.great_circle_distance_km(USER_LAT, USER_LON, item["source"]["lat"], item["source"]["lon"])
+
+
+@pytest.fixture
+def estimator(monkeypatch):
+    estimator = DeliveryEstimator(min_samples=1)
+    monkeypatch.setattr(main, "delivery_estimator", estimator)
+    monkeypatch.setattr(main, "current_almaty_hour", lambda: 12)
+    monkeypatch.setattr(main, "ESTIMATOR_MARGIN", 0.15)
+    monkeypatch.setattr(main, "ESTIMATOR_MAX_AGE", 600)
+    return estimator
+
+
+def observe(estimator, item, price, eta, age=0):
+    estimator.observe(item["source"]["code"], distance_km(item), 12, [{"price": price, "eta": eta}],
+                      now=time.monotonic() - age)
+
+
+def prune(*pharmacies):
+    candidates = {"list_pharmacies": list(pharmacies)}
+    return main.prune_candidates_by_estimate(candidates, {"list_pharmacies": []}, USER_LAT, USER_LON)
+
+
+def test_candidate_that_cannot_win_is_pruned(estimator):
+    cheap, expensive = pharmacy("cheap", 1000), pharmacy("expensive", 5000)
+    observe(estimator, cheap, 500, 60)
+    observe(estimator, expensive, 500, 120)
+
+    assert prune(cheap, expensive) == {"expensive"}
+
+
+def test_candidate_with_stale_observation_is_requoted(estimator):
+    cheap, expensive = pharmacy("cheap", 1000), pharmacy("expensive", 5000)
+    observe(estimator, cheap, 500, 60)
+    observe(estimator, expensive, 500, 120, age=3600)
+
+    assert prune(cheap, expensive) == set()
+
+
+def test_candidate_never_quoted_is_not_pruned_by_shared_estimate(estimator):
+    cheap, unknown = pharmacy("cheap", 1000), pharmacy("unknown", 5000)
+    observe(estimator, cheap, 500, 60)
+    observe(estimator, pharmacy("other", 1000), 500, 300)
+
+    # Прогноз для unknown есть только на общих уровнях
+    assert estimator.predict("unknown", distance_km(unknown), 12) is not None
+    assert prune(cheap, unknown) == set()
+
+
+def test_nothing_is_pruned_without_predictions(estimator):
+    assert prune(pharmacy("a", 1000), pharmacy("b", 5000)) == set()
+
+
+def test_cached_quote_keeps_estimate_fresh_but_counts_once(monkeypatch, estimator):
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        return httpx.Response(200, json={"status": "success", "result": {"delivery": [{"price": 700, "eta": 40}]}})
+
+    client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    monkeypatch.setattr(main, "get_http_client", lambda: client)
+    monkeypatch.setattr(main, "upstream_cache", MemoryCache())
+    monkeypatch.setattr(main, "ESTIMATOR_ENABLED", True)
+    monkeypatch.setattr(main, "PRICE_BATCH_WINDOW_MS", 0)
+    item = pharmacy("cached", 1000)
+
+    async def quote_twice():
+        await main.get_pharmacy_delivery_options(item, USER_LAT, USER_LON)
+        return await main.get_pharmacy_delivery_options(item, USER_LAT, USER_LON)
+
+    options = asyncio.run(quote_twice())
+
+    assert [option["total_price"] for option in options] == [1700]
+    assert len(calls) == 1
+    assert estimator.stats()["observations"] == 1
+    assert estimator.is_fresh("cached", distance_km(item), 600)
+
+
+def test_cached_quote_refreshes_observation_time_without_adding_a_sample(estimator):
+    item = pharmacy("cached", 1000)
+    observe(estimator, item, 700, 40, age=3600)
+    assert not estimator.is_fresh("cached", distance_km(item), 600)
+
+    for _ in range(10):
+        estimator.touch("cached", distance_km(item))
+
+    assert estimator.is_fresh("cached", distance_km(item), 600)
+    assert estimator.stats()["observations"] == 1
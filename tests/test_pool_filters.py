@@ -0,0 +1,62 @@
+import asyncio
+import copy
+import os
+import random
+import subprocess
+import sys
+
+import pytest
+
+import main
+from fuzz_engines import generate_basket, generate_search_result
+from pool_filters import apply_filter_plan, compact_basket, compact_search_result, plan_filter_stages
+
+
+@pytest.fixture(autouse=True)
+def no_dumps(monkeypatch):
+    monkeypatch.setattr(main, "save_response_to_file", lambda data, file_name="data.json": None)
+
+
+def in_process(pharmacies, basket):
+    return asyncio.run(main.run_filter_stages({"result": pharmacies}, basket))
+
+
+def with_plan(pharmacies, basket):
+    plan = plan_filter_stages(compact_search_result(pharmacies), compact_basket(basket))
+    return apply_filter_plan(pharmacies, basket, plan)
+
+
+def test_plan_matches_in_process_filter_stages():
+    for seed in range(500):
+        rng = random.Random(seed)
+        basket = generate_basket(rng, 4)
+        if rng.random() < 0.2:
+            basket.append(dict(rng.choice(basket)))  # одна и та же позиция дважды
+        pharmacies = generate_search_result(rng, basket, rng.randint(0, 12))
+
+        expected = in_process(copy.deepcopy(pharmacies), basket)
+        assert with_plan(copy.deepcopy(pharmacies), basket) == expected, f"seed {seed}"
+
+
+def test_pool_path_matches_in_process_filter_stages(monkeypatch):
+    rng = random.Random(7)
+    basket = generate_basket(rng, 4)
+    pharmacies = generate_search_result(rng, basket, 30)
+    expected = in_process(copy.deepcopy(pharmacies), basket)
+
+    async def filter_in_pool():
+        try:
+            return await main.run_filter_stages_in_pool({"result": copy.deepcopy(pharmacies)}, basket, main.Deadline())
+        finally:
+            await main.shutdown_process_pool()
+
+    monkeypatch.setattr(main, "_process_pool", None)
+    assert asyncio.run(filter_in_pool()) == expected
+
+
+def test_pool_module_imports_nothing_with_side_effects():
+    code = "import sys, pool_filters; print(sorted({'main', 'fastapi', 'httpx', 'sqlite3'} & set(sys.modules)))"
+    output = subprocess.run([sys.executable, "-c", code], cwd=os.path.dirname(main.__file__),
+                            capture_output=True, text=True, check=True).stdout
+
+    assert output.strip() == "[]"
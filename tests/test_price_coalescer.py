@@ -0,0 +1,166 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+
+import main
+
+
+def mock_delivery_price(payload):
+    # Детерминированная цена и время доставки, зависящие от аптеки
+    code_factor = sum(payload.get("source_code", "").encode("utf-8")) % 7
+    return {
+        "status": "success",
+        "result": {
+            "delivery": [
+                {"price": 600 + 50 * code_factor, "eta": 45 + 10 * code_factor},
+                {"price": 1200 + 50 * code_factor, "eta": 25 + 5 * code_factor},
+            ]
+        }
+    }
+
+
+class PriceServer:
+    """Локальная замена URL_PRICE и URL_PRICE_BATCH: запоминает вызовы, ответ пакета можно подменить."""
+
+    single_url = "http://price.test/calculate_price"
+    batch_url = "http://price.test/calculate_price/batch"
+
+    def __init__(self, batch_answers=None):
+        self.batch_answers = batch_answers
+        self.calls = []  # (url, тело, таймаут чтения)
+
+    def handler(self, request):
+        body = json.loads(request.content)
+        self.calls.append((str(request.url), body, request.extensions["timeout"]["read"]))
+        if str(request.url) == self.batch_url:
+            if self.batch_answers is not None:
+                return httpx.Response(200, json=self.batch_answers(body))
+            return httpx.Response(200, json=[mock_delivery_price(payload) for payload in body])
+        return httpx.Response(200, json=mock_delivery_price(body))
+
+
+@pytest.fixture
+def price_server(monkeypatch):
+    server = PriceServer()
+    client = httpx.AsyncClient(transport=httpx.MockTransport(server.handler), timeout=30)
+    monkeypatch.setattr(main, "get_http_client", lambda: client)
+    monkeypatch.setattr(main, "URL_PRICE", server.single_url)
+    return server
+
+
+def payload(code):
+    return {"source_code": code, "user_address": {"lat": 43.24, "lng": 76.88}}
+
+
+async def quote_all(coalescer, payloads, timeouts=None):
+    timeouts = timeouts or [None] * len(payloads)
+    return await asyncio.gather(*(coalescer.quote(item, timeout=timeout) for item, timeout in zip(payloads, timeouts)),
+                                return_exceptions=True)
+
+
+def test_distinct_payloads_are_sent_in_one_batch(price_server):
+    coalescer = main.PriceQuoteCoalescer(window_ms=10, max_batch_size=20, batch_url=price_server.batch_url)
+    payloads = [payload("a"), payload("bb"), payload("a")]
+
+    answers = asyncio.run(quote_all(coalescer, payloads))
+
+    assert answers == [mock_delivery_price(item) for item in payloads]
+    assert [(url, body) for url, body, _ in price_server.calls] == \
+        [(price_server.batch_url, [payload("a"), payload("bb")])]
+    assert (coalescer.requested, coalescer.sent) == (3, 1)
+
+
+def test_without_batch_url_each_payload_is_sent_once(price_server):
+    coalescer = main.PriceQuoteCoalescer(window_ms=10, max_batch_size=20)
+
+    answers = asyncio.run(quote_all(coalescer, [payload("a"), payload("bb"), payload("a")]))
+
+    assert answers[0] == answers[2] == mock_delivery_price(payload("a"))
+    assert sorted(body["source_code"] for _, body, _ in price_server.calls) == ["a", "bb"]
+
+
+def test_batch_length_mismatch_fails_every_waiter(price_server):
+    price_server.batch_answers = lambda body: [mock_delivery_price(body[0])]
+    coalescer = main.PriceQuoteCoalescer(window_ms=10, max_batch_size=20, batch_url=price_server.batch_url)
+
+    answers = asyncio.run(quote_all(coalescer, [payload("a"), payload("bb")]))
+
+    assert all(isinstance(answer, httpx.DecodingError) for answer in answers)
+
+
+def test_batch_item_that_is_not_an_object_fails_only_its_waiter(price_server):
+    price_server.batch_answers = lambda body: [mock_delivery_price(body[0]), "oops", None]
+    coalescer = main.PriceQuoteCoalescer(window_ms=10, max_batch_size=20, batch_url=price_server.batch_url)
+
+    answers = asyncio.run(quote_all(coalescer, [payload("a"), payload("bb"), payload("ccc")]))
+
+    assert answers[0] == mock_delivery_price(payload("a"))
+    assert isinstance(answers[1], httpx.DecodingError)
+    assert isinstance(answers[2], httpx.DecodingError)
+
+
+def test_upstream_call_is_bounded_by_latest_waiter_deadline(price_server):
+    coalescer = main.PriceQuoteCoalescer(window_ms=10, max_batch_size=20, batch_url=price_server.batch_url)
+
+    asyncio.run(quote_all(coalescer, [payload("a"), payload("bb"), payload("a")], timeouts=[2.0, 5.0, 1.0]))
+
+    (_, _, timeout), = price_server.calls
+    assert 4.5 < timeout <= 5.0
+
+
+def test_waiter_without_deadline_leaves_upstream_call_unbounded(price_server):
+    coalescer = main.PriceQuoteCoalescer(window_ms=10, max_batch_size=20, batch_url=price_server.batch_url)
+
+    asyncio.run(quote_all(coalescer, [payload("a"), payload("bb")], timeouts=[1.0, None]))
+
+    (_, _, timeout), = price_server.calls
+    assert timeout == 30
+
+
+async def serve_slowly(delay):
+    """HTTP-сервер на настоящем сокете: отвечает на пакет цен через delay секунд."""
+    async def handle(reader, writer):
+        head = await reader.readuntil(b"\r\n\r\n")
+        length = next(int(line.split(b":")[1]) for line in head.split(b"\r\n")
+                      if line.lower().startswith(b"content-length:"))
+        body = json.loads(await reader.readexactly(length))
+        await asyncio.sleep(delay)
+        answer = json.dumps([mock_delivery_price(item) for item in body]).encode()
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nConnection: close\r\n"
+                     b"Content-Length: " + str(len(answer)).encode() + b"\r\n\r\n" + answer)
+        await writer.drain()
+        writer.close()
+
+    return await asyncio.start_server(handle, "127.0.0.1", 0)
+
+
+def test_short_deadline_waiter_does_not_fail_the_others(monkeypatch):
+    async def scenario():
+        server = await serve_slowly(0.2)
+        port = server.sockets[0].getsockname()[1]
+        async with httpx.AsyncClient(timeout=30) as client:
+            monkeypatch.setattr(main, "get_http_client", lambda: client)
+            coalescer = main.PriceQuoteCoalescer(window_ms=10, max_batch_size=20,
+                                                 batch_url=f"http://127.0.0.1:{port}/calculate_price/batch")
+            answers = await quote_all(coalescer, [payload("a"), payload("bb"), payload("ccc")],
+                                      timeouts=[0.05, None, 5.0])
+        server.close()
+        await server.wait_closed()
+        return answers
+
+    answers = asyncio.run(scenario())
+
+    assert isinstance(answers[0], httpx.TimeoutException)
+    assert answers[1] == mock_delivery_price(payload("bb"))
+    assert answers[2] == mock_delivery_price(payload("ccc"))
+
+
+def test_without_timeouts_client_default_is_used(price_server):
+    coalescer = main.PriceQuoteCoalescer(window_ms=10, max_batch_size=20)
+
+    asyncio.run(quote_all(coalescer, [payload("a")]))
+
+    (_, _, timeout), = price_server.calls
+    assert timeout == 30
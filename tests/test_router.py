@@ -0,0 +1,122 @@
+import asyncio
+import json
+
+import httpx
+
+from router import CityRouter, HashRing
+
+MEMBERS = ["http://10.0.0.1:8000", "http://10.0.0.2:8000", "http://10.0.0.3:8000"]
+KEYS = [f"city-{i}" for i in range(5000)]
+
+SELF = "http://127.0.0.1:9001"
+OTHER = "http://127.0.0.1:9002"
+
+
+def owners(ring):
+    return {key: ring.lookup(key) for key in KEYS}
+
+
+def test_adding_member_moves_about_one_nth_of_keys_and_only_to_it():
+    ring = HashRing(MEMBERS)
+    before = owners(ring)
+
+    ring.add("http://10.0.0.4:8000")
+    after = owners(ring)
+
+    moved = [key for key in KEYS if before[key] != after[key]]
+    assert all(after[key] == "http://10.0.0.4:8000" for key in moved)
+    assert 0.15 < len(moved) / len(KEYS) < 0.35
+
+
+def test_removing_member_moves_only_its_keys():
+    ring = HashRing(MEMBERS)
+    before = owners(ring)
+
+    ring.remove(MEMBERS[1])
+    after = owners(ring)
+
+    moved = [key for key in KEYS if before[key] != after[key]]
+    assert moved and all(before[key] == MEMBERS[1] for key in moved)
+    assert MEMBERS[1] not in after.values()
+    assert 0.2 < len(moved) / len(KEYS) < 0.5
+
+
+def test_lookup_skips_excluded_members():
+    ring = HashRing(MEMBERS)
+
+    for key in KEYS[:100]:
+        owner = ring.lookup(key)
+        assert ring.lookup(key, exclude={owner}) not in (owner, None)
+    assert ring.lookup("x", exclude=set(MEMBERS)) is None
+
+
+class Recorder:
+    """Локальное приложение и апстрим-участник: запоминают заголовки пришедших к ним запросов."""
+
+    def __init__(self):
+        self.local = []
+        self.forwarded = []
+
+    async def app(self, scope, receive, send):
+        self.local.append(dict(scope["headers"]))
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b"local"})
+
+    def upstream(self, request):
+        self.forwarded.append(dict(request.headers))
+        return httpx.Response(200, stream=httpx.ByteStream(b"forwarded"))
+
+
+def make_router(recorder):
+    router = CityRouter([SELF, OTHER], app=recorder.app, self_member=SELF, health_interval=0)
+    router._client = httpx.AsyncClient(transport=httpx.MockTransport(recorder.upstream))
+    return router
+
+
+def call(router, city, client, routed_by):
+    body = json.dumps({"city": city}).encode()
+    scope = {
+        "type": "http", "method": "POST", "path": "/partial_availability", "query_string": b"",
+        "headers": [(b"content-type", b"application/json"), (b"x-routed-by", routed_by.encode())],
+        "client": client,
+    }
+    messages = [{"type": "http.request", "body": body, "more_body": False}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0) if messages else {"type": "http.disconnect"}
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(router(scope, receive, send))
+    return sent[0]["status"]
+
+
+def city_owned_by(ring, member):
+    return next(key for key in KEYS if ring.lookup(key) == member)
+
+
+def test_routed_header_from_non_member_is_dropped_and_request_is_routed():
+    recorder = Recorder()
+    router = make_router(recorder)
+    city = city_owned_by(router.ring, OTHER)
+
+    status = call(router, city, ("192.0.2.10", 50000), routed_by=OTHER)
+
+    assert status == 200
+    assert not recorder.local
+    assert recorder.forwarded[0]["x-routed-by"] == SELF
+    assert router.forwarded == {OTHER: 1}
+
+
+def test_routed_header_from_member_is_handled_locally():
+    recorder = Recorder()
+    router = make_router(recorder)
+    city = city_owned_by(router.ring, OTHER)
+
+    status = call(router, city, ("127.0.0.1", 50000), routed_by=OTHER)
+
+    assert status == 200
+    assert not recorder.forwarded
+    assert recorder.local[0][b"x-routed-by"] == OTHER.encode()
@@ -0,0 +1,52 @@
+import json
+
+import pytest
+from fastapi.responses import JSONResponse
+
+from schemas import best_options_json, parse_delivery_request
+
+VALID = {"city": "almaty", "skus": [{"sku": "aspirin", "count_desired": 1}], "address": {"lat": 43.24, "lng": 76.88}}
+
+REQUIRED = "City, SKU data, and user coordinates are required"
+COORDINATES = "Invalid data type for user coordinates"
+SKU = "Invalid SKU format or count type"
+
+
+def with_(**fields):
+    return dict(VALID, **fields)
+
+
+def test_valid_request_is_parsed_and_extra_fields_are_dropped():
+    body = with_(comment="x", skus=[{"sku": "aspirin", "count_desired": 2, "note": "y"}])
+
+    assert parse_delivery_request(json.dumps(body)) == with_(skus=[{"sku": "aspirin", "count_desired": 2}])
+
+
+@pytest.mark.parametrize("body, error", [
+    (b"{not json", "Invalid JSON format"),
+    (b"[]", REQUIRED),
+    ({k: v for k, v in VALID.items() if k != "city"}, REQUIRED),
+    (with_(city=""), REQUIRED),
+    (with_(skus=[]), REQUIRED),
+    ({k: v for k, v in VALID.items() if k != "address"}, REQUIRED),
+    (with_(address={"lat": 43.24}), REQUIRED),
+    (with_(address={"lat": None, "lng": 76.88}), REQUIRED),
+    (with_(address={"lat": "43.24", "lng": 76.88}), COORDINATES),
+    (with_(skus=[{"sku": 1, "count_desired": 1}]), SKU),
+    (with_(skus=[{"sku": "aspirin", "count_desired": "1"}]), SKU),
+    (with_(skus=[{"sku": "aspirin", "count_desired": 1.5}]), SKU),
+])
+def test_validation_errors_map_to_the_original_messages(body, error):
+    result = parse_delivery_request(body if isinstance(body, bytes) else json.dumps(body))
+
+    assert isinstance(result, JSONResponse) and result.status_code == 400
+    assert json.loads(result.body) == {"error": error}
+
+
+def test_best_options_keep_upstream_fields_not_in_schema():
+    option = {"pharmacy": {"source": {"code": "a"}, "rating": 5}, "total_price": 1700,
+              "delivery_option": {"price": 700, "eta": 40, "courier": "x"}}
+    result = {"cheapest_delivery_option": option, "alternative_cheapest_option": None,
+              "fastest_delivery_option": option, "alternative_fastest_option": None}
+
+    assert json.loads(best_options_json(result)) == result
@@ -0,0 +1,59 @@
+import random
+
+from split_order import SplitOrderSolver, brute_force_solve
+
+
+def random_city(rng):
+    """Маленький город с целыми ценами из короткого списка: равные цены позиций встречаются часто."""
+    basket = [{"sku": f"sku_{position}", "count_desired": rng.randint(1, 2)} for position in range(rng.randint(1, 4))]
+    pharmacies = []
+    for index in range(rng.randint(1, 8)):
+        products = []
+        for item in basket:
+            if rng.random() < 0.3:
+                continue
+            product = {"sku": item["sku"], "base_price": rng.choice((25, 50, 75, 100)),
+                       "quantity": rng.choice((0, 2, 5)), "quantity_desired": item["count_desired"]}
+            if rng.random() < 0.2:
+                product["analogs"] = [{"sku": f"{item['sku']}_analog", "base_price": rng.choice((25, 50, 75)),
+                                       "quantity": rng.choice((0, 2)), "quantity_desired": item["count_desired"]}]
+            products.append(product)
+        pharmacies.append({"source": {"code": f"pharmacy_{index}"}, "products": products})
+    return pharmacies, basket
+
+
+def test_solver_matches_brute_force_with_tied_prices():
+    for seed in range(3000):
+        rng = random.Random(seed)
+        pharmacies, basket = random_city(rng)
+        fee = rng.choice((0, 25, 50))
+
+        solutions = SplitOrderSolver(top_k=3).solve(pharmacies, basket, delivery_fee=fee)
+
+        expected = brute_force_solve(pharmacies, basket, top_k=3, delivery_fee=fee)
+        assert [solution["cost"] for solution in solutions] == expected, f"seed {seed}"
+
+
+def test_pair_that_wins_only_by_tie_is_not_a_split():
+    basket = [{"sku": "a", "count_desired": 1}, {"sku": "b", "count_desired": 1}]
+    full = {"source": {"code": "full"}, "products": [
+        {"sku": "a", "base_price": 50, "quantity": 5}, {"sku": "b", "base_price": 75, "quantity": 5}]}
+    tied = {"source": {"code": "tied"}, "products": [{"sku": "b", "base_price": 75, "quantity": 5}]}
+
+    for pharmacies in ([full, tied], [tied, full]):
+        solutions = SplitOrderSolver(top_k=5).solve(pharmacies, basket)
+        assert [len(solution["parts"]) for solution in solutions] == [1]
+
+
+def test_tied_position_goes_to_the_pharmacy_listed_first():
+    basket = [{"sku": "a", "count_desired": 1}, {"sku": "b", "count_desired": 1}, {"sku": "c", "count_desired": 1}]
+    first = {"source": {"code": "first"}, "products": [
+        {"sku": "a", "base_price": 50, "quantity": 5}, {"sku": "c", "base_price": 60, "quantity": 5}]}
+    second = {"source": {"code": "second"}, "products": [
+        {"sku": "b", "base_price": 50, "quantity": 5}, {"sku": "c", "base_price": 60, "quantity": 5}]}
+
+    for pharmacies in ([first, second], [second, first]):
+        solution, = SplitOrderSolver(top_k=5).solve(pharmacies, basket)
+        owner = pharmacies[0]["source"]["code"]
+        assert [(part["pharmacy"]["source"]["code"], part["positions"]) for part in solution["parts"]][0] == \
+            (owner, [0, 2] if owner == "first" else [1, 2])
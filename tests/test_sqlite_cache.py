@@ -0,0 +1,50 @@
+import asyncio
+import sqlite3
+import threading
+
+from cache import SQLiteCache
+
+
+def test_caches_in_one_file_use_separate_tables(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    responses = SQLiteCache(path, table="response_cache")
+    negatives = SQLiteCache(path, table="negative_cache")
+
+    responses.set("key", {"answer": 1}, 60)
+    negatives.set("key", True, 60)
+
+    assert responses.get("key") == {"answer": 1}
+    assert negatives.get("key") is True
+    assert responses.stats()["entries"] == negatives.stats()["entries"] == 1
+
+
+def test_reads_do_not_write_access_time_until_batch_is_full(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    cache = SQLiteCache(path)
+    cache.set("key", "value", 60)
+    conn = sqlite3.connect(path)
+    written = conn.execute("SELECT accessed_at FROM cache WHERE key = 'key'").fetchone()[0]
+
+    cache.get("key")
+    assert conn.execute("SELECT accessed_at FROM cache WHERE key = 'key'").fetchone()[0] == written
+
+    cache.TOUCH_BATCH = 1
+    cache.get("key")
+    assert conn.execute("SELECT accessed_at FROM cache WHERE key = 'key'").fetchone()[0] > written
+
+
+def test_async_operations_and_stats_run_off_the_event_loop_thread(tmp_path, monkeypatch):
+    cache = SQLiteCache(str(tmp_path / "cache.sqlite3"))
+    threads = []
+    stats = cache.stats
+    monkeypatch.setattr(cache, "stats", lambda: threads.append(threading.get_ident()) or stats())
+
+    async def scenario():
+        await cache.aset("key", "value", 60)
+        return await cache.aget("key"), await cache.astats()
+
+    value, result = asyncio.run(scenario())
+
+    assert value == "value"
+    assert result["entries"] == 1
+    assert threads and threads[0] != threading.get_ident()